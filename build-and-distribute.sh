@@ -1,29 +1,41 @@
 #!/bin/bash
-exit 1 # needs to be configured
-
 set -euo pipefail
-# Typically where this file is located at
-#CODE_ROOT="$HOME/Projects/ppi"
 
-# Can be used for local development
-#WWW_ROOT="${CODE_ROOT}/client/www"
+# Configured in the environment or in build-and-distribute.env next to this
+# script, which is sourced if it exists, e.g.
+#   # Where the web server serves the distribution from
+#   WWW_ROOT="$HOME/Projects/ppi/client/www"
+# With --check, only checks the configuration.
+cd "$(dirname "$(readlink -f "$0")")"
+if [[ -f build-and-distribute.env ]] ; then
+    source build-and-distribute.env
+fi
+if [[ -z "${WWW_ROOT:-}" ]] ; then
+    echo "WWW_ROOT needs to be configured, see the top of build-and-distribute.sh" >&2
+    exit 1
+fi
+RASTER_TO_JSON=fmi/dist_builder/raster_to_json/target/release/raster_to_json
+if [[ ! -x "${RASTER_TO_JSON}" ]] ; then
+    echo "${RASTER_TO_JSON} does not exist! See fmi/dist_builder/raster_to_json/README.md for build instructions." >&2
+    exit 1
+fi
+if [[ "${1:-}" == "--check" ]] ; then
+    exit 0
+fi
 
 # Create an updated distribution
-python3 fmi/dist_builder/collect_radar_products.py fmi/data | \
-    python3 collect.py fmi/dist_builder/raster_to_json/target/release/raster_to_json dist
-python3 finnish_localities/localities_to_geojson.py finnish_localities/finnish_localities.tsv > dist/geointerests.geojson
-
-# Remove old files
-find dist -mmin +1440 -delete
-
-# Set proper permissions
+mkdir -p dist
+python3 finnish_localities/localities_to_geojson.py finnish_localities/finnish_localities.tsv > dist/geointerests.geojson.tmp
+mv dist/geointerests.geojson.tmp dist/geointerests.geojson
+python3 fmi/dist_builder/collect_radar_products.py --index fmi/product_index.sqlite --prune fmi/data | \
+    python3 collect.py "${RASTER_TO_JSON}" dist \
+        --max-age-hours 24 --remove-unreferenced
+
+# Set proper permissions; the published snapshots share the files with dist
 find dist -exec chmod 777 {} \;
 
-# First sync everything but the catalog so that we can atomically switch the catalog
-rsync -a dist/ "${WWW_ROOT}/data/" --exclude 'catalog.json'
-
-# Switch the catalog
-cp dist/catalog.json "${WWW_ROOT}/data/"
-
-# Do a second sync; this should get rid of the old files in the dest as well
-rsync -a -delete dist/ "${WWW_ROOT}/data/"
+# Publish it as a new snapshot under ${WWW_ROOT}/generations only now that
+# everything above has succeeded; ${WWW_ROOT}/data should be a symlink to
+# generations/current, which is switched atomically once the snapshot is
+# complete
+python3 publish.py dist "${WWW_ROOT}/generations"
@@ -2,12 +2,26 @@ import { Component } from 'react'
 
 export type FlavorTime = {
   time: string,
-  url: string
+  url: string,
+  format?: 'json' | 'binary' | 'cog',
+  // XYZ tile URL template, see raster_to_tiles.py
+  tiles?: string,
+  // Lower resolution versions of the product, see decimation.py
+  overviews?: { decimation: number, url: string }[]
+}
+
+// Latest times of a flavor as one animation sequence, see export_sequences
+// in collect.py
+export type FlavorSequence = {
+  url: string,
+  times: string[],
+  format: 'sequence'
 }
 
 export type Flavor = {
   display: string,
-  times: FlavorTime[]
+  times: FlavorTime[],
+  sequence?: FlavorSequence
 }
 
 export type CatalogProduct = {
@@ -27,9 +41,97 @@ export type RadarProducts = {
 }
 
 export type Catalog = {
+  generation?: number,
   radarProducts: RadarProducts
 }
 
+// See write_catalog in collect.py
+type CatalogGeneration = {
+  generation: number,
+  oldestDelta: number
+}
+
+export type CatalogDelta = {
+  fromGeneration: number,
+  generation: number,
+  added: RadarProducts,
+  removed: RadarProducts
+}
+
+export function applyCatalogDelta(catalog: Catalog, delta: CatalogDelta): Catalog {
+  const radarProducts = JSON.parse(JSON.stringify(catalog.radarProducts)) as RadarProducts
+
+  for (const siteId in delta.added) {
+    const addedSite = delta.added[siteId]
+    const site = radarProducts[siteId] ??= { ...addedSite, products: {} }
+    for (const productId in addedSite.products) {
+      const addedProduct = addedSite.products[productId]
+      const product = site.products[productId] ??= { ...addedProduct, flavors: {} }
+      for (const flavorId in addedProduct.flavors) {
+        const addedFlavor = addedProduct.flavors[flavorId]
+        const flavor = product.flavors[flavorId] ??= { ...addedFlavor, times: [] }
+        if (addedFlavor.sequence) flavor.sequence = addedFlavor.sequence
+        const urls = new Set(flavor.times.map((t) => t.url))
+        flavor.times.push(...addedFlavor.times.filter((t) => !urls.has(t.url)))
+        flavor.times.sort((a, b) => a.time < b.time ? -1 : a.time > b.time ? 1 : 0)
+      }
+    }
+  }
+
+  for (const siteId in delta.removed) {
+    const removedSite = delta.removed[siteId]
+    const site = radarProducts[siteId]
+    if (!site) continue
+    for (const productId in removedSite.products) {
+      const removedProduct = removedSite.products[productId]
+      const product = site.products[productId]
+      if (!product) continue
+      for (const flavorId in removedProduct.flavors) {
+        const removedFlavor = removedProduct.flavors[flavorId]
+        const flavor = product.flavors[flavorId]
+        if (!flavor) continue
+        const urls = new Set(removedFlavor.times.map((t) => t.url))
+        flavor.times = flavor.times.filter((t) => !urls.has(t.url))
+        if (flavor.times.length == 0) delete product.flavors[flavorId]
+      }
+      if (Object.keys(site.products[productId].flavors).length == 0) delete site.products[productId]
+    }
+    if (Object.keys(site.products).length == 0) delete radarProducts[siteId]
+  }
+
+  return { generation: delta.generation, radarProducts }
+}
+
+const fetchJson = <T>(url: string): Promise<T> =>
+  fetch(url).then((response) => {
+    if (!response.ok) throw new Error(`Fetching ${url} failed with status ${response.status}`)
+    return response.json() as Promise<T>
+  })
+
+// Brings the catalog up to date with deltas when possible, otherwise
+// fetches the whole catalog. Resolves to null if nothing has changed.
+async function updateCatalog(url: string, catalog: Catalog | null): Promise<Catalog | null> {
+  const baseUrl = url.substring(0, url.lastIndexOf('/') + 1)
+  if (catalog === null || catalog.generation === undefined) {
+    return fetchJson<Catalog>(url)
+  }
+
+  const latest = await fetchJson<CatalogGeneration>(baseUrl + 'catalog-generation.json')
+  if (latest.generation == catalog.generation) {
+    return null
+  }
+  if (latest.generation < catalog.generation || catalog.generation + 1 < latest.oldestDelta) {
+    return fetchJson<Catalog>(url)
+  }
+
+  let updated = catalog
+  for (let generation = catalog.generation + 1; generation <= latest.generation; generation++) {
+    const delta = await fetchJson<CatalogDelta>(`${baseUrl}catalog-deltas/${generation}.json`)
+    updated = applyCatalogDelta(updated, delta)
+  }
+  return updated
+}
+
 type CatalogProviderProps = {
   onCatalogUpdate: (catalog: Catalog) => void,
   url: string
@@ -38,11 +140,13 @@ type CatalogProviderProps = {
 export class CatalogProvider extends Component<CatalogProviderProps> {
   private intervalId: number | null
   private initialTimeoutId: number | null
+  private catalog: Catalog | null
 
   constructor(props: Readonly<CatalogProviderProps> | CatalogProviderProps) {
     super(props)
     this.intervalId = null
     this.initialTimeoutId = null
+    this.catalog = null
   }
 
   componentDidMount() {
@@ -50,10 +154,15 @@ export class CatalogProvider extends Component<CatalogProviderProps> {
     const url = this.props.url
 
     const update = () => {
-      fetch(url)
-        .then((response) => response.json())
-        .then((obj) => {
-          onCatalogUpdate(obj as Catalog)
+      updateCatalog(url, this.catalog)
+        .catch((e) => {
+          console.warn('Incremental catalog update failed, fetching the whole catalog', e)
+          return fetchJson<Catalog>(url)
+        })
+        .then((catalog) => {
+          if (catalog === null) return
+          this.catalog = catalog
+          onCatalogUpdate(catalog)
         })
     }
 
@@ -9,9 +9,9 @@ import { DataValueType, DataScale } from './datavalue'
 import { AffineTransform } from './reprojection'
 
 
-function inflate(input: Uint8Array): string {
+function inflate(input: Uint8Array): Uint8Array {
   try {
-    return pako.inflate(input, { to: 'string' })
+    return pako.inflate(input)
   } catch (err) {
     console.error('Failed to decompress product file:', err)
     throw err
@@ -35,10 +35,144 @@ export type LoadedProduct = {
   }
 }
 
+// See fmi/dist_builder/raster_to_binary.py for the format
+const BINARY_PRODUCT_MAGIC = 'PPIB'
+const BINARY_PRODUCT_HEADER_LENGTH = 68
+const BINARY_PRODUCT_ENCODING_RAW = 0
+const BINARY_PRODUCT_ENCODING_RLE = 1
+const RLE_RUN = 0
+const RLE_LITERAL = 1
+
+const isBinaryProduct = (input: Uint8Array): boolean =>
+  input.length >= BINARY_PRODUCT_HEADER_LENGTH &&
+    String.fromCharCode(input[0], input[1], input[2], input[3]) == BINARY_PRODUCT_MAGIC
+
+const decodeRunLengths = (view: DataView, offset: number, length: number): Uint8Array => {
+  const data = new Uint8Array(length)
+  const input = new Uint8Array(view.buffer, view.byteOffset, view.byteLength)
+  let position = 0
+  while (offset < view.byteLength) {
+    const type = view.getUint8(offset)
+    const count = view.getUint32(offset + 1, true)
+    if (position + count > length) {
+      throw new Error('Run-length encoded payload longer than the product')
+    }
+    if (type == RLE_RUN) {
+      data.fill(view.getUint8(offset + 5), position, position + count)
+      offset += 6
+    } else if (type == RLE_LITERAL) {
+      data.set(input.subarray(offset + 5, offset + 5 + count), position)
+      offset += 5 + count
+    } else {
+      throw new Error(`Unknown run-length encoded payload item ${type}`)
+    }
+    position += count
+  }
+  if (position != length) {
+    throw new Error(`Truncated run-length encoded payload of ${position} pixels`)
+  }
+  return data
+}
+
+export function parseBinaryProduct(input: Uint8Array): LoadedProduct {
+  const view = new DataView(input.buffer, input.byteOffset, input.byteLength)
+  const encoding = view.getUint16(6, true)
+  const width = view.getUint32(8, true)
+  const height = view.getUint32(12, true)
+  const metadataLength = view.getUint32(64, true)
+
+  const metadataStart = BINARY_PRODUCT_HEADER_LENGTH
+  const payloadStart = metadataStart + metadataLength
+  const metadata = JSON.parse(
+    new TextDecoder().decode(input.subarray(metadataStart, payloadStart))
+  ) as LoadedProduct['metadata']
+
+  let data: Uint8Array
+  if (encoding == BINARY_PRODUCT_ENCODING_RAW) {
+    if (input.length - payloadStart < width * height) {
+      throw new Error(`Truncated binary product payload of ${input.length - payloadStart} bytes`)
+    }
+    data = input.subarray(payloadStart, payloadStart + width * height)
+  } else if (encoding == BINARY_PRODUCT_ENCODING_RLE) {
+    data = decodeRunLengths(view, payloadStart, width * height)
+  } else {
+    throw new Error(`Unknown binary product payload encoding ${encoding}`)
+  }
+
+  return {
+    data,
+    _cols: width,
+    _rows: height,
+    metadata
+  }
+}
+
+// See fmi/dist_builder/sequence_to_binary.py for the format, the header is
+// the same as with binary products except for the number of frames
+const SEQUENCE_MAGIC = 'PPIS'
+const SEQUENCE_FRAME_KEY = 0
+const SEQUENCE_FRAME_DELTA = 1
+
+// Returns the frames of an animation sequence by their product URLs, as
+// given in the sequence metadata
+export function parseProductSequence(input: Uint8Array): { url: string, product: LoadedProduct }[] {
+  const view = new DataView(input.buffer, input.byteOffset, input.byteLength)
+  if (String.fromCharCode(input[0], input[1], input[2], input[3]) != SEQUENCE_MAGIC) {
+    throw new Error('Not an animation sequence')
+  }
+  const frameCount = view.getUint16(6, true)
+  const width = view.getUint32(8, true)
+  const height = view.getUint32(12, true)
+  const metadataLength = view.getUint32(64, true)
+
+  let offset = BINARY_PRODUCT_HEADER_LENGTH + metadataLength
+  const { urls, ...metadata } = JSON.parse(
+    new TextDecoder().decode(input.subarray(BINARY_PRODUCT_HEADER_LENGTH, offset))
+  ) as LoadedProduct['metadata'] & { urls: string[] }
+
+  const result: { url: string, product: LoadedProduct }[] = []
+  let previous: Uint8Array | null = null
+  for (let frame = 0; frame < frameCount; frame++) {
+    const frameType = view.getUint8(offset)
+    const payloadLength = view.getUint32(offset + 1, true)
+    const payloadStart = offset + 5
+    offset = payloadStart + payloadLength
+    if (offset > input.length) {
+      throw new Error(`Truncated animation sequence frame ${frame}`)
+    }
+
+    let data: Uint8Array
+    if (frameType == SEQUENCE_FRAME_KEY) {
+      data = input.subarray(payloadStart, payloadStart + width * height)
+    } else if (frameType == SEQUENCE_FRAME_DELTA && previous !== null) {
+      data = previous.slice()
+      let position = 0
+      for (let run = payloadStart; run < offset;) {
+        position += view.getUint32(run, true)
+        const runLength = view.getUint32(run + 4, true)
+        data.set(input.subarray(run + 8, run + 8 + runLength), position)
+        position += runLength
+        run += 8 + runLength
+      }
+    } else {
+      throw new Error(`Unexpected animation sequence frame type ${frameType}`)
+    }
+
+    result.push({ url: urls[frame], product: { data, _cols: width, _rows: height, metadata } })
+    previous = data
+  }
+  return result
+}
+
 async function parseProduct(input: Uint8Array): Promise<LoadedProduct> {
   let inflated = null
   try {
-    inflated = inflate(input)
+    const inflatedBytes = inflate(input)
+    if (isBinaryProduct(inflatedBytes)) {
+      return parseBinaryProduct(inflatedBytes)
+    }
+
+    inflated = new TextDecoder().decode(inflatedBytes)
     const { data: twoDimensionalArray, metadata } = JSON.parse(inflated) as {
       data: number[][]
       metadata: LoadedProduct['metadata']
@@ -51,7 +185,7 @@ async function parseProduct(input: Uint8Array): Promise<LoadedProduct> {
       metadata
     }
   } catch (e) {
-    if (e instanceof SyntaxError) {
+    if (e instanceof SyntaxError && inflated !== null) {
       console.error(
         'Error parsing: ' + e + ' with input ' +
           inflated.substring(0, 20) +
@@ -67,6 +201,66 @@ async function parseProduct(input: Uint8Array): Promise<LoadedProduct> {
 
 type ProductUrlResolver = (flavor: Flavor, time: number) => string
 
+// Sequences which couldn't be loaded, their products are loaded one by one
+const failedSequenceUrls = new Set<string>()
+
+// Loads the products of the flavor's animation sequence in one go, if it has
+// one and they aren't loaded yet. Returns the product URLs in the sequence.
+const loadSequence = (
+  onProductLoadUpdate: (payload: { loaded: string[], unloaded: string[] }) => void,
+  productUrlResolver: ProductUrlResolver,
+  loadedProducts: { [key: string]: LoadedProduct },
+  loadingProducts: { [key: string]: Date },
+  flavor: Flavor
+): Set<string> => {
+  const sequence = flavor.sequence
+  if (!sequence || sequence.times.length == 0) return new Set()
+
+  // Sequence URLs are relative to the same location as the product URLs
+  const latest = flavor.times.find((t) => t.time == sequence.times[sequence.times.length - 1])
+  if (!latest) return new Set()
+  const latestUrl = productUrlResolver(flavor, Date.parse(latest.time))
+  const sequenceUrl = latestUrl.substring(0, latestUrl.length - latest.url.length) + sequence.url
+  if (failedSequenceUrls.has(sequenceUrl)) return new Set()
+
+  const urlsByRelativeUrl: { [url: string]: string } = {}
+  for (const time of sequence.times) {
+    const entry = flavor.times.find((t) => t.time == time)
+    if (entry) urlsByRelativeUrl[entry.url] = productUrlResolver(flavor, Date.parse(time))
+  }
+  const sequenceUrls = new Set(Object.keys(urlsByRelativeUrl).map((url) => urlsByRelativeUrl[url]))
+
+  const allLoaded = Array.from(sequenceUrls).every((url) => url in loadedProducts)
+  if (allLoaded || sequenceUrl in loadingProducts) return sequenceUrls
+
+  loadingProducts[sequenceUrl] = new Date()
+  fetch(sequenceUrl)
+    .then((response) => {
+      if (!response.ok) throw new Error(`Status ${response.status}`)
+      return response.bytes()
+    })
+    .then((bytes) => parseProductSequence(inflate(bytes)))
+    .then((frames) => {
+      const loaded = []
+      for (const { url, product } of frames) {
+        const resolvedUrl = urlsByRelativeUrl[url]
+        if (resolvedUrl !== undefined && !(resolvedUrl in loadedProducts)) {
+          loadedProducts[resolvedUrl] = product
+          loaded.push(resolvedUrl)
+        }
+      }
+      onProductLoadUpdate({ loaded, unloaded: [] })
+    })
+    .catch((e) => {
+      console.error(`Failed to load animation sequence from url ${sequenceUrl}`, e)
+      failedSequenceUrls.add(sequenceUrl)
+    })
+    .finally(() => {
+      delete loadingProducts[sequenceUrl]
+    })
+  return sequenceUrls
+}
+
 const loadOneProduct = (
   onProductLoadUpdate: (payload: { loaded: string[], unloaded: string[] }) => void,
   productUrlResolver: ProductUrlResolver,
@@ -86,10 +280,14 @@ const loadOneProduct = (
     }
   }
 
+  const sequenceUrls = loadSequence(
+    onProductLoadUpdate, productUrlResolver, loadedProducts, loadingProducts, flavor
+  )
+
   let urlToLoad = null
   // Then start loading actual products
   for (const url of intendedUrls) {
-    if ((url in loadedProducts) || (url in loadingProducts)) {
+    if ((url in loadedProducts) || (url in loadingProducts) || sequenceUrls.has(url)) {
       continue
     }
 
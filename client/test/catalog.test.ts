@@ -0,0 +1,48 @@
+import { applyCatalogDelta, type Catalog, type RadarProducts } from '../src/catalog'
+
+const site = (times: string[]): RadarProducts => ({
+  fivan: {
+    display: 'Vantaa',
+    lat: 60.3,
+    lon: 24.9,
+    products: {
+      'PPI dbZh': {
+        display: 'PPI dbZh',
+        flavors: {
+          'EL 0.3': { display: 'EL 0.3', times: times.map((time) => ({ time, url: `${time}.json.gz` })) }
+        }
+      }
+    }
+  }
+})
+
+describe('Should apply catalog deltas', () => {
+  const catalog: Catalog = {
+    generation: 1,
+    radarProducts: site(['2026-01-24T00:00:00+00:00', '2026-01-24T00:05:00+00:00'])
+  }
+
+  test('when times are added and removed', () => {
+    const updated = applyCatalogDelta(catalog, {
+      fromGeneration: 1,
+      generation: 2,
+      added: site(['2026-01-24T00:10:00+00:00']),
+      removed: site(['2026-01-24T00:00:00+00:00'])
+    })
+    expect(updated).toEqual({
+      generation: 2,
+      radarProducts: site(['2026-01-24T00:05:00+00:00', '2026-01-24T00:10:00+00:00'])
+    })
+    expect(catalog.radarProducts.fivan.products['PPI dbZh'].flavors['EL 0.3'].times.length).toEqual(2)
+  })
+
+  test('when all times of a site are removed', () => {
+    const updated = applyCatalogDelta(catalog, {
+      fromGeneration: 1,
+      generation: 2,
+      added: {},
+      removed: site(['2026-01-24T00:00:00+00:00', '2026-01-24T00:05:00+00:00'])
+    })
+    expect(updated.radarProducts).toEqual({})
+  })
+})
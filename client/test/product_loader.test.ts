@@ -0,0 +1,70 @@
+import { parseBinaryProduct, parseProductSequence } from '../src/product_loader'
+
+const encodeBinaryProduct = (
+  width: number, height: number, metadata: object, payload: number[], magic = 'PPIB', encodingOrFrameCount = 0
+) => {
+  const metadataBytes = new TextEncoder().encode(JSON.stringify(metadata))
+  const buffer = new ArrayBuffer(68 + metadataBytes.length + payload.length)
+  const view = new DataView(buffer)
+  const bytes = new Uint8Array(buffer)
+  bytes.set(new TextEncoder().encode(magic), 0)
+  view.setUint16(4, 1, true)
+  view.setUint16(6, encodingOrFrameCount, true)
+  view.setUint32(8, width, true)
+  view.setUint32(12, height, true)
+  const transform = [20.0, 0.01, 0, 62.0, 0, -0.01]
+  transform.forEach((value, i) => view.setFloat64(16 + i * 8, value, true))
+  view.setUint32(64, metadataBytes.length, true)
+  bytes.set(metadataBytes, 68)
+  bytes.set(payload, 68 + metadataBytes.length)
+  return bytes
+}
+
+describe('Should parse binary products', () => {
+  test('in happy case', () => {
+    const metadata = { width: 2, height: 3, productInfo: { dataType: 'REFLECTIVITY' } }
+    const input = encodeBinaryProduct(2, 3, metadata, [1, 2, 3, 4, 5, 6])
+    const product = parseBinaryProduct(input)
+    expect(product._cols).toEqual(2)
+    expect(product._rows).toEqual(3)
+    expect(product.metadata).toEqual(metadata)
+    expect(product.data[1 * product._rows + 2]).toEqual(6)
+    expect(product.data.buffer).toBe(input.buffer)
+  })
+
+  test('with run-length encoded payload', () => {
+    const input = encodeBinaryProduct(2, 3, {}, [
+      0, 3, 0, 0, 0, 255,
+      1, 2, 0, 0, 0, 7, 8,
+      0, 1, 0, 0, 0, 0
+    ], 'PPIB', 1)
+    const product = parseBinaryProduct(input)
+    expect(Array.from(product.data)).toEqual([255, 255, 255, 7, 8, 0])
+  })
+
+  test('with truncated payload', () => {
+    const input = encodeBinaryProduct(2, 3, {}, [1, 2, 3])
+    expect(() => parseBinaryProduct(input)).toThrow()
+  })
+})
+
+describe('Should parse animation sequences', () => {
+  test('with key and delta frames', () => {
+    const metadata = { width: 2, height: 3, urls: ['a.json.gz', 'b.json.gz', 'c.json.gz'] }
+    const input = encodeBinaryProduct(2, 3, metadata, [
+      0, 6, 0, 0, 0, 1, 2, 3, 4, 5, 6,
+      // Pixels 1 and 4 changed
+      1, 18, 0, 0, 0, 1, 0, 0, 0, 1, 0, 0, 0, 9, 2, 0, 0, 0, 1, 0, 0, 0, 8,
+      // Nothing changed
+      1, 0, 0, 0, 0
+    ], 'PPIS', 3)
+
+    const frames = parseProductSequence(input)
+
+    expect(frames.map((f) => f.url)).toEqual(metadata.urls)
+    expect(Array.from(frames[0].product.data)).toEqual([1, 2, 3, 4, 5, 6])
+    expect(Array.from(frames[1].product.data)).toEqual([1, 9, 3, 4, 8, 6])
+    expect(Array.from(frames[2].product.data)).toEqual([1, 9, 3, 4, 8, 6])
+    expect(frames[2].product._rows).toEqual(3)
+  })
+})
@@ -8,15 +8,82 @@ from __future__ import print_function
 
 import argparse
 import codecs
+import collections
+import concurrent.futures
 import copy
 import datetime
+import fnmatch
+import gzip
+import hashlib
 import json
+import multiprocessing
 import operator
 import os
+import queue
+import re
+import shlex
+import shutil
+import signal
 import subprocess
 import sys
+import threading
+import time
 import traceback
 
+from metrics import Metrics
+
+
+_COPY_BUFFER_SIZE = 1024 * 1024
+
+CATALOG_FILENAME = 'catalog.json'
+GENERATION_FILENAME = 'catalog-generation.json'
+DELTAS_DIRNAME = 'catalog-deltas'
+DEFAULT_KEEP_DELTAS = 60
+
+# Sharded catalog, see write_catalog_shards
+CATALOG_INDEX_FILENAME = 'catalog-index.json'
+SHARDS_DIRNAME = 'catalog-shards'
+DEFAULT_PRODUCT_SHARD_TIMES = 1000
+
+# Published snapshots of the distribution, see publish_generation and publish.py
+GENERATIONS_DIRNAME = 'generations'
+CURRENT_LINK = 'current'
+DEFAULT_KEEP_GENERATIONS = 3
+
+# Seconds between logging the pipeline statistics, see PipelineStats
+DEFAULT_STATS_INTERVAL = 10
+
+# Unreferenced exports aren't removed if the new catalog has fewer than this
+# share of the times of the previous one, see check_catalog_size
+DEFAULT_MIN_CATALOG_RATIO = 0.5
+
+# Records what has been exported from where, see export_product
+MANIFEST_FILENAME = 'export_manifest.json'
+
+# Product formats the exporters produce and the file extensions used for them
+PRODUCT_FORMATS = {
+    'json': '.json',
+    'binary': '.bin',
+    'cog': '.tif'
+}
+
+# Formats distributed as they are instead of gzipped, so that clients can
+# read parts of them with range requests
+UNCOMPRESSED_FORMATS = set(['cog'])
+
+# Creation options of Cloud-Optimized GeoTIFFs, see export_cog. Nearest
+# neighbour overviews as the data values are quantized.
+COG_CREATION_OPTIONS = ['COMPRESS=DEFLATE', 'BLOCKSIZE=256', 'OVERVIEWS=AUTO',
+                        'RESAMPLING=NEAREST']
+
+# Suffix of the tile directories produced by the tiler, see tile_product
+TILES_SUFFIX = '.tiles'
+TILE_URL_TEMPLATE = '{z}/{x}/{y}.png'
+
+# Animation sequences, see export_sequences
+SEQUENCE_SUFFIX = '.seq'
+DEFAULT_SEQUENCE_FRAMES = 12
+
 
 def err(*args, **kwargs):
     if kwargs.get('file', None) is None:
@@ -45,7 +112,8 @@ def camelcapsify_dict(d):
     return result
 
 
-def collect_radar_rasters(input_products):
+def collect_radar_rasters(input_products, product_format='json', retention=None,
+                          max_times=None):
     """Collects radar rasters from the list of all products.
 
     Args:
@@ -53,6 +121,15 @@ def collect_radar_rasters(input_products):
         function works with dicts with type 'RADAR RASTER'. Discards
         everything else.
 
+        product_format is the format the products are exported in, one of
+        PRODUCT_FORMATS.
+
+        retention is an optional predicate deciding whether a product is
+        kept, see max_age_retention.
+
+        max_times is an optional function of the site and product id giving
+        the number of latest times to keep of each flavor, see Retention.
+
     Returns:
         A dict where keys are site ids and values site objects.
 
@@ -69,6 +146,11 @@ def collect_radar_rasters(input_products):
                 {              # each item under flavor is one timestep, a distinct product
                   "time": ..., # timestamp as UTC ISO8601, JS compatible format
                   "url": ...,  # relative URL to the product file
+                  "format": ..., # format of the product file, e.g. "json"
+                  "tiles": ...,  # XYZ tile URL template, only when tiled
+                  "overviews": [ # lower resolution versions, if any
+                    { "decimation": 2, "url": ... }, ...
+                  ],
                   "productInfo": ...
                 },
               }
@@ -97,22 +179,167 @@ def collect_radar_rasters(input_products):
         have the value 100 in the product data array, it would be
         -32 + 100 * 0.5 = 18 dBZ.
     """
-    radar_rasters = [product
-                     for product in input_products
-                     if product['type'] == 'RADAR RASTER']
+    collector = RadarRasterCollector(product_format, retention, max_times=max_times)
+    for product in input_products:
+        collector.add(product)
+    return collector.finish()
 
-    result = {}
-    sources_dests_infos = []
-    for product in radar_rasters:
+
+def parse_time(value):
+    """Parses a product time, which is in UTC unless it says otherwise."""
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed
+
+
+def max_age_retention(hours, now=None):
+    """Returns a retention predicate keeping products at most hours old."""
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    oldest = now - datetime.timedelta(hours=hours)
+
+    def keep(product):
+        return parse_time(product["time"]) >= oldest
+    return keep
+
+
+RetentionRule = collections.namedtuple('RetentionRule',
+                                       ['pattern', 'max_age_hours', 'max_times'])
+
+
+def parse_retention_rule(value):
+    """Parses a retention rule given as '<site>/<product>=<limit>[,<limit>]'.
+
+    The pattern is matched against the site and product id with shell
+    wildcards, e.g. 'fivan/*' or '*/ETOP*'. A limit is either the maximum
+    age of the products in hours, like '24h', or the number of latest times
+    to keep of each flavor, like '100'.
+    """
+    pattern, separator, limits = value.rpartition('=')
+    if not separator or not pattern or not limits:
+        raise ValueError(u"Retention rule '{}' isn't of the form <site>/<product>=<limit>"
+                         .format(value))
+    max_age_hours = None
+    max_times = None
+    for limit in limits.split(','):
+        limit = limit.strip()
+        if limit.endswith('h'):
+            max_age_hours = float(limit[:-1])
+        else:
+            max_times = int(limit)
+            if max_times < 1:
+                raise ValueError(u"At least one time must be kept, not {}".format(max_times))
+    return RetentionRule(pattern, max_age_hours, max_times)
+
+
+class Retention(object):
+    """Decides which products are kept, by age and by count.
+
+    The first of rules (see parse_retention_rule) matching the site and
+    product of a product gives its limits, max_age_hours and max_times are
+    used for products no rule matches.
+    """
+
+    def __init__(self, rules=(), max_age_hours=None, max_times=None, now=None):
+        if now is None:
+            now = datetime.datetime.now(datetime.timezone.utc)
+        self.rules = list(rules)
+        self.max_age_hours = max_age_hours
+        self.default_max_times = max_times
+        self.now = now
+
+    def limits(self, site_id, product_id):
+        """Returns the (max age in hours, max times) of a product, either may be None."""
+        key = u'{}/{}'.format(site_id, product_id)
+        for rule in self.rules:
+            if fnmatch.fnmatchcase(key, rule.pattern):
+                return rule.max_age_hours, rule.max_times
+        return self.max_age_hours, self.default_max_times
+
+    def keep(self, product):
+        """Retention predicate, see max_age_retention."""
+        max_age_hours, _ = self.limits(product["site_id"], product["product_id"])
+        if max_age_hours is None:
+            return True
+        return parse_time(product["time"]) >= self.now - datetime.timedelta(hours=max_age_hours)
+
+    def max_times(self, site_id, product_id):
+        return self.limits(site_id, product_id)[1]
+
+    def oldest_kept_hours(self):
+        """Returns the age in hours beyond which no product is kept.
+
+        None if some products are kept regardless of their age.
+        """
+        ages = [self.max_age_hours] + [rule.max_age_hours for rule in self.rules]
+        if None in ages:
+            return None
+        return max(ages)
+
+
+class RadarRasterCollector(object):
+    """Incrementally collects radar rasters, see collect_radar_rasters.
+
+    Products can be added one by one as they are read, so that exporting a
+    product doesn't need to wait for all of the input to be read. Times are
+    ordered once all products have been added.
+
+    Whether a product is among the max_times latest ones of its flavor is
+    only known once all products have been added, so such products are put
+    aside in deferred instead of being exported right away. finish drops
+    the older times from both the catalog and deferred.
+
+    The names of the exports of the products that retention or max_times
+    dropped are collected into dropped, see remove_unreferenced.
+    """
+
+    def __init__(self, product_format='json', retention=None, tiles=False, overviews=(),
+                 max_times=None):
+        self.product_format = product_format
+        self.extension = PRODUCT_FORMATS[product_format]
+        self.retention = retention
+        self.max_times = max_times
+        self.tiles = tiles
+        self.overviews = overviews
+        self.sites = {}
+        self.sources_dests_infos = []
+        self.deferred = []
+        self.dropped = set()
+
+    def _destination(self, product):
         if product["data_file"].endswith(".tiff.gz"):
-            dest_path = os.path.basename(product["data_file"]).replace(".tiff.gz", ".json")
+            return os.path.basename(product["data_file"]).replace(".tiff.gz", self.extension)
         elif product["data_file"].endswith(".tiff"):
-            dest_path = os.path.basename(product["data_file"]).replace(".tiff", ".json")
-        else:
-            raise Exception("Data file with unknown extension: {}"
-                            .format(product["data_file"]))
-        final_dest_path = dest_path + ".gz"
+            return os.path.basename(product["data_file"]).replace(".tiff", self.extension)
+        raise Exception("Data file with unknown extension: {}".format(product["data_file"]))
 
+    def _outputs(self, dest_path):
+        """Returns the names of all the exports of a product."""
+        result = [output_name(dest_path, self.product_format)]
+        result += [output_name(overview_destination(dest_path, factor), self.product_format)
+                   for factor in self.overviews]
+        if self.tiles:
+            result.append(tiles_directory(dest_path))
+        return result
+
+    def add(self, product):
+        """Adds a product into the catalog.
+
+        Returns the (source, destination, product info) tuple to export the
+        product with, or None if the product isn't a radar raster, isn't
+        retained or is deferred.
+        """
+        if product['type'] != 'RADAR RASTER':
+            return None
+        dest_path = self._destination(product)
+        if self.retention is not None and not self.retention(product):
+            self.dropped.update(self._outputs(dest_path))
+            return None
+
+        final_dest_path = output_name(dest_path, self.product_format)
+
+        result = self.sites
         if product["site_id"] not in result:
             result[product["site_id"]] = {
                 "lon": product["site_location"]["lon"],
@@ -144,29 +371,66 @@ def collect_radar_rasters(input_products):
 
         # "sourceFile": product["data_file"],
         # "destinationFile": dest_path,
-        flavors_dict[flavor_key]["times"].append({
+        time_entry = {
             "productInfo": camelcapsify_dict(product["radar_product_info"]),
             "time": product["time"],
-            "url": final_dest_path
-        })
-        
-        flavors_dict[flavor_key]["times"].sort(key=operator.itemgetter("time"))
-        sources_dests_infos.append((product["data_file"], dest_path, product["radar_product_info"]))
-
-    for site, site_dict in result.items():
-        err(u"Site {} ({})".format(site_dict["display"], site))
-        for product_id, product in site_dict["products"].items():
-            err(u"  Product {} ({})".format(product["display"], product_id))
-            for flavor_id, flavor in product["flavors"].items():
-                if len(flavor["times"]) > 5:
-                    times = [t["time"] for t in [flavor["times"][0], flavor["times"][-1]]]
-                    times.insert(1, "...")
-                else:
-                    times = [t["time"] for t in flavor["times"]]
-                err(u"    Flavor {} ({})".format(flavor["display"], flavor_id))
-                err(u"      {}".format(u", ".join(times)))
+            "url": final_dest_path,
+            "format": self.product_format
+        }
+        if self.tiles:
+            time_entry["tiles"] = tiles_directory(dest_path) + "/" + TILE_URL_TEMPLATE
+        if self.overviews:
+            time_entry["overviews"] = [
+                {"decimation": factor,
+                 "url": output_name(overview_destination(dest_path, factor), self.product_format)}
+                for factor in self.overviews]
+        flavors_dict[flavor_key]["times"].append(time_entry)
+
+        source_dest_info = (product["data_file"], dest_path, product["radar_product_info"])
+        self.sources_dests_infos.append(source_dest_info)
+        if (self.max_times is not None and
+                self.max_times(product["site_id"], product_id) is not None):
+            self.deferred.append(source_dest_info)
+            return None
+        return source_dest_info
+
+    def finish(self):
+        """Returns the collected sites and sources_dests_infos."""
+        dropped_urls = set()
+        for site_id, site_dict in self.sites.items():
+            for product_id, product in site_dict["products"].items():
+                max_times = None
+                if self.max_times is not None:
+                    max_times = self.max_times(site_id, product_id)
+                for flavor in product["flavors"].values():
+                    flavor["times"].sort(key=operator.itemgetter("time"))
+                    if max_times is not None and len(flavor["times"]) > max_times:
+                        dropped_urls.update(t["url"] for t in flavor["times"][:-max_times])
+                        del flavor["times"][:-max_times]
+
+        if dropped_urls:
+            def retained(source_dest_info):
+                return output_name(source_dest_info[1], self.product_format) not in dropped_urls
+            for _, dest_path, _ in self.sources_dests_infos:
+                if output_name(dest_path, self.product_format) in dropped_urls:
+                    self.dropped.update(self._outputs(dest_path))
+            self.sources_dests_infos = [s for s in self.sources_dests_infos if retained(s)]
+            self.deferred = [s for s in self.deferred if retained(s)]
 
-    return result, sources_dests_infos
+        for site, site_dict in self.sites.items():
+            err(u"Site {} ({})".format(site_dict["display"], site))
+            for product_id, product in site_dict["products"].items():
+                err(u"  Product {} ({})".format(product["display"], product_id))
+                for flavor_id, flavor in product["flavors"].items():
+                    if len(flavor["times"]) > 5:
+                        times = [t["time"] for t in [flavor["times"][0], flavor["times"][-1]]]
+                        times.insert(1, "...")
+                    else:
+                        times = [t["time"] for t in flavor["times"]]
+                    err(u"    Flavor {} ({})".format(flavor["display"], flavor_id))
+                    err(u"      {}".format(u", ".join(times)))
+
+        return self.sites, self.sources_dests_infos
 
 
 def iload_json(buff, decoder=None, _w=json.decoder.WHITESPACE.match):
@@ -190,60 +454,1209 @@ def iload_json(buff, decoder=None, _w=json.decoder.WHITESPACE.match):
         raise ValueError('%s (%r at position %d).' % (exc, buff[idx:], idx))
 
 
-def collect(infile, exporter, directory):
-    if not os.path.isdir(directory):
-        parser.error(u"Output directory '{}' must exist".format(directory))
+ExportSettings = collections.namedtuple(
+    'ExportSettings', ['exporter', 'directory', 'timeout', 'compress_level',
+                       'exporter_identity', 'verify', 'tiler', 'tiler_identity',
+                       'decimation', 'product_format'],
+    defaults=(None, False, None, None, None, 'json'))
+
+
+def output_name(dst, product_format='json'):
+    """Returns the name of the file a product exported into dst ends up in."""
+    if product_format in UNCOMPRESSED_FORMATS:
+        return dst
+    return dst + '.gz'
+
+
+def exporter_identity(exporter):
+    """Identifies the exporter executable, changes when it gets upgraded."""
+    path = shutil.which(exporter) or exporter
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return os.path.realpath(path)
+    return u"{}:{}:{}".format(os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def command_identity(command):
+    """Like exporter_identity, but the command may have arguments."""
+    args = shlex.split(command)
+    return u' '.join([exporter_identity(args[0])] + args[1:])
+
+
+def overview_destination(dst, factor):
+    """Returns where the overview decimated by factor of dst is exported."""
+    stem, extension = os.path.splitext(dst)
+    return u"{}.{}x{}".format(stem, factor, extension)
+
+
+def tiles_directory(dst):
+    """Returns the name of the tile directory of a product exported into dst."""
+    return os.path.splitext(dst)[0] + TILES_SUFFIX
+
+
+def load_manifest(path):
+    """Loads the export manifest, a dict of records by output file name."""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError as e:
+        err(u"Ignoring unreadable export manifest {}: {}".format(path, e))
+        return {}
+
+
+def save_manifest(path, manifest):
+    write_json(path, manifest, indent=1, sort_keys=True)
 
-    lines = []
+
+def write_json(path, obj, **kwargs):
+    """Writes obj as JSON into path, replacing any previous file atomically."""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(obj, f, **kwargs)
+        _fsync(f)
+    os.replace(temp_path, path)
+
+
+def _fsync(f):
+    """Makes sure what has been written into f is on disk before renaming it."""
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _fsync_directory(path):
+    """Makes sure the renames done in the directory are on disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_COPY_BUFFER_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class _HashingWriter(object):
+    """File object wrapper computing the SHA-256 of what's written through it.
+
+    run_compressed also keeps the size of the output before compression and
+    the seconds spent compressing it here.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.uncompressed_size = 0
+        self.compress_seconds = 0.0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+    def flush(self):
+        return self.f.flush()
+
+
+def is_exported(record, src, settings):
+    """Tells whether the manifest record is for the current source and exporter.
+
+    The output file must also still exist and be of the size in the record.
+    With settings.verify, it is also checked against the checksum in the
+    record.
+    """
+    if record is None:
+        return False
+    output_path = os.path.join(settings.directory, record['output'])
+    try:
+        stat = os.stat(src)
+        output_stat = os.stat(output_path)
+    except OSError:
+        return False
+    if (record.get('source') != src or
+            record.get('sourceSize') != stat.st_size or
+            record.get('sourceMtimeNs') != stat.st_mtime_ns or
+            record.get('exporter') != settings.exporter_identity or
+            record.get('outputSize') != output_stat.st_size):
+        return False
+    if settings.verify:
+        try:
+            return _sha256_file(output_path) == record.get('outputSha256')
+        except OSError:
+            return False
+    return True
+
+
+def read_products(infile):
+    """Generates products from newline delimited JSON as lines come in.
+
+    Lines may contain more than one JSON value, blank lines are skipped.
+    """
     for line in infile:
-        lines.append(line)
-    input_data = "".join(lines)
-    input_products = list(iload_json(input_data))
+        if line.strip():
+            for value in iload_json(line):
+                yield value
 
-    sites, sources_dests_infos = collect_radar_rasters(input_products)
 
-    with open(os.path.join(directory, "catalog.json"), "w") as f:
-        catalog = {
-            'radarProducts': copy.deepcopy(sites)
-        }
-        json.dump(catalog, f)
+def export_product(src, dst, product_info, settings, record=None, metrics=None):
+    """Runs one product through the exporter, compressing its output.
+
+    The exporter's standard output is gzipped as it streams in and written
+    under a temporary name, which is renamed to '<dst>.gz' only once the
+    exporter has succeeded.
+
+    With settings.decimation, the exporter is asked to produce an overview
+    decimated by that factor with '--decimate <factor>'.
+
+    record is the product's previous export manifest record, if any. If it
+    shows the product has already been exported from the same source with
+    the same exporter, the export is skipped.
+
+    The time spent exporting and compressing is added to the 'export' and
+    'compress' stages of metrics, if given.
+
+    Returns a (status, record) tuple where status is 'skipped' or
+    'exported' and record is the manifest record for the output. Raises on
+    failure, including the exporter exiting with a non-zero status or not
+    finishing in settings.timeout seconds.
+    """
+    output_path = output_name(dst, settings.product_format)
+    final_path = os.path.join(settings.directory, output_path)
+
+    if is_exported(record, src, settings):
+        err('Not dumping {}, already exported from {}'.format(final_path, src))
+        return 'skipped', record
+    source_stat = os.stat(src)
+
+    started = time.monotonic()
+    if settings.product_format == 'cog':
+        record = export_cog(src, output_path, settings, source_stat)
+        if metrics is not None:
+            metrics.add('export', time.monotonic() - started, bytes_in=source_stat.st_size,
+                        bytes_out=record['outputSize'])
+        return 'exported', record
+
+    additional_metadata = {"productInfo": camelcapsify_dict(product_info)}
+    # TODO: document how an exporter should work
+    args = [settings.exporter, src]
+    if settings.decimation is not None:
+        args[1:1] = ['--decimate', str(settings.decimation)]
+    err(u"Running command {}".format(u' '.join(args)))
+    err(u"Writing compressed product to '{}'...".format(final_path))
+    output = run_compressed(args, json.dumps(additional_metadata).encode('utf-8'),
+                            final_path, settings, 'Exporter')
+
+    seconds = time.monotonic() - started
+    err(u"Exported in {} s".format(seconds))
+    if metrics is not None:
+        metrics.add('export', seconds - output.compress_seconds, bytes_in=source_stat.st_size,
+                    bytes_out=output.uncompressed_size)
+        metrics.add('compress', output.compress_seconds, bytes_in=output.uncompressed_size,
+                    bytes_out=output.size)
+    return 'exported', {
+        'output': output_path,
+        'source': src,
+        'sourceSize': source_stat.st_size,
+        'sourceMtimeNs': source_stat.st_mtime_ns,
+        'exporter': settings.exporter_identity,
+        'outputSize': output.size,
+        'outputSha256': output.digest.hexdigest()
+    }
+
+
+def export_cog(src, output, settings, source_stat):
+    """Writes the source as a Cloud-Optimized GeoTIFF instead of exporting it.
+
+    settings.exporter is the gdal_translate to use. The GeoTIFF is written
+    under a temporary name and renamed to output once finished, like
+    export_product does. Returns the manifest record of the output.
+    """
+    final_path = os.path.join(settings.directory, output)
+    temp_path = final_path + '.tmp'
+    source = '/vsigzip/' + src if src.endswith('.gz') else src
+
+    args = [settings.exporter, '-q', '-of', 'COG']
+    for option in COG_CREATION_OPTIONS:
+        args.extend(['-co', option])
+    args.extend([source, temp_path])
+    err(u"Running command {}".format(u' '.join(args)))
+    try:
+        run_command(args, b'', settings, 'gdal_translate')
+        with open(temp_path, 'rb+') as f:
+            _fsync(f)
+        os.replace(temp_path, final_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+    return {
+        'output': output,
+        'source': src,
+        'sourceSize': source_stat.st_size,
+        'sourceMtimeNs': source_stat.st_mtime_ns,
+        'exporter': settings.exporter_identity,
+        'outputSize': os.path.getsize(final_path),
+        'outputSha256': _sha256_file(final_path)
+    }
+
+
+def run_command(args, stdin_data, settings, what):
+    """Runs a command killing it if it doesn't finish in settings.timeout seconds.
+
+    Raises if the command fails or times out, what names the command in the
+    error.
+    """
+    # In its own process group so that a timeout kills its children as well
+    process = subprocess.Popen(args, stdin=subprocess.PIPE, start_new_session=True)
+    try:
+        process.communicate(stdin_data, timeout=settings.timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+        raise Exception(u"{} timed out after {} s".format(what, settings.timeout))
+    if process.returncode != 0:
+        raise Exception(u"{} exited with status {}".format(what, process.returncode))
+
+
+def run_compressed(args, stdin_data, final_path, settings, what):
+    """Runs a command writing its gzipped standard output into final_path.
+
+    The output is written under a temporary name which is renamed to
+    final_path only once the command has succeeded. Returns the
+    _HashingWriter the compressed output went through, for its size and
+    checksum. Raises if the command fails or doesn't finish in
+    settings.timeout seconds, what names the command in the error.
+    """
+    temp_path = final_path + '.tmp'
+    timed_out = threading.Event()
+    process = None
+    try:
+        # In its own process group so that a timeout kills any children
+        # holding the output pipe open as well
+        process = subprocess.Popen(args,
+                                   stdout=subprocess.PIPE, stdin=subprocess.PIPE,
+                                   start_new_session=True)
+        timer = None
+        if settings.timeout is not None:
+            def kill():
+                timed_out.set()
+                os.killpg(process.pid, signal.SIGKILL)
+            timer = threading.Timer(settings.timeout, kill)
+            timer.start()
+        try:
+            process.stdin.write(stdin_data)
+            process.stdin.close()
+            with open(temp_path, 'wb') as raw:
+                output = _HashingWriter(raw)
+                with gzip.GzipFile(fileobj=output, mode='wb',
+                                   compresslevel=settings.compress_level) as f:
+                    for chunk in iter(lambda: process.stdout.read(_COPY_BUFFER_SIZE), b''):
+                        started = time.monotonic()
+                        f.write(chunk)
+                        output.compress_seconds += time.monotonic() - started
+                        output.uncompressed_size += len(chunk)
+                _fsync(raw)
+            returncode = process.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+        if timed_out.is_set():
+            raise Exception(u"{} timed out after {} s".format(what, settings.timeout))
+        if returncode != 0:
+            raise Exception(u"{} exited with status {}".format(what, returncode))
+        os.replace(temp_path, final_path)
+    except BaseException:
+        if process is not None and process.poll() is None:
+            process.kill()
+            process.wait()
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    return output
+
+
+def tile_product(src, dst, product_info, settings, status, record, metrics=None):
+    """Runs the tiler on a product exported by export_product.
+
+    The tiler command, settings.tiler, is run as '<tiler> <src> <directory>'
+    with the same metadata in its standard input as the exporters get, and
+    it is expected to write the tiles into the directory (see
+    fmi/dist_builder/raster_to_tiles.py). The tiles are written into a
+    temporary directory which replaces the product's tile directory, see
+    tiles_directory, once the tiler has succeeded.
+
+    status and record are what export_product returned. If the export was
+    skipped and the record shows the tiles have been rendered with the same
+    tiler, tiling is skipped as well. Tiling is timed into the 'tile' stage
+    of metrics, if given.
+
+    Returns the record updated with the tiles. Raises on failure like
+    export_product.
+    """
+    tiles = tiles_directory(dst)
+    final_path = os.path.join(settings.directory, tiles)
+    if (status == 'skipped' and record.get('tiles') == tiles and
+            record.get('tiler') == settings.tiler_identity and os.path.isdir(final_path)):
+        return record
+
+    temp_path = final_path + '.tmp'
+    if os.path.exists(temp_path):
+        shutil.rmtree(temp_path)
+    os.makedirs(temp_path)
+
+    args = shlex.split(settings.tiler) + [src, temp_path]
+    err(u"Running command {}".format(u' '.join(args)))
+    additional_metadata = {"productInfo": camelcapsify_dict(product_info)}
+    started = time.monotonic()
+    try:
+        run_command(args, json.dumps(additional_metadata).encode('utf-8'), settings, 'Tiler')
+
+        old_path = final_path + '.old'
+        if os.path.exists(final_path):
+            os.rename(final_path, old_path)
+        os.rename(temp_path, final_path)
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            shutil.rmtree(temp_path)
+        raise
+
+    if metrics is not None:
+        metrics.add('tile', time.monotonic() - started, bytes_in=os.path.getsize(src))
+    return dict(record, tiles=tiles, tiler=settings.tiler_identity)
+
+
+def _export_job(src, dst, product_info, settings, record):
+    """Wraps export_product and tile_product for running in a worker process.
+
+    Returns a (status, record, stages) tuple where status is 'exported',
+    'skipped' or 'failed' so that failures can be aggregated by the parent
+    process, and stages are the Metrics stages of the job for the parent to
+    merge.
+    """
+    metrics = Metrics(None)
+    try:
+        status, record = export_product(src, dst, product_info, settings, record, metrics)
+        if settings.tiler is not None:
+            record = tile_product(src, dst, product_info, settings, status, record, metrics)
+        return status, record, metrics.stages
+    except KeyboardInterrupt:
+        raise
+    except Exception as e:
+        err(u"Couldn't export {}: {}".format(src, e))
+        err(traceback.format_exc())
+        return 'failed', None, metrics.stages
+
+
+def export_products(sources_dests_infos, settings, jobs=1, manifest=None, stats=None,
+                    metrics=None):
+    """Exports products, optionally in parallel over a pool of processes.
+
+    At most 2 * jobs exports are in flight at any time, so memory use stays
+    bounded no matter how many products there are.
+
+    manifest is the export manifest (see load_manifest), a dict which gets
+    updated with the records of exported products.
+
+    stats is an optional PipelineStats to count the exports in, and metrics
+    an optional Metrics to time them in.
 
-    skipped_count = 0
-    # TODO: parallelize, this should be embarrassingly easy
-    for src, dst, product_info in sources_dests_infos:
+    Returns a dict of counts by status ('exported', 'skipped', 'failed').
+    """
+    counts = collections.Counter({'exported': 0, 'skipped': 0, 'failed': 0})
+    if manifest is None:
+        manifest = {}
+    if stats is None:
+        stats = PipelineStats()
+
+    def done(output, result):
+        status, record, stages = result
+        counts[status] += 1
+        stats.add(status)
+        if metrics is not None:
+            metrics.merge(stages)
+        if record is not None:
+            manifest[output] = record
+
+    if jobs <= 1:
+        for src, dst, product_info in sources_dests_infos:
+            output = output_name(dst, settings.product_format)
+            stats.add('submitted')
+            done(output, _export_job(src, dst, product_info, settings, manifest.get(output)))
+        return counts
+
+    max_in_flight = 2 * jobs
+    # Not forked, as collect has the read and stats threads running by the
+    # time the pool starts and they may be holding locks, e.g. the one of
+    # stderr
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, mp_context=multiprocessing.get_context('forkserver')) as executor:
+        in_flight = {}
+        for src, dst, product_info in sources_dests_infos:
+            if len(in_flight) >= max_in_flight:
+                finished, _ = concurrent.futures.wait(
+                    in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    done(in_flight.pop(future), future.result())
+            output = output_name(dst, settings.product_format)
+            future = executor.submit(_export_job, src, dst, product_info, settings,
+                                     manifest.get(output))
+            stats.add('submitted')
+            in_flight[future] = output
+
+        for future in concurrent.futures.as_completed(in_flight):
+            done(in_flight[future], future.result())
+
+    return counts
+
+
+class PipelineStats(object):
+    """Counts what goes through the stages of the collect pipeline.
+
+    The stages are reading products from the input, exporting them and
+    writing the catalog, see collect. The reading stage runs in a thread of
+    its own and hands the products to export over a bounded queue, so that
+    neither has to wait for the other unless the queue is full or empty.
+    The queue depth tells which one is the bottleneck: a full queue means
+    exporting can't keep up, an empty one that reading can't.
+    """
+
+    def __init__(self, product_queue=None):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.counts = collections.Counter()
+        self.product_queue = product_queue
+
+    def add(self, name, count=1):
+        with self.lock:
+            self.counts[name] += count
+
+    def summary(self):
+        """Returns the counts, rates per second, queue depth and exports in flight."""
+        elapsed = time.monotonic() - self.started
+        with self.lock:
+            counts = dict(self.counts)
+        finished = sum(counts.get(status, 0) for status in ('exported', 'skipped', 'failed'))
+        result = {'elapsedSeconds': round(elapsed, 3)}
+        for name in ('read', 'queued', 'exported', 'skipped', 'failed'):
+            result[name] = counts.get(name, 0)
+            result[name + 'PerSecond'] = round(counts.get(name, 0) / elapsed, 3) if elapsed else 0
+        result['exportsInFlight'] = counts.get('submitted', 0) - finished
+        if self.product_queue is not None:
+            result['queueDepth'] = self.product_queue.qsize()
+            result['queueSize'] = self.product_queue.maxsize
+        return result
+
+    def log(self):
+        err(u"Pipeline: {}".format(json.dumps(self.summary(), sort_keys=True)))
+
+
+# Marks the end of the products in the product queue
+_END_OF_PRODUCTS = None
+
+
+def _put_unless_stopped(product_queue, item, stop):
+    """Puts item into product_queue, blocking while it's full unless stop is set.
+
+    Returns whether item was put.
+    """
+    while not stop.is_set():
         try:
-            dest_path = os.path.join(directory, dst)
+            product_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _read_stage(infile, collector, product_queue, stats, stop, errors, metrics):
+    """Reads products into the collector and queues the ones to export."""
+    try:
+        for product in read_products(infile):
+            stats.add('read')
+            started = time.monotonic()
+            source_dest_info = collector.add(product)
+            metrics.add('read', time.monotonic() - started)
+            if source_dest_info is None:
+                continue
+            if not _put_unless_stopped(product_queue, source_dest_info, stop):
+                return
+            stats.add('queued')
+    except BaseException as e:
+        errors.append(e)
+    finally:
+        # Nobody takes the end marker if exporting has stopped on an error
+        _put_unless_stopped(product_queue, _END_OF_PRODUCTS, stop)
+
+
+def _queued_products(product_queue):
+    while True:
+        source_dest_info = product_queue.get()
+        if source_dest_info is _END_OF_PRODUCTS:
+            return
+        yield source_dest_info
+
+
+def _log_stats_periodically(stats, interval, stop):
+    while not stop.wait(interval):
+        stats.log()
+
+
+def sequence_output(site_id, product_id, flavor_id):
+    """Returns the name of the animation sequence file of a flavor."""
+    return u'_'.join(_shard_name(i) for i in (site_id, product_id, flavor_id)) + \
+        SEQUENCE_SUFFIX + '.gz'
+
+
+def export_sequence(output, frames, settings, sequencer, identity, record=None, metrics=None):
+    """Runs the latest frames of a flavor through the sequencer.
+
+    frames is a list of (source, time entry) tuples in time order. The
+    sequencer command is run as '<sequencer> <source>...' with the metadata
+    of the latest frame along with the "times" and "urls" of the frames in
+    its standard input, and its output is compressed into output like
+    export_product does (see fmi/dist_builder/sequence_to_binary.py).
+
+    record is the output's previous export manifest record, if any. If it
+    shows the sequence has been produced from the same sources with the same
+    sequencer, it isn't produced again. Producing the sequence is timed into
+    the 'sequence' and 'compress' stages of metrics, if given.
+
+    Returns a (status, record) tuple like export_product.
+    """
+    final_path = os.path.join(settings.directory, output)
+    sources = []
+    for src, _ in frames:
+        stat = os.stat(src)
+        sources.append([src, stat.st_size, stat.st_mtime_ns])
+
+    if (record is not None and record.get('sources') == sources and
+            record.get('sequencer') == identity and os.path.exists(final_path)):
+        return 'skipped', record
+
+    additional_metadata = {
+        "productInfo": frames[-1][1]["productInfo"],
+        "times": [entry["time"] for _, entry in frames],
+        "urls": [entry["url"] for _, entry in frames]
+    }
+    args = shlex.split(sequencer) + [src for src, _ in frames]
+    err(u"Writing animation sequence '{}'...".format(final_path))
+    started = time.monotonic()
+    result = run_compressed(args, json.dumps(additional_metadata).encode('utf-8'),
+                            final_path, settings, 'Sequencer')
+    if metrics is not None:
+        metrics.add('sequence', time.monotonic() - started - result.compress_seconds,
+                    bytes_in=sum(size for _, size, _ in sources),
+                    bytes_out=result.uncompressed_size)
+        metrics.add('compress', result.compress_seconds, bytes_in=result.uncompressed_size,
+                    bytes_out=result.size)
+    return 'exported', {
+        'output': output,
+        'sources': sources,
+        'sequencer': identity,
+        'outputSize': result.size,
+        'outputSha256': result.digest.hexdigest()
+    }
+
+
+def _export_sequence_job(output, frames, settings, sequencer, identity, record, metrics):
+    try:
+        return export_sequence(output, frames, settings, sequencer, identity, record, metrics)
+    except Exception as e:
+        err(u"Couldn't export sequence {}: {}".format(output, e))
+        err(traceback.format_exc())
+        return 'failed', None
+
+
+def export_sequences(sites, sources_dests_infos, settings, sequencer,
+                     frames=DEFAULT_SEQUENCE_FRAMES, jobs=1, manifest=None, metrics=None):
+    """Exports the latest frames of every flavor as an animation sequence.
+
+    The flavors of sites successfully sequenced get a "sequence" telling
+    where the sequence is and which times are in it:
+      { "url": ..., "times": [...], "format": "sequence" }
+
+    Returns a dict of counts by status like export_products.
+    """
+    counts = collections.Counter({'exported': 0, 'skipped': 0, 'failed': 0})
+    if manifest is None:
+        manifest = {}
+    identity = command_identity(sequencer)
+    sources_by_url = dict((output_name(dst, settings.product_format), src)
+                          for src, dst, _ in sources_dests_infos)
+
+    # The work is done by the sequencer processes, threads suffice here
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = {}
+        for site_id, site in sites.items():
+            for product_id, product in site["products"].items():
+                for flavor_id, flavor in product["flavors"].items():
+                    latest = [(sources_by_url[entry["url"]], entry)
+                              for entry in flavor["times"][-frames:]]
+                    if not latest:
+                        continue
+                    output = sequence_output(site_id, product_id, flavor_id)
+                    future = executor.submit(_export_sequence_job, output, latest, settings,
+                                             sequencer, identity, manifest.get(output), metrics)
+                    futures[future] = (output, flavor, latest)
+
+        for future in concurrent.futures.as_completed(futures):
+            output, flavor, latest = futures[future]
+            status, record = future.result()
+            counts[status] += 1
+            if record is None:
+                continue
+            manifest[output] = record
+            flavor["sequence"] = {
+                "url": output,
+                "times": [entry["time"] for _, entry in latest],
+                "format": "sequence"
+            }
+    return counts
+
+
+def _catalog_entries(sites):
+    """Flattens sites into a dict of time entries by (site, product, flavor, url)."""
+    result = {}
+    for site_id, site in sites.items():
+        for product_id, product in site["products"].items():
+            for flavor_id, flavor in product["flavors"].items():
+                for entry in flavor["times"]:
+                    result[(site_id, product_id, flavor_id, entry["url"])] = entry
+    return result
+
+
+def _partial_sites(sites, keys, entries):
+    """Builds sites with only the times of the given keys in them."""
+    result = {}
+    for key in sorted(keys):
+        site_id, product_id, flavor_id, _ = key
+        site = sites[site_id]
+        product = site["products"][product_id]
+        flavor = product["flavors"][flavor_id]
+
+        partial_site = result.setdefault(site_id, dict(site, products={}))
+        partial_product = partial_site["products"].setdefault(
+            product_id, dict(product, flavors={}))
+        partial_flavor = partial_product["flavors"].setdefault(
+            flavor_id, dict(flavor, times=[]))
+        partial_flavor["times"].append(entries[key])
+    return result
+
+
+def catalog_delta(previous_sites, sites):
+    """Returns the (added, removed) times between two generations of sites.
+
+    Both are in the same shape as sites, containing only the sites, products
+    and flavors that had times added or removed.
+    """
+    previous_entries = _catalog_entries(previous_sites)
+    entries = _catalog_entries(sites)
+    added = set(entries) - set(previous_entries)
+    removed = set(previous_entries) - set(entries)
+    return (_partial_sites(sites, added, entries),
+            _partial_sites(previous_sites, removed, previous_entries))
+
+
+def read_catalog(directory):
+    """Returns the catalog in directory, or None if there is no readable one."""
+    catalog_path = os.path.join(directory, CATALOG_FILENAME)
+    if not os.path.exists(catalog_path):
+        return None
+    try:
+        with open(catalog_path) as f:
+            return json.load(f)
+    except ValueError as e:
+        err(u"Ignoring unreadable previous catalog: {}".format(e))
+        return None
+
+
+def write_catalog(directory, sites, keep_deltas=DEFAULT_KEEP_DELTAS):
+    """Writes catalog.json and a delta against the previous catalog.
+
+    Every catalog that differs from the previous one gets the next
+    generation number. What changed is written into
+    'catalog-deltas/<generation>.json', so that clients already having the
+    previous generation can fetch just the changes:
+      {
+        "fromGeneration": ..., "generation": ...,
+        "added": {...},       # times added, in the shape of radarProducts
+        "removed": {...}      # times removed, likewise
+      }
+
+    The latest generation and the oldest delta still kept are written into
+    catalog-generation.json last, for clients to poll.
+
+    Everything is written under temporary names and renamed into place once
+    on disk, and the products are synced before the catalog referring to
+    them, so that clients never see a catalog whose products don't exist.
+
+    Returns the generation of the catalog.
+    """
+    catalog_path = os.path.join(directory, CATALOG_FILENAME)
+    deltas_directory = os.path.join(directory, DELTAS_DIRNAME)
+    _fsync_directory(directory)
+
+    previous = read_catalog(directory)
+    if previous is None:
+        generation = 1
+    else:
+        previous_generation = previous.get('generation', 0)
+        added, removed = catalog_delta(previous['radarProducts'], sites)
+        if added or removed:
+            generation = previous_generation + 1
+            if not os.path.isdir(deltas_directory):
+                os.makedirs(deltas_directory)
+            write_json(os.path.join(deltas_directory, '{}.json'.format(generation)), {
+                'fromGeneration': previous_generation,
+                'generation': generation,
+                'added': added,
+                'removed': removed
+            })
+            _fsync_directory(deltas_directory)
+        else:
+            generation = previous_generation
+
+    write_json(catalog_path, {
+        'generation': generation,
+        'radarProducts': copy.deepcopy(sites)
+    })
 
-            if os.path.exists(dest_path + '.gz') and os.path.getsize(dest_path + '.gz') > 0:
-                err('Not dumping {}, already exists and is not an empty file!'.format(dest_path))
-                skipped_count += 1
+    oldest_delta = generation + 1
+    if os.path.isdir(deltas_directory):
+        for name in os.listdir(deltas_directory):
+            stem, extension = os.path.splitext(name)
+            if extension != '.json' or not stem.isdigit():
                 continue
+            if int(stem) <= generation - keep_deltas or int(stem) > generation:
+                os.unlink(os.path.join(deltas_directory, name))
+            else:
+                oldest_delta = min(oldest_delta, int(stem))
+
+    write_json(os.path.join(directory, GENERATION_FILENAME), {
+        'generation': generation,
+        'oldestDelta': oldest_delta
+    })
+    _fsync_directory(directory)
+    return generation
+
+
+def _published_generations(generations_directory):
+    """Returns the (generation, name) of the published generations, oldest first."""
+    result = []
+    for name in os.listdir(generations_directory):
+        parts = name.split('-')
+        if len(parts) == 2 and parts[0].isdigit() and parts[1].isdigit():
+            result.append(((int(parts[0]), int(parts[1])), name))
+    return [name for _, name in sorted(result)]
+
+
+def publish_generation(directory, publish_directory, generation,
+                       keep_generations=DEFAULT_KEEP_GENERATIONS):
+    """Publishes a snapshot of the distribution and switches to it atomically.
+
+    The files of directory are hard linked into
+    'generations/<generation>-<ns>' under publish_directory, after which
+    the 'current' symbolic link in publish_directory is replaced with one
+    pointing to the new snapshot. The web server should serve 'current',
+    which changes from one complete distribution to the next in a single
+    rename, so no separate passes of copying products first and the
+    catalog last are needed.
+
+    publish_directory must be on the same filesystem as directory; rather
+    than copying the whole distribution on every run, an exception is
+    raised if the files can't be linked.
+
+    The keep_generations latest snapshots are kept so that a bad
+    distribution can be rolled back by pointing 'current' to an earlier
+    one.
+
+    This isn't done by collect but by publish.py, run as a step of its own
+    once everything producing the distribution has succeeded, so that a
+    build whose input ended early never replaces the published one.
+
+    Returns the path of the snapshot.
+    """
+    generations_directory = os.path.join(publish_directory, GENERATIONS_DIRNAME)
+    if not os.path.isdir(generations_directory):
+        os.makedirs(generations_directory)
+
+    name = u'{}-{}'.format(generation, time.time_ns())
+    snapshot = os.path.join(generations_directory, name)
+    temp_snapshot = snapshot + '.tmp'
+    try:
+        for root, _, filenames in os.walk(directory):
+            target_root = os.path.normpath(os.path.join(temp_snapshot, os.path.relpath(root, directory)))
+            os.makedirs(target_root)
+            for filename in filenames:
+                if filename.endswith('.tmp') or filename == MANIFEST_FILENAME:
+                    continue
+                os.link(os.path.join(root, filename), os.path.join(target_root, filename))
+    except OSError as e:
+        shutil.rmtree(temp_snapshot, ignore_errors=True)
+        raise Exception(u"Can't hard link {} into publish directory {}, is it on the same filesystem? ({})"
+                        .format(directory, publish_directory, e))
+    os.rename(temp_snapshot, snapshot)
+    _fsync_directory(generations_directory)
+
+    link = os.path.join(publish_directory, CURRENT_LINK)
+    temp_link = link + '.tmp'
+    if os.path.lexists(temp_link):
+        os.unlink(temp_link)
+    os.symlink(os.path.join(GENERATIONS_DIRNAME, name), temp_link)
+    os.replace(temp_link, link)
+    _fsync_directory(publish_directory)
+
+    for old in _published_generations(generations_directory)[:-max(keep_generations, 1)]:
+        shutil.rmtree(os.path.join(generations_directory, old))
+    return snapshot
+
+
+def drop_unexported(sites, directory, manifest):
+    """Drops what hasn't been exported from the catalog of sites.
+
+    Time entries whose output has no export manifest record or isn't in
+    directory, e.g. because exporting it failed, are removed, as are their
+    overviews and tiles that don't exist. Flavors, products and sites left
+    without times are removed as well, so that the catalog only refers to
+    files clients can fetch.
+
+    Returns the number of time entries dropped.
+    """
+    def exported(name):
+        return name in manifest and os.path.exists(os.path.join(directory, name))
+
+    dropped = 0
+    for site_id in list(sites.keys()):
+        products = sites[site_id]["products"]
+        for product_id in list(products.keys()):
+            flavors = products[product_id]["flavors"]
+            for flavor_id in list(flavors.keys()):
+                times = flavors[flavor_id]["times"]
+                kept = [entry for entry in times if exported(entry["url"])]
+                dropped += len(times) - len(kept)
+                for entry in kept:
+                    if "overviews" in entry:
+                        entry["overviews"] = [o for o in entry["overviews"] if exported(o["url"])]
+                    if ("tiles" in entry and not os.path.isdir(
+                            os.path.join(directory, entry["tiles"].split('/')[0]))):
+                        del entry["tiles"]
+                times[:] = kept
+                if not kept:
+                    del flavors[flavor_id]
+            if not flavors:
+                del products[product_id]
+        if not products:
+            del sites[site_id]
+    return dropped
+
+
+def referenced_outputs(sites):
+    """Returns the names of the files and tile directories the catalog refers to."""
+    result = set()
+    for site in sites.values():
+        for product in site["products"].values():
+            for flavor in product["flavors"].values():
+                if "sequence" in flavor:
+                    result.add(flavor["sequence"]["url"])
+                for entry in flavor["times"]:
+                    result.add(entry["url"])
+                    if "tiles" in entry:
+                        result.add(entry["tiles"].split('/')[0])
+                    for overview in entry.get("overviews", ()):
+                        result.add(overview["url"])
+    return result
+
+
+def _is_output(name):
+    """Tells whether name is of a product, overview, sequence or tiles export."""
+    suffixes = [output_name(extension, product_format)
+                for product_format, extension in PRODUCT_FORMATS.items()]
+    suffixes += [SEQUENCE_SUFFIX + '.gz', TILES_SUFFIX]
+    return name.endswith(tuple(suffixes))
+
+
+def check_catalog_size(previous_sites, sites, min_ratio=DEFAULT_MIN_CATALOG_RATIO):
+    """Raises an exception if sites looks like it was built from incomplete input.
+
+    That is, if sites has no times at all or fewer than min_ratio times the
+    times of previous_sites, e.g. because the input ended early. Removing
+    the exports such a catalog doesn't refer to would wipe out the
+    distribution.
+    """
+    count = len(_catalog_entries(sites))
+    previous_count = len(_catalog_entries(previous_sites or {}))
+    if count == 0 or count < min_ratio * previous_count:
+        raise Exception(u"Catalog shrank from {} to {} times, not removing unreferenced exports"
+                        .format(previous_count, count))
+
+
+def remove_unreferenced(directory, sites, manifest=None, dropped=(), max_age_hours=None,
+                        now=None):
+    """Removes the exports in directory that are no longer needed.
+
+    An export is removed if the catalog of sites doesn't refer to it and
+    either its name is in dropped, the exports retention dropped (see
+    RadarRasterCollector), or it was last modified more than max_age_hours
+    ago. Exports that are merely missing from the catalog are kept, as the
+    input may have ended early.
+
+    Only what collect exports is considered, so the catalog files and
+    anything else living in the output directory are left alone. The
+    records of the removed exports are dropped from manifest.
+
+    Returns the number of files and directories removed.
+    """
+    if now is None:
+        now = time.time()
+    referenced = referenced_outputs(sites)
+    removed = 0
+    for name in os.listdir(directory):
+        if name in referenced or not _is_output(name):
+            continue
+        path = os.path.join(directory, name)
+        if name not in dropped and (max_age_hours is None or
+                                    os.lstat(path).st_mtime >= now - max_age_hours * 3600):
+            continue
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+        if manifest is not None:
+            manifest.pop(name, None)
+        removed += 1
+    return removed
+
+
+def _shard_name(identifier):
+    """Makes a site or product id usable as a file name and in URLs as-is."""
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', identifier)
+
+
+def write_catalog_shards(directory, sites, generation,
+                         product_shard_times=DEFAULT_PRODUCT_SHARD_TIMES):
+    """Writes the catalog split into a site index and per-site shards.
+
+    catalog-index.json lists the sites without their products:
+      {
+        "generation": ...,
+        "sites": {
+          "fivan": { "lon": ..., "lat": ..., "display": ...,
+                     "url": "catalog-shards/fivan.json" },
+          ...
+        }
+      }
+
+    Each site shard is the site object of catalog.json along with the
+    generation. Products with more than product_shard_times times in total
+    are left out of the site shard and written into a shard of their own,
+    the site shard then only has their display name and URL:
+      { "display": ..., "url": "catalog-shards/fivan/PPI_dbZh.json" }
+
+    All URLs are relative to the output directory like the product URLs.
+    Shards of sites and products no longer in the catalog are removed and
+    the index is written last, so that it never refers to missing shards.
+    """
+    shards_directory = os.path.join(directory, SHARDS_DIRNAME)
+    if not os.path.isdir(shards_directory):
+        os.makedirs(shards_directory)
+
+    written = set()
+
+    def write_shard(relative_path, obj):
+        path = os.path.join(shards_directory, relative_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        write_json(path, obj)
+        written.add(os.path.normpath(relative_path))
+        return u'/'.join([SHARDS_DIRNAME, relative_path.replace(os.sep, '/')])
+
+    index_sites = {}
+    for site_id, site in sites.items():
+        products = {}
+        for product_id, product in site["products"].items():
+            time_count = sum(len(f["times"]) for f in product["flavors"].values())
+            if time_count > product_shard_times:
+                products[product_id] = {
+                    "display": product["display"],
+                    "url": write_shard(
+                        os.path.join(_shard_name(site_id), _shard_name(product_id) + '.json'),
+                        dict(product, generation=generation))
+                }
+            else:
+                products[product_id] = product
+
+        site_shard = dict(site, products=products, generation=generation)
+        index_site = dict((k, v) for k, v in site.items() if k != "products")
+        index_site["url"] = write_shard(_shard_name(site_id) + '.json', site_shard)
+        index_sites[site_id] = index_site
+
+    for root, dirnames, filenames in os.walk(shards_directory, topdown=False):
+        for name in filenames:
+            path = os.path.join(root, name)
+            if os.path.relpath(path, shards_directory) not in written:
+                os.unlink(path)
+        if root != shards_directory and not os.listdir(root):
+            os.rmdir(root)
+
+    write_json(os.path.join(directory, CATALOG_INDEX_FILENAME), {
+        'generation': generation,
+        'sites': index_sites
+    })
+
+
+def collect(infile, settings, *, jobs=1, product_format='json', retention=None,
+            manifest_path=None, keep_deltas=DEFAULT_KEEP_DELTAS, product_shard_times=None,
+            overviews=(), sequencer=None, sequence_frames=DEFAULT_SEQUENCE_FRAMES,
+            queue_size=None, stats_interval=DEFAULT_STATS_INTERVAL, max_times=None,
+            remove_unreferenced_outputs=False, remove_older_than_hours=None,
+            min_catalog_ratio=DEFAULT_MIN_CATALOG_RATIO, metrics_path=None,
+            prometheus_path=None):
+    """Builds the catalog and exports all products into settings.directory.
+
+    The export manifest is kept in manifest_path, by default
+    MANIFEST_FILENAME in the output directory.
+
+    If product_shard_times is given, the catalog is also written sharded by
+    site, see write_catalog_shards.
+
+    overviews are the decimation factors to export overviews of each
+    product with. They are exported once all full resolution products have
+    been exported.
+
+    With a sequencer, the latest sequence_frames times of every flavor are
+    also exported as an animation sequence, see export_sequences.
+
+    Products are read in a thread of their own and queued for export in a
+    queue of queue_size products, by default 2 * jobs. Pipeline statistics
+    (see PipelineStats) are logged every stats_interval seconds, if set,
+    and once everything is done.
+
+    retention and max_times limit the products kept in the catalog, see
+    RadarRasterCollector. With remove_unreferenced_outputs, exports the new
+    catalog no longer refers to are removed once it has been written, if
+    retention dropped them or they are older than remove_older_than_hours
+    (see remove_unreferenced). An exception is raised instead if the new
+    catalog has fewer than min_catalog_ratio of the times of the previous
+    one, see check_catalog_size.
+
+    The timings of the stages (see Metrics) are appended into metrics_path
+    as a line of JSON and written into prometheus_path in the Prometheus
+    text format, if given.
+
+    Returns the number of products that failed to export.
+    """
+    directory = settings.directory
+    if not os.path.isdir(directory):
+        raise Exception(u"Output directory '{}' must exist".format(directory))
+
+    settings = settings._replace(product_format=product_format)
+    if settings.exporter_identity is None:
+        settings = settings._replace(exporter_identity=exporter_identity(settings.exporter))
+    if settings.tiler is not None and settings.tiler_identity is None:
+        settings = settings._replace(tiler_identity=command_identity(settings.tiler))
+    if manifest_path is None:
+        manifest_path = os.path.join(directory, MANIFEST_FILENAME)
+    manifest = load_manifest(manifest_path)
+
+    collector = RadarRasterCollector(product_format, retention, tiles=settings.tiler is not None,
+                                     overviews=overviews, max_times=max_times)
+
+    if queue_size is None:
+        queue_size = 2 * max(jobs, 1)
+    product_queue = queue.Queue(maxsize=queue_size)
+    stats = PipelineStats(product_queue)
+    metrics = Metrics('collect')
+    stop = threading.Event()
+    read_errors = []
+    reader = threading.Thread(target=_read_stage, name='read',
+                              args=(infile, collector, product_queue, stats, stop, read_errors,
+                                    metrics))
+    reader.daemon = True
+    reader.start()
+    if stats_interval:
+        monitor = threading.Thread(target=_log_stats_periodically, name='stats',
+                                   args=(stats, stats_interval, stop))
+        monitor.daemon = True
+        monitor.start()
+
+    # Products get exported as soon as they are read
+    try:
+        counts = export_products(_queued_products(product_queue), settings, jobs, manifest,
+                                 stats, metrics)
+        reader.join()
+        if read_errors:
+            raise read_errors[0]
+
+        started = time.monotonic()
+        sites, sources_dests_infos = collector.finish()
+        catalog_seconds = time.monotonic() - started
+        if collector.deferred:
+            counts.update(export_products(collector.deferred, settings, jobs, manifest, stats,
+                                          metrics))
+        for factor in overviews:
+            overview_settings = settings._replace(decimation=factor, tiler=None)
+            counts.update(export_products(
+                [(src, overview_destination(dst, factor), product_info)
+                 for src, dst, product_info in sources_dests_infos],
+                overview_settings, jobs, manifest, metrics=metrics))
+
+        dropped = drop_unexported(sites, directory, manifest)
+        if dropped:
+            err('Left {} products that have not been exported out of the catalog'.format(dropped))
+        if sequencer is not None:
+            counts.update(export_sequences(sites, sources_dests_infos, settings, sequencer,
+                                           sequence_frames, jobs, manifest, metrics))
+    finally:
+        stop.set()
+        save_manifest(manifest_path, manifest)
+
+    started = time.monotonic()
+    previous_catalog = read_catalog(directory)
+    generation = write_catalog(directory, sites, keep_deltas)
+    err('Wrote catalog generation {}'.format(generation))
+    if product_shard_times is not None:
+        write_catalog_shards(directory, sites, generation, product_shard_times)
+    metrics.add('catalog', catalog_seconds + time.monotonic() - started,
+                bytes_out=os.path.getsize(os.path.join(directory, CATALOG_FILENAME)))
+    if remove_unreferenced_outputs:
+        check_catalog_size(previous_catalog and previous_catalog['radarProducts'], sites,
+                           min_catalog_ratio)
+        started = time.monotonic()
+        removed = remove_unreferenced(directory, sites, manifest, collector.dropped,
+                                      remove_older_than_hours)
+        save_manifest(manifest_path, manifest)
+        metrics.add('gc', time.monotonic() - started, count=removed)
+        err('Removed {} unreferenced exports'.format(removed))
+
+    err('Exported {} products, skipped {}, failed {}'.format(
+        counts['exported'], counts['skipped'], counts['failed']))
+    stats.log()
 
-            # err(dest_path)
-            # err(camelcapsify_dict(product_info))
-            additional_metadata = {"productInfo": camelcapsify_dict(product_info)}
-            # TODO: document how an exporter should work
-            started = datetime.datetime.now()
-            err(u"Running command {}".format(u' '.join([exporter, src])))
-
-            with open(dest_path, "w") as f:
-                err(u"Writing product as JSON to '{}'...".format(dest_path))
-                process = subprocess.Popen([exporter, src],
-                                           stdout=f, stdin=subprocess.PIPE)
-                process.stdin.write(json.dumps(additional_metadata).encode('utf-8'))
-                process.stdin.close()
-                process.wait()
-            # TODO: needs a sanity check that the command actually returned with non-error status, and that the file is readable
-            err(u"Written. Compressing...")
-            subprocess.check_call(["gzip", "-v", dest_path])
-            err(u"Exported in {} s".format((datetime.datetime.now() - started).total_seconds()))
-        except KeyboardInterrupt as kbi:
-            raise kbi
-        except Exception as e:
-            err(u"Couldn't export {}: {}".format(src, e))
-            err(traceback.format_exc())
-
-    err('Exported {} products, skipped {}'.format(len(sources_dests_infos), skipped_count))
+    for status in ('exported', 'skipped', 'failed'):
+        metrics.gauge('products', counts[status], status=status)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for site_id, site in sites.items():
+        latest = max(parse_time(flavor["times"][-1]["time"])
+                     for product in site["products"].values()
+                     for flavor in product["flavors"].values() if flavor["times"])
+        metrics.gauge('latest_product_age_seconds', round((now - latest).total_seconds(), 3),
+                      site=site_id)
+    if metrics_path is not None:
+        metrics.write_json_line(metrics_path)
+    if prometheus_path is not None:
+        metrics.write_prometheus(prometheus_path)
+    return counts['failed']
 
 
 if __name__ == '__main__':
@@ -254,8 +1667,85 @@ if __name__ == '__main__':
                         default=sys.stdin,
                         help="JSON input such as produced by collect_radar_products.py")
     parser.add_argument('exporter',
-                        help='exporter command to run the product files through, see raster_to_json.py for an example')
+                        help='exporter command to run the product files through, see raster_to_json.py and raster_to_binary.py for examples; gdal_translate with --format cog')
     parser.add_argument("directory",
                         help="output directory to produce distribution in")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of products to export in parallel")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="seconds to allow a single export to run before killing it")
+    parser.add_argument("--compress-level", type=int, default=6, choices=range(1, 10),
+                        metavar="{1..9}",
+                        help="gzip compression level of the exported products")
+    parser.add_argument("--format", dest="product_format", default='json',
+                        choices=sorted(PRODUCT_FORMATS.keys()),
+                        help="format the exporter produces, written into the catalog; cog writes Cloud-Optimized GeoTIFFs with gdal_translate instead of running an exporter")
+    parser.add_argument("--max-age-hours", type=float, default=None,
+                        help="leave products older than this out of the distribution")
+    parser.add_argument("--max-times", type=int, default=None,
+                        help="keep only this many latest times of each flavor")
+    parser.add_argument("--retain", dest="retention_rules", metavar="RULE",
+                        type=parse_retention_rule, action="append", default=[],
+                        help="retention of matching products instead of --max-age-hours and --max-times, e.g. 'fivan/*=24h' or '*/ETOP*=12h,50'; the first matching rule applies, can be given many times")
+    parser.add_argument("--remove-unreferenced", action="store_true", default=False,
+                        help="remove exports retention dropped from the catalog, or older than --max-age-hours and no longer in it, from the output directory")
+    parser.add_argument("--min-catalog-ratio", type=float, default=DEFAULT_MIN_CATALOG_RATIO,
+                        help="with --remove-unreferenced, fail instead of removing anything if the catalog has fewer than this share of the times of the previous one")
+    parser.add_argument("--manifest", metavar="FILE", default=None,
+                        help="export manifest to use, by default {} in the output directory"
+                        .format(MANIFEST_FILENAME))
+    parser.add_argument("--verify", action="store_true", default=False,
+                        help="check exported files against the manifest checksums, re-export if they differ")
+    parser.add_argument("--keep-deltas", type=int, default=DEFAULT_KEEP_DELTAS,
+                        help="number of catalog generations to keep deltas for")
+    parser.add_argument("--tiler", metavar="COMMAND", default=None,
+                        help="also render each product into XYZ tiles with this command, see raster_to_tiles.py")
+    parser.add_argument("--overview", dest="overviews", metavar="FACTOR", type=int,
+                        action="append", default=[],
+                        help="also export overviews decimated by FACTOR, can be given many times; the exporter must support --decimate")
+    parser.add_argument("--sequencer", metavar="COMMAND", default=None,
+                        help="also export the latest times of each flavor as an animation sequence with this command, see sequence_to_binary.py")
+    parser.add_argument("--sequence-frames", type=int, default=DEFAULT_SEQUENCE_FRAMES,
+                        help="number of latest times to put into animation sequences")
+    parser.add_argument("--queue-size", type=int, default=None,
+                        help="number of products read ahead of exporting, by default twice --jobs")
+    parser.add_argument("--stats-interval", type=float, default=DEFAULT_STATS_INTERVAL,
+                        help="seconds between logging pipeline statistics, 0 to only log them at the end")
+    parser.add_argument("--metrics", dest="metrics_path", metavar="FILE", default=None,
+                        help="append the timings of the stages of the run into FILE as a line of JSON")
+    parser.add_argument("--prometheus", dest="prometheus_path", metavar="FILE", default=None,
+                        help="write the timings of the stages of the run into FILE in the Prometheus text format")
+    parser.add_argument("--shards", action="store_true", default=False,
+                        help="also write the catalog as a site index and per-site shards")
+    parser.add_argument("--product-shard-times", type=int, default=DEFAULT_PRODUCT_SHARD_TIMES,
+                        help="with --shards, give products with more times than this a shard of their own")
     args = parser.parse_args()
-    collect(args.infile, args.exporter, args.directory)
+    if not os.path.isdir(args.directory):
+        parser.error(u"Output directory '{}' must exist".format(args.directory))
+    if args.product_format == 'cog' and args.overviews:
+        parser.error(u"Cloud-Optimized GeoTIFFs have overviews of their own, don't use --overview with them")
+    if args.max_times is not None and args.max_times < 1:
+        parser.error(u"--max-times must be at least 1")
+    retention = Retention(args.retention_rules, args.max_age_hours, args.max_times)
+    settings = ExportSettings(exporter=args.exporter, directory=args.directory,
+                              timeout=args.timeout, compress_level=args.compress_level,
+                              verify=args.verify, tiler=args.tiler)
+    failed = collect(args.infile, settings,
+                     jobs=args.jobs,
+                     product_format=args.product_format,
+                     retention=retention.keep,
+                     max_times=retention.max_times,
+                     manifest_path=args.manifest,
+                     keep_deltas=args.keep_deltas,
+                     product_shard_times=args.product_shard_times if args.shards else None,
+                     overviews=args.overviews,
+                     sequencer=args.sequencer,
+                     sequence_frames=args.sequence_frames,
+                     queue_size=args.queue_size,
+                     stats_interval=args.stats_interval,
+                     remove_unreferenced_outputs=args.remove_unreferenced,
+                     remove_older_than_hours=retention.oldest_kept_hours(),
+                     min_catalog_ratio=args.min_catalog_ratio,
+                     metrics_path=args.metrics_path,
+                     prometheus_path=args.prometheus_path)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,613 @@
+import datetime
+import errno
+import gzip
+import hashlib
+import io
+import json
+import os
+import queue
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+from collect import (ExportSettings, PipelineStats, RadarRasterCollector, Retention,
+                     _export_job, _read_stage, catalog_delta, collect, collect_radar_rasters,
+                     export_product, export_sequences, max_age_retention, parse_retention_rule,
+                     publish_generation, read_products, write_catalog, write_catalog_shards)
+from metrics import Metrics
+
+
+_EXPORTER = """#!{python}
+import json
+import sys
+import time
+
+metadata = json.load(sys.stdin)
+if 'fail' in sys.argv[-1]:
+    sys.exit(3)
+if 'slow' in sys.argv[-1]:
+    time.sleep(10)
+json.dump({{'data': [[1, 2], [3, 4]], 'metadata': metadata, 'options': sys.argv[1:-1]}},
+          sys.stdout)
+"""
+
+_TILER = """#!{python}
+import json
+import os
+import sys
+
+metadata = json.load(sys.stdin)
+os.makedirs(os.path.join(sys.argv[-1], '5', '17'))
+with open(os.path.join(sys.argv[-1], '5', '17', '8.png'), 'w') as f:
+    json.dump(metadata, f)
+"""
+
+_SEQUENCER = """#!{python}
+import json
+import sys
+
+json.dump({{'metadata': json.load(sys.stdin), 'frames': sys.argv[1:]}}, sys.stdout)
+"""
+
+_GDAL_TRANSLATE = """#!{python}
+import shutil
+import sys
+
+assert sys.argv[1:4] == ['-q', '-of', 'COG']
+shutil.copyfile(sys.argv[-2], sys.argv[-1])
+"""
+
+
+def _write_script(path, script):
+    with open(path, 'w') as f:
+        f.write(script.format(python=sys.executable))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+
+def _product(site_id, time, flavor='EL 0.3'):
+    return {
+        'type': 'RADAR RASTER',
+        'data_file': '/data/{}_{}.tiff.gz'.format(time.replace(':', ''), site_id),
+        'site_id': site_id,
+        'site_name': site_id.title(),
+        'site_location': {'lon': 24.9, 'lat': 60.3},
+        'product_id': 'PPI dbZh',
+        'product_name': 'PPI dbZh',
+        'product_flavor': flavor,
+        'time': time,
+        'radar_product_info': {'data_type': 'REFLECTIVITY', 'data_scale': {'no_echo': 0}}
+    }
+
+
+class TestCollectRadarRasters(unittest.TestCase):
+    def test_times_are_ordered(self):
+        products = [_product('fivan', '2026-01-24T00:10:00+00:00'),
+                    {'type': 'SOMETHING ELSE'},
+                    _product('fivan', '2026-01-24T00:00:00+00:00'),
+                    _product('fivan', '2026-01-24T00:05:00+00:00')]
+
+        sites, sources_dests_infos = collect_radar_rasters(products)
+
+        times = sites['fivan']['products']['PPI dbZh']['flavors']['EL 0.3']['times']
+        self.assertEqual([t['time'] for t in times], ['2026-01-24T00:00:00+00:00',
+                                                      '2026-01-24T00:05:00+00:00',
+                                                      '2026-01-24T00:10:00+00:00'])
+        self.assertEqual(times[0]['url'], '2026-01-24T000000+0000_fivan.json.gz')
+        self.assertEqual(times[0]['productInfo'], {'dataType': 'REFLECTIVITY',
+                                                   'dataScale': {'noEcho': 0}})
+        self.assertEqual(len(sources_dests_infos), 3)
+
+    def test_max_age_retention(self):
+        now = datetime.datetime(2026, 1, 24, 12, 0, tzinfo=datetime.timezone.utc)
+        products = [_product('fivan', '2026-01-24T09:00:00+00:00'),
+                    _product('fivan', '2026-01-24T11:00:00+00:00'),
+                    _product('fikor', '2026-01-24T08:00:00Z')]
+
+        sites, sources_dests_infos = collect_radar_rasters(
+            products, retention=max_age_retention(2, now=now))
+
+        self.assertEqual(list(sites.keys()), ['fivan'])
+        times = sites['fivan']['products']['PPI dbZh']['flavors']['EL 0.3']['times']
+        self.assertEqual([t['time'] for t in times], ['2026-01-24T11:00:00+00:00'])
+        self.assertEqual(len(sources_dests_infos), 1)
+
+    def test_retention_rules(self):
+        now = datetime.datetime(2026, 1, 24, 12, 0, tzinfo=datetime.timezone.utc)
+        retention = Retention([parse_retention_rule('fivan/*=2'),
+                               parse_retention_rule('*/PPI*=1h')], max_times=5, now=now)
+        products = [_product('fivan', '2026-01-24T{:02}:00:00+00:00'.format(hour))
+                    for hour in range(8, 12)]
+        products += [_product('fikor', '2026-01-24T{:02}:00:00+00:00'.format(hour))
+                     for hour in range(8, 12)]
+        collector = RadarRasterCollector(retention=retention.keep, max_times=retention.max_times)
+
+        queued = [collector.add(p) for p in products]
+        sites, sources_dests_infos = collector.finish()
+
+        fivan = sites['fivan']['products']['PPI dbZh']['flavors']['EL 0.3']['times']
+        self.assertEqual([t['time'] for t in fivan], ['2026-01-24T10:00:00+00:00',
+                                                      '2026-01-24T11:00:00+00:00'])
+        fikor = sites['fikor']['products']['PPI dbZh']['flavors']['EL 0.3']['times']
+        self.assertEqual([t['time'] for t in fikor], ['2026-01-24T11:00:00+00:00'])
+        # Only products not limited by count are exported right away
+        self.assertEqual(queued[:4], [None] * 4)
+        self.assertEqual(len([q for q in queued[4:] if q is not None]), 1)
+        self.assertEqual([dst for _, dst, _ in collector.deferred],
+                         [os.path.basename(t['url'])[:-len('.gz')] for t in fivan])
+        self.assertEqual(len(sources_dests_infos), 3)
+        # Both the times dropped by count and the ones dropped by age
+        self.assertEqual(collector.dropped, set(
+            '2026-01-24T{:02}0000+0000_{}.json.gz'.format(hour, site)
+            for site, hours in [('fivan', (8, 9)), ('fikor', (8, 9, 10))] for hour in hours))
+
+    def test_oldest_kept_hours(self):
+        self.assertIsNone(Retention().oldest_kept_hours())
+        self.assertIsNone(Retention([parse_retention_rule('fivan/*=2')],
+                                    max_age_hours=24).oldest_kept_hours())
+        self.assertEqual(Retention([parse_retention_rule('fivan/*=48h,2')],
+                                   max_age_hours=24).oldest_kept_hours(), 48)
+
+
+class TestCatalogDeltas(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _read(self, *path):
+        with open(os.path.join(self.directory, *path)) as f:
+            return json.load(f)
+
+    def test_catalog_delta(self):
+        previous, _ = collect_radar_rasters([_product('fivan', '2026-01-24T00:00:00+00:00'),
+                                             _product('fivan', '2026-01-24T00:05:00+00:00')])
+        current, _ = collect_radar_rasters([_product('fivan', '2026-01-24T00:05:00+00:00'),
+                                            _product('fikor', '2026-01-24T00:10:00+00:00')])
+
+        added, removed = catalog_delta(previous, current)
+
+        self.assertEqual(list(added.keys()), ['fikor'])
+        self.assertEqual(added['fikor']['display'], 'Fikor')
+        added_times = added['fikor']['products']['PPI dbZh']['flavors']['EL 0.3']['times']
+        self.assertEqual([t['time'] for t in added_times], ['2026-01-24T00:10:00+00:00'])
+        removed_times = removed['fivan']['products']['PPI dbZh']['flavors']['EL 0.3']['times']
+        self.assertEqual([t['time'] for t in removed_times], ['2026-01-24T00:00:00+00:00'])
+        self.assertEqual(catalog_delta(current, current), ({}, {}))
+
+    def test_generations(self):
+        first, _ = collect_radar_rasters([_product('fivan', '2026-01-24T00:00:00+00:00')])
+        second, _ = collect_radar_rasters([_product('fivan', '2026-01-24T00:00:00+00:00'),
+                                           _product('fivan', '2026-01-24T00:05:00+00:00')])
+        third, _ = collect_radar_rasters([_product('fivan', '2026-01-24T00:10:00+00:00')])
+
+        self.assertEqual(write_catalog(self.directory, first, keep_deltas=1), 1)
+        self.assertEqual(self._read('catalog-generation.json'), {'generation': 1, 'oldestDelta': 2})
+
+        self.assertEqual(write_catalog(self.directory, second, keep_deltas=1), 2)
+        self.assertEqual(write_catalog(self.directory, second, keep_deltas=1), 2)
+        delta = self._read('catalog-deltas', '2.json')
+        self.assertEqual((delta['fromGeneration'], delta['generation'], delta['removed']), (1, 2, {}))
+
+        self.assertEqual(write_catalog(self.directory, third, keep_deltas=1), 3)
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'catalog-deltas')), ['3.json'])
+        self.assertEqual(self._read('catalog-generation.json'), {'generation': 3, 'oldestDelta': 3})
+        self.assertEqual(self._read('catalog.json')['generation'], 3)
+
+    def test_shards(self):
+        sites, _ = collect_radar_rasters([_product('fivan', '2026-01-24T00:00:00+00:00'),
+                                          _product('fivan', '2026-01-24T00:05:00+00:00'),
+                                          _product('fikor', '2026-01-24T00:00:00+00:00')])
+
+        write_catalog_shards(self.directory, sites, 7, product_shard_times=1)
+
+        index = self._read('catalog-index.json')
+        self.assertEqual(index['generation'], 7)
+        self.assertEqual(index['sites']['fikor']['url'], 'catalog-shards/fikor.json')
+        self.assertNotIn('products', index['sites']['fikor'])
+        self.assertEqual(self._read('catalog-shards', 'fikor.json')['products'],
+                         sites['fikor']['products'])
+
+        fivan = self._read('catalog-shards', 'fivan.json')
+        self.assertEqual(fivan['products']['PPI dbZh'],
+                         {'display': 'PPI dbZh', 'url': 'catalog-shards/fivan/PPI_dbZh.json'})
+        product = self._read('catalog-shards', 'fivan', 'PPI_dbZh.json')
+        self.assertEqual(product['flavors'], sites['fivan']['products']['PPI dbZh']['flavors'])
+
+        del sites['fivan']
+        write_catalog_shards(self.directory, sites, 8, product_shard_times=1)
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'catalog-shards')),
+                         ['fikor.json'])
+
+    def test_publish_generation(self):
+        sites, _ = collect_radar_rasters([_product('fivan', '2026-01-24T00:00:00+00:00')])
+        dist = os.path.join(self.directory, 'dist')
+        os.makedirs(dist)
+        write_catalog(dist, sites)
+        with open(os.path.join(dist, 'product.json.tmp'), 'w') as f:
+            f.write('unfinished')
+        publish = os.path.join(self.directory, 'www')
+
+        for generation in range(1, 4):
+            snapshot = publish_generation(dist, publish, generation, keep_generations=2)
+
+        current = os.path.join(publish, 'current')
+        self.assertEqual(os.path.realpath(current), os.path.realpath(snapshot))
+        with open(os.path.join(current, 'catalog.json')) as f:
+            self.assertEqual(json.load(f)['radarProducts'], sites)
+        self.assertTrue(os.path.exists(os.path.join(current, 'catalog-generation.json')))
+        self.assertFalse(os.path.exists(os.path.join(current, 'product.json.tmp')))
+        self.assertEqual(len(os.listdir(os.path.join(publish, 'generations'))), 2)
+
+    def test_publish_generation_fails_if_files_cant_be_linked(self):
+        sites, _ = collect_radar_rasters([_product('fivan', '2026-01-24T00:00:00+00:00')])
+        dist = os.path.join(self.directory, 'dist')
+        os.makedirs(dist)
+        write_catalog(dist, sites)
+        publish = os.path.join(self.directory, 'www')
+
+        def link(source, target):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+        with unittest.mock.patch('os.link', link):
+            with self.assertRaisesRegex(Exception, 'same filesystem'):
+                publish_generation(dist, publish, 1)
+
+        self.assertEqual(os.listdir(os.path.join(publish, 'generations')), [])
+        self.assertFalse(os.path.lexists(os.path.join(publish, 'current')))
+
+
+class _ExporterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.exporter = os.path.join(self.directory, 'exporter.py')
+        _write_script(self.exporter, _EXPORTER)
+        self.source = os.path.join(self.directory, 'a.tiff')
+        with open(self.source, 'wb') as f:
+            f.write(b'TIFF')
+        self.settings = ExportSettings(exporter=self.exporter, directory=self.directory,
+                                       timeout=5, compress_level=1,
+                                       exporter_identity='exporter-1')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write_source(self, name):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(b'TIFF')
+        return path
+
+
+class TestExportProduct(_ExporterTestCase):
+    def test_exports_compressed_output(self):
+        status, record = export_product(self.source, 'a.json', {'data_type': 'REFLECTIVITY'},
+                                        self.settings)
+
+        self.assertEqual(status, 'exported')
+        output_path = os.path.join(self.directory, 'a.json.gz')
+        with gzip.open(output_path, 'rt') as f:
+            exported = json.load(f)
+        self.assertEqual(exported['data'], [[1, 2], [3, 4]])
+        self.assertEqual(exported['metadata'], {'productInfo': {'dataType': 'REFLECTIVITY'}})
+        self.assertFalse(os.path.exists(output_path + '.tmp'))
+
+        self.assertEqual(record['output'], 'a.json.gz')
+        self.assertEqual(record['source'], self.source)
+        self.assertEqual(record['sourceSize'], 4)
+        self.assertEqual(record['exporter'], 'exporter-1')
+        self.assertEqual(record['outputSize'], os.path.getsize(output_path))
+        with open(output_path, 'rb') as f:
+            self.assertEqual(record['outputSha256'], hashlib.sha256(f.read()).hexdigest())
+
+    def test_skips_exported_according_to_manifest(self):
+        _, record = export_product(self.source, 'a.json', {}, self.settings)
+        self.assertEqual(export_product(self.source, 'a.json', {}, self.settings, record),
+                         ('skipped', record))
+
+    def test_reexports_when_source_changes(self):
+        _, record = export_product(self.source, 'a.json', {}, self.settings)
+        with open(self.source, 'ab') as f:
+            f.write(b'MORE')
+        status, _ = export_product(self.source, 'a.json', {}, self.settings, record)
+        self.assertEqual(status, 'exported')
+
+    def test_reexports_when_exporter_changes(self):
+        _, record = export_product(self.source, 'a.json', {}, self.settings)
+        settings = self.settings._replace(exporter_identity='exporter-2')
+        status, _ = export_product(self.source, 'a.json', {}, settings, record)
+        self.assertEqual(status, 'exported')
+
+    def test_reexports_missing_output(self):
+        _, record = export_product(self.source, 'a.json', {}, self.settings)
+        os.unlink(os.path.join(self.directory, 'a.json.gz'))
+        status, _ = export_product(self.source, 'a.json', {}, self.settings, record)
+        self.assertEqual(status, 'exported')
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'a.json.gz')))
+
+    def test_verify_reexports_corrupted_output(self):
+        settings = self.settings._replace(verify=True)
+        _, record = export_product(self.source, 'a.json', {}, settings)
+        self.assertEqual(export_product(self.source, 'a.json', {}, settings, record)[0], 'skipped')
+
+        with open(os.path.join(self.directory, 'a.json.gz'), 'wb') as f:
+            f.write(b'garbage')
+        self.assertEqual(export_product(self.source, 'a.json', {}, settings, record)[0], 'exported')
+
+    def test_failing_exporter_leaves_no_output(self):
+        source = self._write_source('fail.tiff')
+        with self.assertRaises(Exception):
+            export_product(source, 'fail.json', {}, self.settings)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['a.tiff', 'exporter.py', 'fail.tiff'])
+
+    def test_timeout_kills_exporter(self):
+        source = self._write_source('slow.tiff')
+        settings = self.settings._replace(timeout=0.5)
+        with self.assertRaises(Exception) as cm:
+            export_product(source, 'slow.json', {}, settings)
+        self.assertIn('timed out', str(cm.exception))
+        self.assertEqual(sorted(os.listdir(self.directory)), ['a.tiff', 'exporter.py', 'slow.tiff'])
+
+    def test_overview(self):
+        settings = self.settings._replace(decimation=2)
+        status, record = export_product(self.source, 'a.2x.json', {}, settings)
+
+        self.assertEqual(record['output'], 'a.2x.json.gz')
+        with gzip.open(os.path.join(self.directory, 'a.2x.json.gz'), 'rt') as f:
+            self.assertEqual(json.load(f)['options'], ['--decimate', '2'])
+
+    def test_overviews_in_catalog(self):
+        collector = RadarRasterCollector(overviews=[2, 4])
+        collector.add(_product('fivan', '2026-01-24T00:00:00+00:00'))
+        sites, _ = collector.finish()
+        time = sites['fivan']['products']['PPI dbZh']['flavors']['EL 0.3']['times'][0]
+        self.assertEqual(time['overviews'], [
+            {'decimation': 2, 'url': '2026-01-24T000000+0000_fivan.2x.json.gz'},
+            {'decimation': 4, 'url': '2026-01-24T000000+0000_fivan.4x.json.gz'}])
+
+    def test_cog(self):
+        gdal_translate = os.path.join(self.directory, 'gdal_translate.py')
+        _write_script(gdal_translate, _GDAL_TRANSLATE)
+        settings = self.settings._replace(exporter=gdal_translate, product_format='cog')
+
+        status, record = export_product(self.source, 'a.tif', {}, settings)
+
+        self.assertEqual((status, record['output']), ('exported', 'a.tif'))
+        with open(os.path.join(self.directory, 'a.tif'), 'rb') as f:
+            self.assertEqual(f.read(), b'TIFF')
+        self.assertEqual(export_product(self.source, 'a.tif', {}, settings, record)[0], 'skipped')
+
+        collector = RadarRasterCollector(product_format='cog')
+        collector.add(_product('fivan', '2026-01-24T00:00:00+00:00'))
+        sites, _ = collector.finish()
+        time = sites['fivan']['products']['PPI dbZh']['flavors']['EL 0.3']['times'][0]
+        self.assertEqual((time['url'], time['format']), ('2026-01-24T000000+0000_fivan.tif', 'cog'))
+
+    def test_tiles(self):
+        tiler = os.path.join(self.directory, 'tiler.py')
+        _write_script(tiler, _TILER)
+        settings = self.settings._replace(tiler=tiler + ' --max-zoom 5', tiler_identity='tiler-1')
+
+        status, record, stages = _export_job(self.source, 'a.json', {'data_type': 'REFLECTIVITY'},
+                                             settings, None)
+
+        self.assertEqual((status, record['tiles'], record['tiler']),
+                         ('exported', 'a.tiles', 'tiler-1'))
+        self.assertEqual(sorted(stages.keys()), ['compress', 'export', 'tile'])
+        with open(os.path.join(self.directory, 'a.tiles', '5', '17', '8.png')) as f:
+            self.assertEqual(json.load(f), {'productInfo': {'dataType': 'REFLECTIVITY'}})
+        self.assertEqual(_export_job(self.source, 'a.json', {}, settings, record),
+                         ('skipped', record, {}))
+
+        settings = settings._replace(tiler_identity='tiler-2')
+        self.assertEqual(_export_job(self.source, 'a.json', {}, settings, record)[1]['tiler'],
+                         'tiler-2')
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'a.tiles.old')))
+
+    def test_tile_url_in_catalog(self):
+        collector = RadarRasterCollector(tiles=True)
+        collector.add(_product('fivan', '2026-01-24T00:00:00+00:00'))
+        sites, _ = collector.finish()
+        time = sites['fivan']['products']['PPI dbZh']['flavors']['EL 0.3']['times'][0]
+        self.assertEqual(time['tiles'], '2026-01-24T000000+0000_fivan.tiles/{z}/{x}/{y}.png')
+
+    def test_sequences(self):
+        sequencer = os.path.join(self.directory, 'sequencer.py')
+        _write_script(sequencer, _SEQUENCER)
+        products = [_product('fivan', '2026-01-24T00:{:02}:00+00:00'.format(minute))
+                    for minute in (10, 0, 5)]
+        for product in products:
+            product['data_file'] = self._write_source(os.path.basename(product['data_file']))
+        sites, sources_dests_infos = collect_radar_rasters(products)
+        manifest = {}
+
+        counts = export_sequences(sites, sources_dests_infos, self.settings, sequencer,
+                                  frames=2, manifest=manifest)
+
+        self.assertEqual(counts['exported'], 1)
+        flavor = sites['fivan']['products']['PPI dbZh']['flavors']['EL 0.3']
+        self.assertEqual(flavor['sequence'], {
+            'url': 'fivan_PPI_dbZh_EL_0.3.seq.gz',
+            'times': ['2026-01-24T00:05:00+00:00', '2026-01-24T00:10:00+00:00'],
+            'format': 'sequence'
+        })
+        with gzip.open(os.path.join(self.directory, 'fivan_PPI_dbZh_EL_0.3.seq.gz'), 'rt') as f:
+            sequence = json.load(f)
+        self.assertEqual([os.path.basename(f) for f in sequence['frames']],
+                         ['2026-01-24T000500+0000_fivan.tiff.gz',
+                          '2026-01-24T001000+0000_fivan.tiff.gz'])
+        self.assertEqual(sequence['metadata']['urls'],
+                         ['2026-01-24T000500+0000_fivan.json.gz',
+                          '2026-01-24T001000+0000_fivan.json.gz'])
+
+        counts = export_sequences(sites, sources_dests_infos, self.settings, sequencer,
+                                  frames=2, manifest=manifest)
+        self.assertEqual(counts['skipped'], 1)
+
+
+class TestCollect(_ExporterTestCase):
+    def test_collect(self):
+        products = [_product('fivan', '2026-01-24T00:{:02}:00+00:00'.format(minute))
+                    for minute in range(0, 30, 5)]
+        products.append(_product('fivan', '2026-01-24T01:00:00+00:00'))
+        products[-1]['data_file'] = self._write_source('fail.tiff')
+        for product in products[:-1]:
+            product['data_file'] = self._write_source(os.path.basename(product['data_file']))
+        infile = io.StringIO(''.join(json.dumps(p) + '\n' for p in products))
+
+        metrics_path = os.path.join(self.directory, 'metrics.jsonl')
+        prometheus_path = os.path.join(self.directory, 'collect.prom')
+
+        failed = collect(infile, self.settings, jobs=1, queue_size=1, stats_interval=None,
+                         metrics_path=metrics_path, prometheus_path=prometheus_path)
+
+        self.assertEqual(failed, 1)
+        with open(os.path.join(self.directory, 'catalog.json')) as f:
+            catalog = json.load(f)
+        times = catalog['radarProducts']['fivan']['products']['PPI dbZh']['flavors']['EL 0.3']['times']
+        self.assertEqual(len(times), 6)
+        self.assertNotIn('2026-01-24T01:00:00+00:00', [time['time'] for time in times])
+        for time in times:
+            self.assertTrue(os.path.exists(os.path.join(self.directory, time['url'])))
+
+        with open(os.path.join(self.directory, 'export_manifest.json')) as f:
+            self.assertEqual(len(json.load(f)), 6)
+
+        with open(metrics_path) as f:
+            metrics = json.loads(f.read())
+        self.assertEqual(metrics['component'], 'collect')
+        self.assertEqual({stage: totals['count'] for stage, totals in metrics['stages'].items()},
+                         {'read': 7, 'export': 6, 'compress': 6, 'catalog': 1})
+        self.assertEqual(metrics['stages']['export']['bytesIn'], 6 * len(b'TIFF'))
+        self.assertIn({'name': 'products', 'labels': {'status': 'failed'}, 'value': 1},
+                      metrics['gauges'])
+        with open(prometheus_path) as f:
+            prometheus = f.read().splitlines()
+        self.assertIn('ppi_stage_count{component="collect",stage="export"} 6', prometheus)
+        self.assertTrue(any(line.startswith(
+            'ppi_latest_product_age_seconds{component="collect",site="fivan"} ')
+            for line in prometheus))
+
+    def test_collect_in_parallel(self):
+        products = [_product('fivan', '2026-01-24T00:{:02}:00+00:00'.format(minute))
+                    for minute in range(0, 30, 5)]
+        for product in products:
+            product['data_file'] = self._write_source(os.path.basename(product['data_file']))
+        infile = io.StringIO(''.join(json.dumps(p) + '\n' for p in products))
+
+        failed = collect(infile, self.settings, jobs=3, queue_size=1, stats_interval=0.01)
+
+        self.assertEqual(failed, 0)
+        with open(os.path.join(self.directory, 'catalog.json')) as f:
+            catalog = json.load(f)
+        times = catalog['radarProducts']['fivan']['products']['PPI dbZh']['flavors']['EL 0.3']['times']
+        self.assertEqual(len(times), 6)
+        for time in times:
+            self.assertTrue(os.path.exists(os.path.join(self.directory, time['url'])))
+
+    def test_read_stage_doesnt_block_once_stopped(self):
+        product_queue = queue.Queue(maxsize=1)
+        product_queue.put('not taken')
+        stop = threading.Event()
+        errors = []
+        reader = threading.Thread(target=_read_stage, args=(
+            io.StringIO(''), RadarRasterCollector(), product_queue, PipelineStats(), stop,
+            errors, Metrics('test')))
+        reader.start()
+
+        stop.set()
+        reader.join(5)
+
+        self.assertFalse(reader.is_alive())
+        self.assertEqual(errors, [])
+
+    def test_remove_unreferenced(self):
+        products = [_product('fivan', '2026-01-24T00:{:02}:00+00:00'.format(minute))
+                    for minute in range(0, 30, 5)]
+        for product in products:
+            product['data_file'] = self._write_source(os.path.basename(product['data_file']))
+        for name in ['geointerests.geojson', 'old.json.gz.tmp']:
+            with open(os.path.join(self.directory, name), 'w') as f:
+                f.write('{}')
+
+        self.assertEqual(len(self._run(products)), 6)
+        manifest = self._run(products, max_times=lambda site_id, product_id: 2,
+                             min_catalog_ratio=0)
+
+        exported = self._exported()
+        self.assertEqual(exported, sorted(manifest.keys()))
+        self.assertEqual(len(exported), 2)
+        for name in ['catalog.json', 'geointerests.geojson', 'old.json.gz.tmp']:
+            self.assertTrue(os.path.exists(os.path.join(self.directory, name)))
+
+    def _run(self, products, **kwargs):
+        infile = io.StringIO(''.join(json.dumps(p) + '\n' for p in products))
+        collect(infile, self.settings, stats_interval=None, remove_unreferenced_outputs=True,
+                **kwargs)
+        with open(os.path.join(self.directory, 'export_manifest.json')) as f:
+            return json.load(f)
+
+    def _exported(self):
+        return sorted(n for n in os.listdir(self.directory) if n.endswith('.json.gz'))
+
+    def _products(self, count):
+        products = [_product('fivan', '2026-01-24T00:{:02}:00+00:00'.format(minute))
+                    for minute in range(0, 5 * count, 5)]
+        for product in products:
+            product['data_file'] = self._write_source(os.path.basename(product['data_file']))
+        return products
+
+    def test_empty_input_removes_nothing(self):
+        self._run(self._products(6))
+        exported = self._exported()
+
+        with self.assertRaisesRegex(Exception, 'Catalog shrank from 6 to 0 times'):
+            self._run([])
+
+        self.assertEqual(self._exported(), exported)
+        with open(os.path.join(self.directory, 'export_manifest.json')) as f:
+            self.assertEqual(sorted(json.load(f).keys()), exported)
+
+    def test_truncated_input_removes_nothing(self):
+        products = self._products(6)
+        self._run(products)
+        exported = self._exported()
+
+        with self.assertRaisesRegex(Exception, 'Catalog shrank from 6 to 2 times'):
+            self._run(products[:2])
+        self.assertEqual(self._exported(), exported)
+
+        # Products only missing from the input aren't removed even when the
+        # catalog is large enough
+        self._run(products[:4])
+        self.assertEqual(self._exported(), exported)
+
+    def test_removes_old_unreferenced(self):
+        products = self._products(6)
+        self._run(products)
+        old = os.path.join(self.directory, self._exported()[0])
+        os.utime(old, (time.time() - 2 * 3600, time.time() - 2 * 3600))
+
+        self._run(products[1:], remove_older_than_hours=1)
+
+        self.assertEqual(len(self._exported()), 5)
+        self.assertFalse(os.path.exists(old))
+
+
+class TestReadProducts(unittest.TestCase):
+    def test_reads_lines_lazily(self):
+        lines = iter(['{"a": 1}\n', '\n', '{"b": 2} {"c": 3}\n'])
+        products = read_products(lines)
+
+        self.assertEqual(next(products), {'a': 1})
+        self.assertEqual(next(lines), '\n')
+        self.assertEqual(list(products), [{'b': 2}, {'c': 3}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,17 @@
+#!/bin/bash
+# Alternative to cronjob.sh: keeps the downloader running and rebuilds the
+# distribution as soon as new products have been downloaded.
+set -euo pipefail
+
+script_dir=$(dirname "$(readlink -f "$0")")
+
+# Fail right away instead of in every round if the build isn't configured
+"${script_dir}/build-and-distribute.sh" --check
+
+# Exporting and writing the catalog run as processes of their own after each
+# round rather than in the downloader: the product index and the export
+# manifest make a run only do the work new products need, the exporters are
+# processes anyway, and the downloader keeps downloading if a build crashes.
+cd "${script_dir}/fmi/s3_downloader"
+exec env/bin/python fmi_s3_product_download.py -c config.ini --daemon --compress \
+    --after-round "'${script_dir}/build-and-distribute.sh'"
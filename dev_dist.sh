@@ -11,7 +11,7 @@ if [[ ! -f "${RASTER_TO_JSON}" ]] ; then
     exit 1
 fi
 
-python3 fmi/dist_builder/collect_radar_products.py fmi/data/ | \
-    python3 collect.py "$RASTER_TO_JSON" client/build/data
+python3 fmi/dist_builder/collect_radar_products.py --index fmi/product_index.sqlite --prune fmi/data/ | \
+    python3 collect.py --jobs "$(nproc)" --remove-unreferenced "$RASTER_TO_JSON" client/build/data
 
 python3 finnish_localities/localities_to_geojson.py finnish_localities/finnish_localities.tsv > client/build/data/geointerests.geojson
@@ -11,10 +11,16 @@ import codecs
 import datetime
 import json
 import os
+import sqlite3
 import sys
+import time
 
 from fmi_radars import radars
 
+# metrics.py is shared by all the components and lives in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from metrics import Metrics
+
 
 def err(*args, **kwargs):
     if kwargs.get('file', None) is None:
@@ -117,6 +123,122 @@ def read_product(path):
     return result
 
 
+class ProductIndex(object):
+    """On-disk SQLite index of read_product results.
+
+    Entries are keyed by the metadata file path and are valid as long as the
+    file's modification time and size stay the same and the data file the
+    product refers to still exists.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS products ("
+            " path TEXT PRIMARY KEY,"
+            " mtime_ns INTEGER NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " product TEXT NOT NULL)")
+
+    def get(self, path, stat):
+        row = self.connection.execute(
+            "SELECT product FROM products WHERE path = ? AND mtime_ns = ? AND size = ?",
+            (path, stat.st_mtime_ns, stat.st_size)).fetchone()
+        if row is None:
+            return None
+        product = json.loads(row[0])
+        # e.g. the TIFF has been gzipped since
+        if not os.path.isfile(product["data_file"]):
+            return None
+        return product
+
+    def put(self, path, stat, product):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO products (path, mtime_ns, size, product) VALUES (?, ?, ?, ?)",
+            (path, stat.st_mtime_ns, stat.st_size, json.dumps(product)))
+
+    def prune(self, directory, seen_paths):
+        """Removes entries under directory whose paths aren't in seen_paths."""
+        prefix = os.path.join(directory, '')
+        stale = [(path,) for (path,) in self.connection.execute("SELECT path FROM products")
+                 if path.startswith(prefix) and path not in seen_paths]
+        self.connection.executemany("DELETE FROM products WHERE path = ?", stale)
+        return len(stale)
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def scan(directory, index=None, prune=False, metrics=None):
+    """Generates products from the directory as their files are read.
+
+    With an index, only new or changed files are read, the rest come from the
+    index. With prune, entries for files no longer in directory are removed
+    from the index once the whole directory has been scanned.
+
+    The time spent reading product information files is added to the
+    'parse' stage of metrics, if given, and the rest of the time spent
+    scanning, excluding the time the caller spends on the products, to the
+    'scan' stage.
+    """
+    err("Scanning '{}' for product information files...".format(directory))
+
+    seen_paths = set()
+    read_count = 0
+    file_count = 0
+    busy_seconds = 0.0
+    parse_seconds = 0.0
+    resumed = time.monotonic()
+
+    def parse(path):
+        started = time.monotonic()
+        product = read_product(path)
+        seconds = time.monotonic() - started
+        if metrics is not None:
+            metrics.add('parse', seconds, bytes_in=os.path.getsize(path))
+        return product, seconds
+
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            if not file.endswith(".json"):
+                continue
+            path = os.path.join(root, file)
+            file_count += 1
+
+            if index is None:
+                product, seconds = parse(path)
+                parse_seconds += seconds
+            else:
+                seen_paths.add(path)
+                stat = os.stat(path)
+                product = index.get(path, stat)
+                if product is None:
+                    product, seconds = parse(path)
+                    parse_seconds += seconds
+                    index.put(path, stat, product)
+                    read_count += 1
+
+            busy_seconds += time.monotonic() - resumed
+            yield product
+            resumed = time.monotonic()
+
+    if index is not None:
+        err("Read {} product information files, {} from the index".format(
+            read_count, len(seen_paths) - read_count))
+        if prune:
+            err("Pruned {} entries from the index".format(index.prune(directory, seen_paths)))
+        index.commit()
+
+    if metrics is not None:
+        busy_seconds += time.monotonic() - resumed
+        metrics.add('scan', busy_seconds - parse_seconds, count=file_count)
+        if index is not None:
+            metrics.gauge('index_hits', len(seen_paths) - read_count)
+
 
 def collect(directory):
     if not os.path.isdir(directory):
@@ -126,18 +248,7 @@ def collect(directory):
     # dir_parts = [directory, str(now.year), str(now.month), str(now.day)]
     # dir_path = os.path.abspath("/".join(dir_parts))
 
-    products = []
-    err("Scanning '{}' for product information files...".format(directory))
-
-    for root, dirs, files in os.walk(directory):
-        path = root.split(os.sep)
-        # print((len(path) - 1) * '---', os.path.basename(root))
-
-        for file in files:
-            if file.endswith(".json"):
-                products.append(read_product(os.path.join(root, file)))
-
-    return products
+    return list(scan(directory))
 
 
 if __name__ == '__main__':
@@ -146,6 +257,33 @@ if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument("directory",
                         help="product directory shared with fmi_product_download")
+    parser.add_argument("--index", metavar="FILE",
+                        help="SQLite file to cache product information in between runs")
+    parser.add_argument("--prune", action="store_true", default=False,
+                        help="remove index entries of files that no longer exist")
+    parser.add_argument("--metrics", dest="metrics_path", metavar="FILE", default=None,
+                        help="append the timings of scanning and parsing into FILE as a line of JSON")
+    parser.add_argument("--prometheus", dest="prometheus_path", metavar="FILE", default=None,
+                        help="write the timings of scanning and parsing into FILE in the Prometheus text format")
     args = parser.parse_args()
-    for product in collect(args.directory):
-        pr(json.dumps(product))
+    if not os.path.isdir(args.directory):
+        parser.error("Product directory '{}' must exist".format(args.directory))
+
+    index = None
+    directory = args.directory
+    if args.index:
+        index = ProductIndex(args.index)
+        # Index entries must stay valid regardless of the working directory
+        directory = os.path.abspath(directory)
+    metrics = Metrics('collect_radar_products')
+    try:
+        # Output products as they are read so that collect.py can get going
+        for product in scan(directory, index, args.prune, metrics):
+            pr(json.dumps(product), flush=True)
+    finally:
+        if index is not None:
+            index.close()
+    if args.metrics_path:
+        metrics.write_json_line(args.metrics_path)
+    if args.prometheus_path:
+        metrics.write_prometheus(args.prometheus_path)
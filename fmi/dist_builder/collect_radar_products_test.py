@@ -0,0 +1,95 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from collect_radar_products import Metrics, ProductIndex, scan
+
+
+def _write_product(directory, name='202601240000_fivan_ppi_0.3_dbzh_qc'):
+    with open(os.path.join(directory, name + '.json'), 'w') as f:
+        json.dump({
+            'site': 'fivan',
+            'composite': False,
+            'timestamp': '2026-01-24T00:00:00+00:00',
+            'product_type': 'PPI dbZh',
+            'product_subtype': 'EL 0.3',
+            'elevation': 0.3,
+            'data_scale': {'linear_transformation_offset': -32,
+                           'linear_transformation_gain': 0.5}
+        }, f)
+    with open(os.path.join(directory, name + '.tiff'), 'wb') as f:
+        f.write(b'TIFF')
+    return os.path.join(directory, name)
+
+
+class TestProductIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data = os.path.join(self.directory, 'data')
+        os.makedirs(self.data)
+        self.index = ProductIndex(os.path.join(self.directory, 'index.sqlite'))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+    def _scan(self, prune=False):
+        """Returns the products and the number of files read."""
+        metrics = Metrics('test')
+        products = list(scan(self.data, self.index, prune, metrics))
+        return products, metrics.stages.get('parse', {}).get('count', 0)
+
+    def test_hit(self):
+        _write_product(self.data)
+        first, first_reads = self._scan()
+        second, second_reads = self._scan()
+
+        self.assertEqual((first_reads, second_reads), (1, 0))
+        self.assertEqual(second, first)
+
+    def test_miss_when_mtime_changes(self):
+        stem = _write_product(self.data)
+        self._scan()
+        stat = os.stat(stem + '.json')
+        os.utime(stem + '.json', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+        self.assertEqual(self._scan()[1], 1)
+
+    def test_miss_when_size_changes(self):
+        stem = _write_product(self.data)
+        self._scan()
+        stat = os.stat(stem + '.json')
+        with open(stem + '.json', 'a') as f:
+            f.write('\n')
+        os.utime(stem + '.json', ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+        self.assertEqual(self._scan()[1], 1)
+
+    def test_miss_when_data_file_gets_gzipped(self):
+        stem = _write_product(self.data)
+        self._scan()
+        os.rename(stem + '.tiff', stem + '.tiff.gz')
+
+        products, reads = self._scan()
+
+        self.assertEqual(reads, 1)
+        self.assertEqual(products[0]['data_file'], stem + '.tiff.gz')
+
+    def test_prune(self):
+        stem = _write_product(self.data)
+        _write_product(self.data, '202601240005_fivan_ppi_0.3_dbzh_qc')
+        self._scan()
+        os.unlink(stem + '.json')
+
+        products, _ = self._scan(prune=True)
+
+        self.assertEqual(len(products), 1)
+        paths = [path for (path,) in self.index.connection.execute("SELECT path FROM products")]
+        self.assertEqual(paths, [os.path.join(self.data,
+                                              '202601240005_fivan_ppi_0.3_dbzh_qc.json')])
+
+
+if __name__ == '__main__':
+    unittest.main()
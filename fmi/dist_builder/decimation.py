@@ -0,0 +1,90 @@
+"""
+Decimation of rasters into lower resolution overviews.
+
+Plain resampling would smooth away the reflectivity peaks that matter the
+most when looking at an overview, so each block of factor * factor pixels is
+reduced into its maximum for measured quantities and into its most common
+value for classifications. Pixels which weren't scanned only make it into
+the overview if the whole block wasn't scanned.
+"""
+from __future__ import print_function
+
+import numpy as np
+
+import tiff_reader
+
+
+METHOD_MAX = 'max'
+METHOD_MODE = 'mode'
+
+
+def decimation_method(product_info):
+    """Tells how a product should be decimated given its product info."""
+    data_scale = product_info.get('dataScale') or {}
+    if product_info.get('dataType') == 'hclass' or 'mapping' in data_scale:
+        return METHOD_MODE
+    return METHOD_MAX
+
+
+def _blocks(data, factor, fill_value):
+    """Returns data as (width / factor, height / factor, factor * factor) blocks.
+
+    data is padded with fill_value to a multiple of factor first.
+    """
+    width, height = data.shape
+    padded_width = -(-width // factor) * factor
+    padded_height = -(-height // factor) * factor
+    if (padded_width, padded_height) != (width, height):
+        padded = np.full((padded_width, padded_height), fill_value, dtype=data.dtype)
+        padded[:width, :height] = data
+        data = padded
+    blocks = data.reshape(padded_width // factor, factor, padded_height // factor, factor)
+    return blocks.transpose(0, 2, 1, 3).reshape(padded_width // factor,
+                                                padded_height // factor, factor * factor)
+
+
+def decimate_max(data, factor, not_scanned):
+    blocks = _blocks(data, factor, not_scanned).astype(np.int16)
+    blocks[blocks == not_scanned] = -1
+    result = blocks.max(axis=-1)
+    result[result < 0] = not_scanned
+    return result.astype(np.uint8)
+
+
+def decimate_mode(data, factor, not_scanned):
+    blocks = _blocks(data, factor, not_scanned)
+    values = [v for v in np.unique(blocks) if v != not_scanned]
+    if not values:
+        return np.full(blocks.shape[:2], not_scanned, dtype=np.uint8)
+    counts = np.stack([(blocks == v).sum(axis=-1) for v in values])
+    result = np.asarray(values, dtype=np.uint8)[counts.argmax(axis=0)]
+    result[counts.max(axis=0) == 0] = not_scanned
+    return result
+
+
+def decimate_raster(raster, factor, product_info):
+    """Returns the raster with its bands decimated by factor.
+
+    The data of the bands is indexed as data[x][y] like tiff_reader returns
+    it, and the affine transform is scaled to match.
+    """
+    if factor == 1:
+        return raster
+
+    data_scale = product_info.get('dataScale') or {}
+    not_scanned = data_scale.get('notScanned', tiff_reader.DEFAULT_FILL_VALUE)
+    if decimation_method(product_info) == METHOD_MODE:
+        decimate = decimate_mode
+    else:
+        decimate = decimate_max
+
+    bands = [band._replace(data=decimate(band.data, factor, not_scanned))
+             for band in raster.bands]
+    origin_x, pixel_width, row_rotation, origin_y, column_rotation, pixel_height = \
+        raster.affine_transform
+    return raster._replace(
+        width=bands[0].data.shape[0] if bands else -(-raster.width // factor),
+        height=bands[0].data.shape[1] if bands else -(-raster.height // factor),
+        affine_transform=(origin_x, pixel_width * factor, row_rotation * factor,
+                          origin_y, column_rotation * factor, pixel_height * factor),
+        bands=bands)
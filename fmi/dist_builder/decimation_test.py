@@ -0,0 +1,92 @@
+import unittest
+
+import numpy as np
+
+import tiff_reader
+from decimation import (METHOD_MAX, METHOD_MODE, decimate_max, decimate_mode, decimate_raster,
+                        decimation_method)
+
+
+NOT_SCANNED = 255
+
+
+class TestDecimateMax(unittest.TestCase):
+    def test_block_maximum(self):
+        data = np.array([[1, 2, 3, 4],
+                         [5, 6, 7, 8],
+                         [9, 10, 11, 12],
+                         [13, 14, 15, 16]], dtype=np.uint8)
+
+        np.testing.assert_array_equal(decimate_max(data, 2, NOT_SCANNED),
+                                      [[6, 8], [14, 16]])
+
+    def test_not_scanned_only_when_whole_block_is(self):
+        data = np.array([[NOT_SCANNED, NOT_SCANNED, NOT_SCANNED, 0],
+                         [NOT_SCANNED, NOT_SCANNED, NOT_SCANNED, NOT_SCANNED]], dtype=np.uint8)
+
+        np.testing.assert_array_equal(decimate_max(data, 2, NOT_SCANNED),
+                                      [[NOT_SCANNED, 0]])
+
+    def test_padded_edge_blocks(self):
+        # 5 x 3 pads into 6 x 4: the edge blocks only have the pixels that exist
+        data = np.arange(15, dtype=np.uint8).reshape(5, 3)
+
+        result = decimate_max(data, 2, NOT_SCANNED)
+
+        np.testing.assert_array_equal(result, [[4, 5], [10, 11], [13, 14]])
+
+
+class TestDecimateMode(unittest.TestCase):
+    def test_most_common_value(self):
+        data = np.array([[2, 2, 3, 4],
+                         [2, 5, 4, 4]], dtype=np.uint8)
+
+        np.testing.assert_array_equal(decimate_mode(data, 2, NOT_SCANNED), [[2, 4]])
+
+    def test_ties_go_to_the_smallest_value(self):
+        data = np.array([[3, 1, 6, 6],
+                         [1, 3, 5, 5]], dtype=np.uint8)
+
+        np.testing.assert_array_equal(decimate_mode(data, 2, NOT_SCANNED), [[1, 5]])
+
+    def test_not_scanned_is_not_counted(self):
+        data = np.array([[NOT_SCANNED, NOT_SCANNED, NOT_SCANNED, NOT_SCANNED],
+                         [NOT_SCANNED, 2, NOT_SCANNED, NOT_SCANNED]], dtype=np.uint8)
+
+        np.testing.assert_array_equal(decimate_mode(data, 2, NOT_SCANNED), [[2, NOT_SCANNED]])
+
+    def test_padded_edge_blocks(self):
+        data = np.array([[1, 1, 2],
+                         [3, 1, 2],
+                         [4, 4, 4]], dtype=np.uint8)
+
+        np.testing.assert_array_equal(decimate_mode(data, 2, NOT_SCANNED), [[1, 2], [4, 4]])
+
+    def test_all_not_scanned(self):
+        data = np.full((2, 2), NOT_SCANNED, dtype=np.uint8)
+
+        np.testing.assert_array_equal(decimate_mode(data, 2, NOT_SCANNED), [[NOT_SCANNED]])
+
+
+class TestDecimateRaster(unittest.TestCase):
+    def test_decimate_raster(self):
+        data = np.zeros((5, 3), dtype=np.uint8)
+        band = tiff_reader.Band(no_data_value=0, unit_type='', scale=1, offset=0, data=data)
+        raster = tiff_reader.Raster(width=5, height=3, projection_ref='',
+                                    affine_transform=(24.0, 0.1, 0.0, 61.0, 0.0, -0.1),
+                                    bands=[band])
+
+        result = decimate_raster(raster, 2, {'dataScale': {'notScanned': NOT_SCANNED}})
+
+        self.assertEqual((result.width, result.height), (3, 2))
+        self.assertEqual(result.affine_transform, (24.0, 0.2, 0.0, 61.0, 0.0, -0.2))
+        self.assertEqual(result.bands[0].data.shape, (3, 2))
+
+    def test_method(self):
+        self.assertEqual(decimation_method({'dataType': 'REFLECTIVITY'}), METHOD_MAX)
+        self.assertEqual(decimation_method({'dataType': 'hclass'}), METHOD_MODE)
+        self.assertEqual(decimation_method({'dataScale': {'mapping': {}}}), METHOD_MODE)
+
+
+if __name__ == '__main__':
+    unittest.main()
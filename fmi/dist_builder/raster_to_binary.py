@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""Exporter producing the binary product format.
+
+Works like raster_to_json.py (additional metadata is read as JSON from stdin,
+the TIFF path is the first argument, an overview can be produced with
+--decimate and the product is written to stdout), but
+the output is binary, little-endian:
+
+    offset  size   field
+    0       4      magic, b'PPIB'
+    4       2      format version, 1
+    6       2      payload encoding, 0 = raw, 1 = run-length
+    8       4      width
+    12      4      height
+    16      48     affine transform, 6 float64s
+    64      4      length of the metadata JSON in bytes
+    68      n      metadata JSON (UTF-8), same as the 'metadata' of the JSON
+                   format, e.g. productInfo and projectionRef
+    68 + n  w * h  payload
+
+The raw payload is the uint8 data laid out as in the JSON format's 'data'
+array, i.e. one row of 'height' values per x, so that clients can use it
+as-is without any parsing.
+
+Most pixels of a product tend to be no echo or not scanned, so by default
+long runs of the special values declared in the product's dataScale are
+run-length encoded. The run-length payload is the same data as the raw
+one, rows one after another, as a list of
+
+    0       1      type, 0 = run, 1 = literal
+    1       4      number of pixels, n
+    5       1      run: the value of all the n pixels
+    5       n      literal: the n pixel values
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import struct
+import sys
+
+import numpy as np
+
+import decimation
+import tiff_reader
+
+
+MAGIC = b'PPIB'
+VERSION = 1
+
+ENCODING_RAW = 0
+ENCODING_RLE = 1
+
+ENCODINGS = {
+    'raw': ENCODING_RAW,
+    'rle': ENCODING_RLE
+}
+
+_RUN = 0
+_LITERAL = 1
+
+# Shorter runs of special values are left in literals, they would take more
+# space as runs of their own
+_MIN_RUN_LENGTH = 8
+
+_HEADER = struct.Struct('<4sHHII6dI')
+_RUN_HEADER = struct.Struct('<BIB')
+_LITERAL_HEADER = struct.Struct('<BI')
+
+
+def special_values(metadata):
+    """Returns the special values declared in the dataScale of the metadata."""
+    data_scale = metadata.get('productInfo', {}).get('dataScale') or {}
+    values = set([data_scale.get('notScanned', tiff_reader.DEFAULT_FILL_VALUE)])
+    if data_scale.get('noEcho') is not None:
+        values.add(data_scale['noEcho'])
+    return values
+
+
+def encode_rle(data, values):
+    """Run-length encodes the runs of values in data, see the module docstring."""
+    flat = np.ascontiguousarray(data).ravel()
+    if len(flat) == 0:
+        return b''
+
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    lengths = np.diff(np.concatenate((starts, [len(flat)])))
+    run_values = flat[starts]
+    is_run = np.isin(run_values, sorted(values)) & (lengths >= _MIN_RUN_LENGTH)
+
+    result = []
+    position = 0
+    for start, length, value in zip(starts[is_run].tolist(), lengths[is_run].tolist(),
+                                    run_values[is_run].tolist()):
+        if start > position:
+            result.append(_LITERAL_HEADER.pack(_LITERAL, start - position))
+            result.append(flat[position:start].tobytes())
+        result.append(_RUN_HEADER.pack(_RUN, length, value))
+        position = start + length
+    if position < len(flat):
+        result.append(_LITERAL_HEADER.pack(_LITERAL, len(flat) - position))
+        result.append(flat[position:].tobytes())
+    return b''.join(result)
+
+
+def encode_product(raster, band, metadata, encoding=ENCODING_RAW):
+    """Returns the product as bytes in the binary product format."""
+    metadata = dict(metadata)
+    metadata['width'] = raster.width
+    metadata['height'] = raster.height
+    metadata['projectionRef'] = raster.projection_ref
+    metadata['affineTransform'] = raster.affine_transform
+    metadata_json = json.dumps(metadata).encode('utf-8')
+
+    if encoding == ENCODING_RAW:
+        payload = band.data.tobytes(order='C')
+    elif encoding == ENCODING_RLE:
+        payload = encode_rle(band.data, special_values(metadata))
+    else:
+        raise ValueError("Unknown payload encoding: {}".format(encoding))
+
+    header = _HEADER.pack(MAGIC, VERSION, encoding, raster.width, raster.height,
+                          *raster.affine_transform, len(metadata_json))
+    return header + metadata_json + payload
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path')
+    parser.add_argument('--decimate', type=int, default=1, metavar='FACTOR',
+                        help="produce an overview decimated by FACTOR, see decimation.py")
+    parser.add_argument('--encoding', choices=sorted(ENCODINGS.keys()), default='rle',
+                        help="payload encoding")
+    args = parser.parse_args()
+
+    additional_metadata = json.load(sys.stdin)
+
+    raster = tiff_reader.read_tiff(args.path)
+    raster = decimation.decimate_raster(
+        raster, args.decimate, additional_metadata.get('productInfo', {}))
+
+    if len(raster.bands) != 1:
+        sys.exit("Exactly one band expected!")
+
+    sys.stdout.buffer.write(encode_product(raster, raster.bands[0], additional_metadata,
+                                           ENCODINGS[args.encoding]))
@@ -0,0 +1,95 @@
+import json
+import unittest
+
+import numpy as np
+
+import tiff_reader
+from raster_to_binary import (ENCODING_RLE, MAGIC, _HEADER, _LITERAL, _LITERAL_HEADER, _RUN,
+                              _RUN_HEADER, encode_product, encode_rle)
+
+
+def _decode_rle(payload):
+    """Decodes a run-length payload into (items, data), like the client does."""
+    items = []
+    data = bytearray()
+    position = 0
+    while position < len(payload):
+        item_type = payload[position]
+        if item_type == _RUN:
+            _, length, value = _RUN_HEADER.unpack_from(payload, position)
+            data.extend(bytes([value]) * length)
+            position += _RUN_HEADER.size
+        else:
+            _, length = _LITERAL_HEADER.unpack_from(payload, position)
+            position += _LITERAL_HEADER.size
+            data.extend(payload[position:position + length])
+            position += length
+        items.append((item_type, length))
+    return items, bytes(data)
+
+
+class TestEncodeRle(unittest.TestCase):
+    def test_round_trip(self):
+        data = np.random.RandomState(0).randint(0, 6, size=(17, 23)).astype(np.uint8)
+        data[2:5, :] = 255
+        data[10, 3:20] = 0
+
+        _, decoded = _decode_rle(encode_rle(data, {0, 255}))
+
+        self.assertEqual(decoded, data.tobytes(order='C'))
+
+    def test_short_runs_stay_in_literals(self):
+        data = np.array([[1] + [0] * 7 + [2] + [255] * 8 + [3]], dtype=np.uint8)
+
+        items, decoded = _decode_rle(encode_rle(data, {0, 255}))
+
+        self.assertEqual(items, [(_LITERAL, 9), (_RUN, 8), (_LITERAL, 1)])
+        self.assertEqual(decoded, data.tobytes())
+
+    def test_runs_span_rows(self):
+        # Rows are x, so a run going past the end of one continues on the next
+        data = np.ones((4, 5), dtype=np.uint8)
+        data[0, 2:] = 0
+        data[1, :] = 0
+        data[2, :2] = 0
+
+        items, decoded = _decode_rle(encode_rle(data, {0}))
+
+        self.assertEqual(items, [(_LITERAL, 2), (_RUN, 10), (_LITERAL, 8)])
+        self.assertEqual(decoded, data.tobytes())
+
+    def test_only_special_values_make_runs(self):
+        data = np.full((2, 10), 7, dtype=np.uint8)
+
+        items, decoded = _decode_rle(encode_rle(data, {0, 255}))
+
+        self.assertEqual(items, [(_LITERAL, 20)])
+        self.assertEqual(decoded, data.tobytes())
+
+    def test_empty(self):
+        self.assertEqual(encode_rle(np.zeros((0, 0), dtype=np.uint8), {0}), b'')
+
+
+class TestEncodeProduct(unittest.TestCase):
+    def test_rle_product(self):
+        data = np.zeros((3, 4), dtype=np.uint8)
+        data[1, 1] = 42
+        band = tiff_reader.Band(no_data_value=0, unit_type='', scale=1, offset=0, data=data)
+        raster = tiff_reader.Raster(width=3, height=4, projection_ref='',
+                                    affine_transform=(24.0, 0.1, 0.0, 61.0, 0.0, -0.1),
+                                    bands=[band])
+        metadata = {'productInfo': {'dataScale': {'noEcho': 0, 'notScanned': 255}}}
+
+        product = encode_product(raster, band, metadata, ENCODING_RLE)
+
+        header = _HEADER.unpack_from(product)
+        self.assertEqual(header[:5], (MAGIC, 1, ENCODING_RLE, 3, 4))
+        metadata_length = header[-1]
+        self.assertEqual(json.loads(product[_HEADER.size:_HEADER.size + metadata_length])['width'],
+                         3)
+        _, decoded = _decode_rle(product[_HEADER.size + metadata_length:])
+        self.assertEqual(decoded, data.tobytes(order='C'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,23 +1,33 @@
 #!/usr/bin/env python
 from __future__ import print_function
 
+import argparse
 import json
 import sys
 
+import decimation
 import tiff_reader
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path')
+    parser.add_argument('--decimate', type=int, default=1, metavar='FACTOR',
+                        help="produce an overview decimated by FACTOR, see decimation.py")
+    args = parser.parse_args()
+
     additional_metadata = json.load(sys.stdin)
 
-    raster = tiff_reader.read_tiff(sys.argv[1])
+    raster = tiff_reader.read_tiff(args.path)
+    raster = decimation.decimate_raster(
+        raster, args.decimate, additional_metadata.get('productInfo', {}))
 
     if len(raster.bands) != 1:
         sys.exit("Exactly one band expected!")
     band = raster.bands[0]
 
     result = {}
-    result['data'] = band.data
+    result['data'] = band.data.tolist()
     # the TIFFs returned (or read) don't seem to include no data values etc.
 
     metadata = {}
@@ -26,7 +36,7 @@ if __name__ == "__main__":
     metadata['projectionRef'] = raster.projection_ref
     metadata['affineTransform'] = raster.affine_transform
 
-    for k, v in additional_metadata.iteritems():
+    for k, v in additional_metadata.items():
         metadata[k] = v
 
     result['metadata'] = metadata
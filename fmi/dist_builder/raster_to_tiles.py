@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+"""Tiler rendering a product into a Web Mercator XYZ tile pyramid.
+
+Used with `collect.py --tiler`: additional metadata is read as JSON from
+stdin like with the exporters, the TIFF path is the first argument and the
+directory to write the tiles into the second one. Tiles are written as
+'<directory>/<z>/<x>/<y>.png' for the zoom levels given with --min-zoom and
+--max-zoom, along with 'tiles.json' describing the pyramid.
+
+The tiles are palette-indexed PNGs whose pixel values are the product's
+data values as-is and whose palette is built from the product's dataScale
+with the client's colors (see client/src/coloring.ts), so they can be shown
+without any processing on the client and stay small. Pixels are resampled
+with nearest neighbour so that no values that aren't in the product get
+made up.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import os
+import sys
+
+from osgeo import gdal
+gdal.UseExceptions()
+
+import tiff_reader
+
+
+TILE_SIZE = 256
+DEFAULT_MIN_ZOOM = 5
+DEFAULT_MAX_ZOOM = 9
+
+# Half of the width of the Web Mercator world in meters
+_WORLD_HALF = 20037508.342789244
+
+# The colors below match client/src/coloring.ts
+NOT_SCANNED_COLOR = (211, 211, 211, 76)
+NO_ECHO_COLOR = (0, 0, 0, 0)
+
+# Lower bound of the range in dBZ and the color of the range
+NOAA_LOW_RED_GREEN_BLUE = [
+    (-30, 208, 255, 255),
+    (-25, 198, 152, 189),
+    (-20, 154, 104, 155),
+    (-15, 95, 47, 99),
+    (-10, 205, 205, 155),
+    (-5, 155, 154, 106),
+    (0, 100, 101, 96),
+    (5, 12, 230, 231),
+    (10, 1, 161, 249),
+    (15, 0, 0, 238),
+    (20, 4, 252, 5),
+    (25, 0, 200, 6),
+    (30, 0, 141, 1),
+    (35, 250, 242, 0),
+    (40, 229, 188, 0),
+    (45, 255, 157, 7),
+    (50, 253, 0, 2),
+    (55, 215, 0, 0),
+    (60, 189, 1, 0),
+    (65, 253, 0, 246),
+    (70, 154, 86, 195),
+    (75, 248, 246, 247)]
+
+HCLASS_COLORS = {
+    'NON_MET': (46, 47, 51, 255),
+    'RAIN': (78, 94, 160, 255),
+    'WET_SNOW': (60, 38, 129, 255),
+    'DRY_SNOW': (181, 216, 234, 255),
+    'GRAUPEL': (233, 235, 72, 255),
+    'HAIL': (182, 2, 36, 255),
+    'NO_SIGNAL': NO_ECHO_COLOR,
+    'NOT_SCANNED': NOT_SCANNED_COLOR
+}
+
+
+def reflectivity_color(dbz):
+    for index, (low, red, green, blue) in enumerate(NOAA_LOW_RED_GREEN_BLUE):
+        if index == len(NOAA_LOW_RED_GREEN_BLUE) - 1:
+            return (red, green, blue, 255)
+        if low <= dbz < NOAA_LOW_RED_GREEN_BLUE[index + 1][0]:
+            return (red, green, blue, 255)
+    # Below the scale, the client ends up drawing these black
+    return (0, 0, 0, 255)
+
+
+def palette(product_info):
+    """Returns the RGBA colors of all 256 data values of the product."""
+    data_scale = product_info.get('dataScale') or {}
+
+    if product_info.get('dataType') == 'REFLECTIVITY':
+        colors = [reflectivity_color(data_scale['offset'] + value * data_scale['step'])
+                  for value in range(256)]
+    elif 'mapping' in data_scale:
+        colors = [(128, 128, 128, 128)] * 256
+        for value, hclass in data_scale['mapping'].items():
+            colors[int(value)] = HCLASS_COLORS.get(hclass, (128, 128, 128, 128))
+    else:
+        colors = [(0, 0, 255, min(255, int(value / 150.0 * 255))) for value in range(256)]
+
+    if data_scale.get('noEcho') is not None:
+        colors[data_scale['noEcho']] = NO_ECHO_COLOR
+    colors[data_scale.get('notScanned', tiff_reader.DEFAULT_FILL_VALUE)] = NOT_SCANNED_COLOR
+    return colors
+
+
+def tile_bounds(zoom, x, y):
+    """Returns the Web Mercator (min x, min y, max x, max y) of a tile."""
+    size = 2 * _WORLD_HALF / 2 ** zoom
+    min_x = -_WORLD_HALF + x * size
+    max_y = _WORLD_HALF - y * size
+    return (min_x, max_y - size, min_x + size, max_y)
+
+
+def tile_range(bounds, zoom):
+    """Returns the (first x, first y, last x, last y) tiles covering bounds."""
+    min_x, min_y, max_x, max_y = bounds
+    count = 2 ** zoom
+    size = 2 * _WORLD_HALF / count
+
+    def tile(offset):
+        return min(max(int(math.floor(offset / size)), 0), count - 1)
+
+    # The max edges are exclusive, so that bounds ending exactly on a tile
+    # edge don't cover the next tile
+    return (tile(min_x + _WORLD_HALF), tile(_WORLD_HALF - max_y),
+            tile(math.nextafter(max_x, min_x) + _WORLD_HALF),
+            tile(_WORLD_HALF - math.nextafter(min_y, max_y)))
+
+
+def mercator_bounds(dataset):
+    warped = gdal.Warp('', dataset, format='VRT', dstSRS='EPSG:3857')
+    min_x, pixel_width, _, max_y, _, pixel_height = warped.GetGeoTransform()
+    return (min_x, max_y + warped.RasterYSize * pixel_height,
+            min_x + warped.RasterXSize * pixel_width, max_y)
+
+
+def write_tile(path, data, color_table):
+    tile = gdal.GetDriverByName('MEM').Create('', TILE_SIZE, TILE_SIZE, 1, gdal.GDT_Byte)
+    band = tile.GetRasterBand(1)
+    band.WriteArray(data)
+    band.SetRasterColorTable(color_table)
+    gdal.GetDriverByName('PNG').CreateCopy(path, tile)
+
+
+def render_zoom(dataset, zoom, bounds, color_table, fill_value, directory):
+    """Renders the tiles of one zoom level, returns the number of tiles."""
+    first_x, first_y, last_x, last_y = tile_range(bounds, zoom)
+    min_x, _, _, max_y = tile_bounds(zoom, first_x, first_y)
+    _, min_y, max_x, _ = tile_bounds(zoom, last_x, last_y)
+    columns = last_x - first_x + 1
+    rows = last_y - first_y + 1
+
+    # The band's own no data value is 0 in the downloader's output, which is
+    # no echo, so only the not scanned value must be taken for missing data
+    warped = gdal.Warp('', dataset, format='MEM', dstSRS='EPSG:3857',
+                       outputBounds=(min_x, min_y, max_x, max_y),
+                       width=columns * TILE_SIZE, height=rows * TILE_SIZE,
+                       resampleAlg='near',
+                       srcNodata=fill_value, dstNodata=fill_value,
+                       warpOptions=['INIT_DEST={}'.format(fill_value)])
+    data = warped.GetRasterBand(1).ReadAsArray()
+
+    for column in range(columns):
+        column_directory = os.path.join(directory, str(zoom), str(first_x + column))
+        if not os.path.isdir(column_directory):
+            os.makedirs(column_directory)
+        for row in range(rows):
+            write_tile(os.path.join(column_directory, '{}.png'.format(first_y + row)),
+                       data[row * TILE_SIZE:(row + 1) * TILE_SIZE,
+                            column * TILE_SIZE:(column + 1) * TILE_SIZE],
+                       color_table)
+    return columns * rows
+
+
+def render_tiles(path, product_info, directory, min_zoom=DEFAULT_MIN_ZOOM,
+                 max_zoom=DEFAULT_MAX_ZOOM):
+    dataset = tiff_reader.open_tiff(path)
+    if dataset.RasterCount != 1:
+        raise Exception("Exactly one band expected!")
+
+    fill_value = (product_info.get('dataScale') or {}).get(
+        'notScanned', tiff_reader.DEFAULT_FILL_VALUE)
+    color_table = gdal.ColorTable()
+    for value, color in enumerate(palette(product_info)):
+        color_table.SetColorEntry(value, color)
+
+    bounds = mercator_bounds(dataset)
+    tile_count = 0
+    for zoom in range(min_zoom, max_zoom + 1):
+        tile_count += render_zoom(dataset, zoom, bounds, color_table, fill_value, directory)
+
+    with open(os.path.join(directory, 'tiles.json'), 'w') as f:
+        json.dump({
+            'minZoom': min_zoom,
+            'maxZoom': max_zoom,
+            'tileSize': TILE_SIZE,
+            'bounds': bounds
+        }, f)
+    return tile_count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('path', help="product TIFF, possibly gzipped")
+    parser.add_argument('directory', help="directory to write the tiles into")
+    parser.add_argument('--min-zoom', type=int, default=DEFAULT_MIN_ZOOM)
+    parser.add_argument('--max-zoom', type=int, default=DEFAULT_MAX_ZOOM)
+    args = parser.parse_args()
+
+    additional_metadata = json.load(sys.stdin)
+    if not os.path.isdir(args.directory):
+        os.makedirs(args.directory)
+    count = render_tiles(args.path, additional_metadata.get('productInfo', {}), args.directory,
+                         args.min_zoom, args.max_zoom)
+    print(u"Wrote {} tiles into {}".format(count, args.directory), file=sys.stderr)
@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from osgeo import gdal, osr
+
+from raster_to_tiles import render_tiles
+
+
+_PRODUCT_INFO = {
+    'dataType': 'REFLECTIVITY',
+    'dataScale': {'offset': -32, 'step': 0.5, 'noEcho': 0, 'notScanned': 255}
+}
+
+
+def _write_product(path):
+    """Writes a product like the downloader does: no echo around an echo, nodata 0."""
+    data = np.zeros((100, 100), dtype=np.uint8)
+    data[40:60, 40:60] = 100
+    dataset = gdal.GetDriverByName('GTiff').Create(path, 100, 100, 1, gdal.GDT_Byte)
+    dataset.SetGeoTransform((24.0, 0.01, 0, 61.0, 0, -0.01))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    dataset.SetProjection(srs.ExportToWkt())
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(0)
+    band.WriteArray(data)
+    dataset = None
+
+
+class TestRenderTiles(unittest.TestCase):
+    def test_no_echo_is_not_rendered_as_not_scanned(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'product.tiff')
+            _write_product(path)
+            tiles = os.path.join(directory, 'tiles')
+            os.makedirs(tiles)
+
+            self.assertEqual(render_tiles(path, _PRODUCT_INFO, tiles, 5, 5), 1)
+
+            values = set()
+            for root, _, filenames in os.walk(tiles):
+                for filename in filenames:
+                    if filename.endswith('.png'):
+                        tile = gdal.Open(os.path.join(root, filename))
+                        values.update(np.unique(tile.GetRasterBand(1).ReadAsArray()).tolist())
+                        tile = None
+            self.assertEqual(values, {0, 100, 255})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""Sequencer encoding consecutive products into one animation sequence.
+
+Used with `collect.py --sequencer`: the TIFF paths of the frames are the
+arguments in time order, additional metadata is read as JSON from stdin and
+the sequence is written to stdout. The metadata is as for the exporters,
+along with "times" and "urls" of the frames.
+
+Most of a frame is the same as the frame before it (no echo, not scanned),
+so only every --keyframe-interval'th frame is stored as a whole. The frames
+in between only store the runs of pixels that differ from the previous
+frame. The format is little-endian:
+
+    offset  size   field
+    0       4      magic, b'PPIS'
+    4       2      format version, 1
+    6       2      number of frames
+    8       4      width
+    12      4      height
+    16      48     affine transform, 6 float64s
+    64      4      length of the metadata JSON in bytes
+    68      n      metadata JSON (UTF-8), like in raster_to_binary.py
+
+followed by the frames, each of which is
+
+    0       1      frame type, 0 = keyframe, 1 = delta
+    1       4      length of the frame payload in bytes
+    5       m      frame payload
+
+A keyframe payload is the frame's data laid out like the raw payload of
+raster_to_binary.py. A delta payload is a list of runs, each of which is
+
+    0       4      number of pixels to skip after the previous run
+    4       4      number of pixels in the run, k
+    8       k      the pixel values of the run
+
+and the frame is the previous frame with the pixels of the runs replaced.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import struct
+import sys
+
+import numpy as np
+
+import tiff_reader
+
+
+MAGIC = b'PPIS'
+VERSION = 1
+
+FRAME_KEY = 0
+FRAME_DELTA = 1
+
+DEFAULT_KEYFRAME_INTERVAL = 6
+
+# Runs closer to each other than this are merged, as it takes less space to
+# repeat the unchanged pixels than to start a new run
+_RUN_MERGE_DISTANCE = 8
+
+_HEADER = struct.Struct('<4sHHII6dI')
+_FRAME_HEADER = struct.Struct('<BI')
+_RUN_HEADER = struct.Struct('<II')
+
+
+def delta_runs(previous, current):
+    """Returns the runs of current differing from previous as bytes."""
+    previous = previous.ravel()
+    current = current.ravel()
+    changed = np.flatnonzero(previous != current)
+    if len(changed) == 0:
+        return b''
+
+    breaks = np.flatnonzero(np.diff(changed) > _RUN_MERGE_DISTANCE) + 1
+    starts = changed[np.concatenate(([0], breaks))]
+    ends = changed[np.concatenate((breaks - 1, [len(changed) - 1]))] + 1
+
+    result = []
+    position = 0
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        result.append(_RUN_HEADER.pack(start - position, end - start))
+        result.append(current[start:end].tobytes())
+        position = end
+    return b''.join(result)
+
+
+def encode_sequence(rasters, metadata, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL):
+    """Returns the sequence of rasters as bytes in the sequence format."""
+    first = rasters[0]
+    for raster in rasters:
+        if len(raster.bands) != 1:
+            raise ValueError("Exactly one band expected!")
+        if ((raster.width, raster.height, tuple(raster.affine_transform)) !=
+                (first.width, first.height, tuple(first.affine_transform))):
+            raise ValueError("All frames must share the same grid")
+
+    metadata = dict(metadata)
+    metadata['width'] = first.width
+    metadata['height'] = first.height
+    metadata['projectionRef'] = first.projection_ref
+    metadata['affineTransform'] = first.affine_transform
+    metadata_json = json.dumps(metadata).encode('utf-8')
+
+    result = [_HEADER.pack(MAGIC, VERSION, len(rasters), first.width, first.height,
+                           *first.affine_transform, len(metadata_json)),
+              metadata_json]
+    previous = None
+    for index, raster in enumerate(rasters):
+        data = raster.bands[0].data
+        if previous is None or index % keyframe_interval == 0:
+            frame_type, payload = FRAME_KEY, data.tobytes(order='C')
+        else:
+            frame_type, payload = FRAME_DELTA, delta_runs(previous, data)
+        result.append(_FRAME_HEADER.pack(frame_type, len(payload)))
+        result.append(payload)
+        previous = data
+    return b''.join(result)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='+', help="frames in time order")
+    parser.add_argument('--keyframe-interval', type=int, default=DEFAULT_KEYFRAME_INTERVAL)
+    args = parser.parse_args()
+
+    additional_metadata = json.load(sys.stdin)
+    rasters = [tiff_reader.read_tiff(path) for path in args.paths]
+    sys.stdout.buffer.write(encode_sequence(rasters, additional_metadata,
+                                            args.keyframe_interval))
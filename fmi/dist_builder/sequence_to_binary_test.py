@@ -0,0 +1,103 @@
+import unittest
+
+import numpy as np
+
+import tiff_reader
+from sequence_to_binary import (FRAME_DELTA, FRAME_KEY, MAGIC, _FRAME_HEADER, _HEADER,
+                                _RUN_HEADER, delta_runs, encode_sequence)
+
+
+def _apply_runs(previous, payload):
+    """Applies a delta payload to the previous frame, like the client does."""
+    frame = bytearray(previous)
+    runs = []
+    pixel = 0
+    position = 0
+    while position < len(payload):
+        skip, length = _RUN_HEADER.unpack_from(payload, position)
+        position += _RUN_HEADER.size
+        pixel += skip
+        frame[pixel:pixel + length] = payload[position:position + length]
+        runs.append((skip, length))
+        position += length
+        pixel += length
+    return runs, bytes(frame)
+
+
+def _raster(data):
+    band = tiff_reader.Band(no_data_value=0, unit_type='', scale=1, offset=0, data=data)
+    return tiff_reader.Raster(width=data.shape[0], height=data.shape[1], projection_ref='',
+                              affine_transform=(24.0, 0.1, 0.0, 61.0, 0.0, -0.1), bands=[band])
+
+
+class TestDeltaRuns(unittest.TestCase):
+    def test_round_trip(self):
+        random = np.random.RandomState(0)
+        previous = random.randint(0, 4, size=(13, 11)).astype(np.uint8)
+        current = previous.copy()
+        current[random.rand(13, 11) < 0.1] = 200
+
+        _, frame = _apply_runs(previous.tobytes(), delta_runs(previous, current))
+
+        self.assertEqual(frame, current.tobytes())
+
+    def test_unchanged(self):
+        data = np.ones((3, 3), dtype=np.uint8)
+        self.assertEqual(delta_runs(data, data.copy()), b'')
+
+    def test_close_changes_are_merged(self):
+        previous = np.zeros((1, 40), dtype=np.uint8)
+        current = previous.copy()
+        # 7 unchanged pixels in between merge, 8 don't
+        current[0, [2, 10, 19]] = 1
+
+        runs, frame = _apply_runs(previous.tobytes(), delta_runs(previous, current))
+
+        self.assertEqual(runs, [(2, 9), (8, 1)])
+        self.assertEqual(frame, current.tobytes())
+
+    def test_runs_span_rows(self):
+        previous = np.zeros((3, 4), dtype=np.uint8)
+        current = previous.copy()
+        current[0, 3] = 1
+        current[1, 0] = 2
+
+        runs, frame = _apply_runs(previous.tobytes(), delta_runs(previous, current))
+
+        self.assertEqual(runs, [(3, 2)])
+        self.assertEqual(frame, current.tobytes())
+
+
+class TestEncodeSequence(unittest.TestCase):
+    def test_keyframes_and_deltas(self):
+        frames = [np.full((4, 3), value, dtype=np.uint8) for value in range(5)]
+
+        sequence = encode_sequence([_raster(f) for f in frames], {}, keyframe_interval=3)
+
+        header = _HEADER.unpack_from(sequence)
+        self.assertEqual(header[:5], (MAGIC, 1, 5, 4, 3))
+        position = _HEADER.size + header[-1]
+        decoded = []
+        frame_types = []
+        while position < len(sequence):
+            frame_type, length = _FRAME_HEADER.unpack_from(sequence, position)
+            position += _FRAME_HEADER.size
+            payload = sequence[position:position + length]
+            position += length
+            if frame_type == FRAME_KEY:
+                decoded.append(bytes(payload))
+            else:
+                decoded.append(_apply_runs(decoded[-1], payload)[1])
+            frame_types.append(frame_type)
+
+        self.assertEqual(frame_types, [FRAME_KEY, FRAME_DELTA, FRAME_DELTA, FRAME_KEY, FRAME_DELTA])
+        self.assertEqual(decoded, [f.tobytes() for f in frames])
+
+    def test_frames_must_share_the_grid(self):
+        with self.assertRaises(ValueError):
+            encode_sequence([_raster(np.zeros((2, 2), dtype=np.uint8)),
+                             _raster(np.zeros((3, 2), dtype=np.uint8))], {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,12 +4,10 @@ Reader for gzipped TIFFs.
 from __future__ import print_function
 
 import collections
-import gzip
-import struct
 import sys
-import tempfile
 
-import gdal
+import numpy as np
+from osgeo import gdal
 gdal.UseExceptions()
 
 
@@ -18,6 +16,12 @@ Raster = collections.namedtuple('Raster', ['width', 'height', 'projection_ref',
 Band = collections.namedtuple('Band', ['no_data_value', 'unit_type', 'scale', 'offset', 'data'])
 
 
+# Used for pixels in blocks GDAL can't read, whatever no data value the band
+# declares: nothing is known about them, which is what FMI products mark as
+# "not scanned" (no data, 0, means no echo in downloaded products).
+DEFAULT_FILL_VALUE = 255
+
+
 def extract_metadata(gdal_object):
     result = {}
     for i in dir(gdal_object):
@@ -32,80 +36,92 @@ def extract_metadata(gdal_object):
                 v = getattr(gdal_object, i)()
                 print(u"###### KEY:{} == VALUE:{}".format(k, v))
                 result[k] = v
-            except TypeError, te:
+            except TypeError:
                 pass
     return result
 
 
-def gdal_to_raster(gdal_raster):
+def _is_missing_block_error(e):
+    # Older GDAL versions report the block with the former message, newer
+    # ones with the latter
+    return ("GetBlockRef failed at X block offset" in str(e) or
+            "IReadBlock failed at X offset" in str(e))
+
+
+def read_band_blocks(band, fill_value):
+    """Reads a band block by block into a (height, width) uint8 array.
+
+    Blocks GDAL fails to read are filled with fill_value as a whole instead of
+    failing the entire read.
+    """
+    width, height = band.XSize, band.YSize
+    block_width, block_height = band.GetBlockSize()
+
+    result = np.full((height, width), fill_value, dtype=np.uint8)
+    for y in range(0, height, block_height):
+        y_size = min(block_height, height - y)
+        for x in range(0, width, block_width):
+            x_size = min(block_width, width - x)
+            try:
+                result[y:y + y_size, x:x + x_size] = band.ReadAsArray(x, y, x_size, y_size)
+            except RuntimeError as e:
+                if not _is_missing_block_error(e):
+                    raise e
+    return result
+
+
+def read_band(band, fill_value=DEFAULT_FILL_VALUE):
+    """Reads a whole band as a uint8 array indexed as data[x][y].
+
+    The indexing matches what the exporters have always produced: the outer
+    dimension is x (columns), the inner one y (rows). Blocks GDAL can't read
+    are filled with fill_value.
+    """
+    data_type = gdal.GetDataTypeName(band.DataType)
+    if data_type != 'Byte':
+        raise Exception("Unhandled element type: " + data_type)
+
+    try:
+        data = band.ReadAsArray().astype(np.uint8, copy=False)
+    except RuntimeError as e:
+        if not _is_missing_block_error(e):
+            raise e
+        data = read_band_blocks(band, fill_value)
+
+    return data.T
+
+
+def gdal_to_raster(gdal_raster, fill_value=DEFAULT_FILL_VALUE):
     width = gdal_raster.RasterXSize
     height = gdal_raster.RasterYSize
     band_count = gdal_raster.RasterCount
     projection_ref = gdal_raster.GetProjectionRef()
-    transform =  gdal_raster.GetGeoTransform()
-    # print width, height, band_count
+    transform = gdal_raster.GetGeoTransform()
 
     bands = []
-    for i in xrange(1, band_count + 1):
-        # print i
+    for i in range(1, band_count + 1):
         band = gdal_raster.GetRasterBand(i)
-        # print band
-        data_type = gdal.GetDataTypeName(band.DataType)
-
-        # print(extract_metadata(band))
-        # sys.exit()
-
-        rows = []
-        for x in xrange(width):
-            row = []
-            rows.append(row)
-            for y in xrange(height):
-                try:
-                    value_array = band.ReadRaster(x, y, 1, 1)
-                except RuntimeError, e:
-                    if "GetBlockRef failed at X block offset" in str(e):
-                        value_array = None
-                    else:
-                        raise e
-                if data_type != 'Byte':
-                    raise Exception("Unhandled element type: " + data_type)
-
-                if value_array is None:
-                    value = None
-                else:
-                    value = struct.unpack('B', value_array[0])[0]
-
-                row.append(value)
-            # grid = band.ReadRaster(0, 0, width, height)
-            # print grid
-
         bands.append(
             Band(
                 no_data_value=band.GetNoDataValue(),
                 unit_type=band.GetUnitType(),
                 offset=band.GetOffset(),
                 scale=band.GetScale(),
-                data=rows))
-
-
-        # print dir(gdal_raster)
-        # print gdal_raster.GetMetadata()
+                data=read_band(band, fill_value)))
 
     return Raster(width=width, height=height, projection_ref=projection_ref,
                   affine_transform=transform, bands=bands)
 
 
-def read_tiff(path):
+def open_tiff(path):
+    """Opens a possibly gzipped TIFF as a GDAL dataset."""
     if path.endswith('.gz'):
-        with gzip.open(path, 'rb') as input_file:
-            file_contents = input_file.read()
-            with tempfile.NamedTemporaryFile() as temp_file:
-                temp_file.write(file_contents)
-                gdal_raster = gdal.Open(temp_file.name)
-                return gdal_to_raster(gdal_raster)
-    else:
-        gdal_raster = gdal.Open(path)
-        return gdal_to_raster(gdal_raster)
+        path = '/vsigzip/' + path
+    return gdal.Open(path)
+
+
+def read_tiff(path, fill_value=DEFAULT_FILL_VALUE):
+    return gdal_to_raster(open_tiff(path), fill_value)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,72 @@
+import unittest
+
+import numpy as np
+from osgeo import gdal
+
+import tiff_reader
+
+
+def _write_tiff(path, data, options=(), no_data_value=None):
+    """Writes data, indexed as data[y][x] like GDAL does, as a single band GTiff."""
+    height, width = data.shape
+    dataset = gdal.GetDriverByName('GTiff').Create(path, width, height, 1, gdal.GDT_Byte,
+                                                   options=list(options))
+    band = dataset.GetRasterBand(1)
+    if no_data_value is not None:
+        band.SetNoDataValue(no_data_value)
+    band.WriteArray(data)
+    dataset = None
+
+
+def _damage_block(path, x_block, y_block):
+    """Overwrites the compressed data of a block with garbage."""
+    dataset = gdal.Open(path)
+    band = dataset.GetRasterBand(1)
+    offset = int(band.GetMetadataItem('BLOCK_OFFSET_{}_{}'.format(x_block, y_block), 'TIFF'))
+    size = int(band.GetMetadataItem('BLOCK_SIZE_{}_{}'.format(x_block, y_block), 'TIFF'))
+    dataset = None
+
+    f = gdal.VSIFOpenL(path, 'r+b')
+    gdal.VSIFSeekL(f, offset, 0)
+    gdal.VSIFWriteL(b'\xff' * size, 1, size, f)
+    gdal.VSIFCloseL(f)
+
+
+class TestReadBand(unittest.TestCase):
+    def setUp(self):
+        self.path = '/vsimem/tiff_reader_test_{}.tiff'.format(id(self))
+
+    def tearDown(self):
+        gdal.Unlink(self.path)
+
+    def test_data_is_indexed_by_x_first(self):
+        data = np.arange(6, dtype=np.uint8).reshape((2, 3))
+        _write_tiff(self.path, data)
+
+        raster = tiff_reader.read_tiff(self.path)
+
+        band_data = raster.bands[0].data
+        self.assertEqual((raster.width, raster.height), (3, 2))
+        self.assertEqual(band_data.shape, (3, 2))
+        for y in range(2):
+            for x in range(3):
+                self.assertEqual(band_data[x][y], data[y][x])
+
+    def test_unreadable_block_is_not_scanned(self):
+        data = np.full((32, 32), 7, dtype=np.uint8)
+        # No data is no echo in downloaded products, unreadable blocks still
+        # mustn't be filled with it
+        _write_tiff(self.path, data, no_data_value=0,
+                    options=['TILED=YES', 'BLOCKXSIZE=16', 'BLOCKYSIZE=16', 'COMPRESS=DEFLATE'])
+        _damage_block(self.path, 1, 0)
+
+        band_data = tiff_reader.read_band(gdal.Open(self.path).GetRasterBand(1))
+
+        expected = np.full((32, 32), 7, dtype=np.uint8)
+        expected[16:32, 0:16] = tiff_reader.DEFAULT_FILL_VALUE
+        np.testing.assert_array_equal(band_data, expected)
+        self.assertEqual(tiff_reader.DEFAULT_FILL_VALUE, 255)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,23 @@
+import concurrent.futures
+import concurrent.futures.process
 import datetime
+import gzip
 import json
+import multiprocessing
 import operator
 import os
+import io
+import shutil
+import signal
 import subprocess
 import sys
+import threading
+import time
 import traceback
 import dataclasses
+import hashlib
 import typing
+import uuid
 
 from os import getcwd, unlink, makedirs
 from os.path import join as path_join
@@ -20,6 +31,14 @@ from botocore.client import Config
 
 import dateutil.parser
 
+import numpy as np
+from osgeo import gdal
+gdal.UseExceptions()
+
+# metrics.py is shared by all the components and lives in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from metrics import Metrics
+
 
 SITE_NAMES = {
     'fianj': 'Anjalankoski',
@@ -44,12 +63,38 @@ DEFAULT_SITES = sorted(SITE_NAMES.keys())
 _product_bucket = 'fmi-opendata-radar-geotiff'
 
 
+DEFAULT_DOWNLOAD_CONCURRENCY = 8
+DEFAULT_WARP_CONCURRENCY = os.cpu_count() or 1
+
+# Per-site listing watermarks are kept here, next to the configuration file
+# unless configured otherwise. Must not be in output-directory as everything
+# ending in .json there is taken for product metadata.
+DEFAULT_STATE_FILENAME = 'listing_state.json'
+# Likewise for cached warp grids
+DEFAULT_WARP_CACHE_DIRNAME = 'warp_cache'
+WATERMARK_LOOKBACK = datetime.timedelta(minutes=15)
+
+# Seconds between listings in daemon mode
+DEFAULT_POLL_INTERVAL = 60
+
+
 sample_config = """
 [fmi_s3_product_download]
 sites = %s
 side-length = %s
 output-directory = %s
-""" % (", ".join(DEFAULT_SITES), 1000, os.getcwd())
+download-concurrency = %s
+warp-concurrency = %s
+state-file = %s
+warp-cache-directory = %s
+# Remove the products downloaded more than this many hours ago
+# retention-hours = 48
+# Append stage timings of each round as JSON lines / write them for Prometheus
+# metrics-file = /var/log/ppi/metrics.jsonl
+# prometheus-file = /var/lib/node_exporter/textfile_collector/ppi_downloader.prom
+""" % (", ".join(DEFAULT_SITES), 1000, os.getcwd(), DEFAULT_DOWNLOAD_CONCURRENCY,
+       DEFAULT_WARP_CONCURRENCY, path_join(os.getcwd(), DEFAULT_STATE_FILENAME),
+       path_join(os.getcwd(), DEFAULT_WARP_CACHE_DIRNAME))
 
 
 @dataclasses.dataclass
@@ -252,23 +297,18 @@ class Product:
         return '.'.join(self.filename.split('.')[:-1])
 
 
-def list_objects(client, bucket, prefix):
+def list_objects(client, bucket, prefix, start_after=None):
     result = []
     continuation_token = None
     while True:
+        kwargs = {'Bucket': _product_bucket, 'Prefix': prefix}
         if continuation_token:
-            response = client.list_objects_v2(
-                Bucket=_product_bucket,
-                Prefix=prefix,
-                ContinuationToken=continuation_token
-            )
-        else:
-            response = client.list_objects_v2(
-                Bucket=_product_bucket,
-                Prefix=prefix
-            )
+            kwargs['ContinuationToken'] = continuation_token
+        elif start_after:
+            kwargs['StartAfter'] = start_after
+        response = client.list_objects_v2(**kwargs)
 
-        for entry in response['Contents']:
+        for entry in response.get('Contents', []):
             result.append(entry)
 
         if 'NextContinuationToken' in response:
@@ -279,46 +319,127 @@ def list_objects(client, bucket, prefix):
     return result
 
 
-def fetch_product_list(sites=DEFAULT_SITES):
-    client = boto3.client('s3', config=Config(signature_version=UNSIGNED))
+def listing_start_after(watermark, prefix):
+    """Resolves the key to start listing prefix after, or None for a full listing.
+
+    Keys within a site prefix start with the product timestamp, so listing
+    after the last seen key only returns newer products. As products of one
+    timestamp don't all appear at the same time, the listing starts
+    WATERMARK_LOOKBACK before the timestamp of the last seen key.
+    A watermark from another prefix (i.e. another day) means a full listing.
+    """
+    if not watermark or watermark.get('prefix') != prefix:
+        return None
+
+    filename = watermark['last_key'][len(prefix):]
+    try:
+        last_seen = dt.strptime(filename.split('_')[0], '%Y%m%d%H%M')
+    except ValueError:
+        return None
+    return prefix + (last_seen - WATERMARK_LOOKBACK).strftime('%Y%m%d%H%M')
+
+
+def load_watermarks(path):
+    if not path or not path_exists(path):
+        return {}
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except ValueError:
+        traceback.print_exc()
+        print(f'Ignoring unreadable listing state {path}', file=sys.stderr)
+        return {}
+
+
+def save_watermarks(path, watermarks):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(watermarks, f, indent=4, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+def make_client(max_pool_connections=DEFAULT_DOWNLOAD_CONCURRENCY):
+    """Creates an anonymous S3 client that can be shared between threads."""
+    return boto3.client('s3', config=Config(
+        signature_version=UNSIGNED,
+        max_pool_connections=max_pool_connections
+    ))
 
+
+def latest_site_products(client, site, date_prefix, watermarks=None, listed_watermarks=None):
+    """Returns [s3_key, product] pairs for the latest products of site.
+
+    If watermarks is given, only objects newer than the site's watermark in
+    it are listed. The watermark of the last object listed is put into
+    listed_watermarks, if given, for moving the site's watermark to once
+    its products have been downloaded.
+    """
     result = []
-    for site in sites:
-        try:
-            date_prefix = dt.now(datetime.UTC).strftime('%Y/%m/%d')
-            prefix = f'{date_prefix}/{site}/'
-            raw_entries = list_objects(client, _product_bucket, prefix)
-
-            entries_by_filename = { entry['Key'].split('/')[-1]: entry['Key'] for entry in raw_entries }
-            entries = { p: Product.from_filename(p) for p in entries_by_filename.keys() }
-
-            supported_data_scale = [p for p in entries.values() if p.data_scale is not None]
-
-            # Collect PPIs
-            desired_elevations = sorted(list(set([p.elevation for p in supported_data_scale if p.elevation])))
-            for elevation in desired_elevations:
-                elevation_ppis = [p for p in supported_data_scale if p.elevation == elevation]
-                unique_data_types = set([p.data_type for p in elevation_ppis])
-                for data_type in unique_data_types:
-                    latest = sorted(
-                        [p for p in elevation_ppis if p.data_type == data_type],
-                        key=lambda e: e.timestamp,
-                        reverse=True
-                    )[0]
-                    s3_key = entries_by_filename[latest.filename]
-                    result.append([s3_key, latest])
-
-            # Collect CAPPIs
-            desired_heights = sorted(list(set([p.height for p in supported_data_scale if p.height])))
-            for height in desired_heights:
-                height_cappis = [p for p in supported_data_scale if p.height == height]
-                latest = sorted(height_cappis, key=lambda e: e.timestamp, reverse=True)[0]
-                s3_key = entries_by_filename[latest.filename]
-                result.append([s3_key, latest])
+    prefix = f'{date_prefix}/{site}/'
+    start_after = None
+    if watermarks is not None:
+        start_after = listing_start_after(watermarks.get(site), prefix)
+    raw_entries = list_objects(client, _product_bucket, prefix, start_after)
+    if listed_watermarks is not None and raw_entries:
+        listed_watermarks[site] = {'prefix': prefix, 'last_key': raw_entries[-1]['Key']}
+
+    entries_by_filename = { entry['Key'].split('/')[-1]: entry['Key'] for entry in raw_entries }
+    entries = { p: Product.from_filename(p) for p in entries_by_filename.keys() }
+
+    supported_data_scale = [p for p in entries.values() if p.data_scale is not None]
+
+    # Collect PPIs
+    desired_elevations = sorted(list(set([p.elevation for p in supported_data_scale if p.elevation])))
+    for elevation in desired_elevations:
+        elevation_ppis = [p for p in supported_data_scale if p.elevation == elevation]
+        unique_data_types = sorted(set([p.data_type for p in elevation_ppis]))
+        for data_type in unique_data_types:
+            latest = sorted(
+                [p for p in elevation_ppis if p.data_type == data_type],
+                key=lambda e: e.timestamp,
+                reverse=True
+            )[0]
+            s3_key = entries_by_filename[latest.filename]
+            result.append([s3_key, latest])
+
+    # Collect CAPPIs
+    desired_heights = sorted(list(set([p.height for p in supported_data_scale if p.height])))
+    for height in desired_heights:
+        height_cappis = [p for p in supported_data_scale if p.height == height]
+        latest = sorted(height_cappis, key=lambda e: e.timestamp, reverse=True)[0]
+        s3_key = entries_by_filename[latest.filename]
+        result.append([s3_key, latest])
+
+    return result
+
+
+def fetch_product_list(sites=DEFAULT_SITES, client=None, concurrency=DEFAULT_DOWNLOAD_CONCURRENCY,
+                       watermarks=None, listed_watermarks=None):
+    """Lists the latest products of all sites.
+
+    Sites are listed concurrently with at most concurrency requests in
+    flight. The result is in the order of sites regardless of which listing
+    finishes first. See latest_site_products for watermarks and
+    listed_watermarks.
+    """
+    if client is None:
+        client = make_client(concurrency)
+
+    date_prefix = dt.now(datetime.UTC).strftime('%Y/%m/%d')
 
+    def list_site(site):
+        try:
+            return latest_site_products(client, site, date_prefix, watermarks,
+                                        listed_watermarks)
         except Exception as e:
             traceback.print_exc()
             print(f'Failed to resolve latest product for site {site}, continuing...', file=sys.stderr)
+            return []
+
+    result = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for site_products in executor.map(list_site, sites):
+            result.extend(site_products)
 
     return result
 
@@ -332,10 +453,24 @@ def read_configuration(path):
  
     get = lambda key: config.get("fmi_s3_product_download", key)
 
+    getint = lambda key, fallback: config.getint("fmi_s3_product_download", key, fallback=fallback)
+
     return {
         "sites": [s.strip() for s in get("sites").split(',')],
         "side-length": int(get("side-length")),
-        "output-directory": get("output-directory")
+        "output-directory": get("output-directory"),
+        "download-concurrency": getint("download-concurrency", DEFAULT_DOWNLOAD_CONCURRENCY),
+        "warp-concurrency": getint("warp-concurrency", DEFAULT_WARP_CONCURRENCY),
+        "state-file": config.get("fmi_s3_product_download", "state-file",
+                                 fallback=path_join(os.path.dirname(os.path.abspath(path)),
+                                                    DEFAULT_STATE_FILENAME)),
+        "warp-cache-directory": config.get("fmi_s3_product_download", "warp-cache-directory",
+                                           fallback=path_join(os.path.dirname(os.path.abspath(path)),
+                                                              DEFAULT_WARP_CACHE_DIRNAME)),
+        "retention-hours": config.getfloat("fmi_s3_product_download", "retention-hours",
+                                           fallback=None),
+        "metrics-file": config.get("fmi_s3_product_download", "metrics-file", fallback=None),
+        "prometheus-file": config.get("fmi_s3_product_download", "prometheus-file", fallback=None)
     }
 
 
@@ -349,68 +484,474 @@ def default(obj):
         raise Exception("Unknown type")
 
 
-def download(dry_run, configuration):
-    s3_keys_and_products = fetch_product_list(sites=configuration['sites'])
+def _product_paths(configuration, product, now):
+    dir_part = [configuration['output-directory'], str(now.year), str(now.month), str(now.day)]
+    if not path_exists(path_join(*dir_part)):
+        makedirs(path_join(*dir_part), exist_ok=True)
 
-    newest_products = {}
-    for [s3_key, p] in s3_keys_and_products:
-        key = p.site, p.product_type, p.product_subtype
-        _, newest_currently = newest_products.get(key, [None, None])
-        if newest_currently is None or newest_currently.timestamp < p.timestamp:
-            newest_products[key] = [s3_key, p]
+    return {
+        'json': path_join(*(dir_part + [product.extensionless_filename() + ".json"])),
+        'reproj_tiff': path_join(*(dir_part + [product.extensionless_filename() + ".tiff"]))
+    }
 
-    client = boto3.client('s3', config=Config(signature_version=UNSIGNED))
 
-    for index, s3_key_and_product in enumerate(newest_products.values()):
-        s3_key, product = s3_key_and_product
-        if not dry_run:
-            now = dt.now(datetime.UTC)
-            dir_part = [configuration['output-directory'], str(now.year), str(now.month), str(now.day)]
-            if not path_exists(path_join(*dir_part)):
-                makedirs(path_join(*dir_part))
+def remove_old_days(output_directory, retention, now):
+    """Removes the day directories of output_directory older than retention.
 
-            json_dest_path = path_join(*(dir_part + [product.extensionless_filename() + ".json"]))
-            orig_tiff_dest_path = path_join(*(dir_part + [product.extensionless_filename() + ".orig.tiff"]))
-            reproj_tiff_dest_path = path_join(*(dir_part + [product.extensionless_filename() + ".tiff"]))
+    Products are downloaded into '<year>/<month>/<day>' directories by the
+    day they were downloaded on (see _product_paths), so whole days can be
+    removed once the last moment of the day is older than retention. Emptied
+    month and year directories are removed as well.
 
-            if path_exists(json_dest_path):
-                print("%s already exists, not downloading %s" % (json_dest_path, s3_key),
+    Returns the removed day directories.
+    """
+    oldest = now - retention
+    removed = []
+    for year in sorted(os.listdir(output_directory)):
+        year_path = path_join(output_directory, year)
+        if not year.isdigit() or not os.path.isdir(year_path):
+            continue
+        for month in sorted(os.listdir(year_path)):
+            month_path = path_join(year_path, month)
+            if not month.isdigit() or not os.path.isdir(month_path):
+                continue
+            for day in sorted(os.listdir(month_path)):
+                day_path = path_join(month_path, day)
+                if not day.isdigit() or not os.path.isdir(day_path):
+                    continue
+                try:
+                    day_end = dt(int(year), int(month), int(day), tzinfo=timezone.utc) + \
+                        datetime.timedelta(days=1)
+                except ValueError:
+                    continue
+                if day_end <= oldest:
+                    shutil.rmtree(day_path)
+                    removed.append(day_path)
+            if not os.listdir(month_path):
+                os.rmdir(month_path)
+        if not os.listdir(year_path):
+            os.rmdir(year_path)
+    return removed
+
+
+def download_product(client, s3_key):
+    """Downloads the product in s3_key into memory, returns it as bytes."""
+    buffer = io.BytesIO()
+    client.download_fileobj(_product_bucket, s3_key, buffer)
+    print(f'Downloaded {s3_key} ({buffer.tell()} bytes)', file=sys.stderr)
+    return buffer.getvalue()
+
+
+# Warp grids already loaded or computed by this process, by cache key
+_warp_grids = {}
+
+
+def _warp_size(source_ds, side_length):
+    sizes = [source_ds.RasterXSize, source_ds.RasterYSize]
+    min_dimension = min(sizes)
+    coef = side_length / float(min_dimension)
+    return [int(coef * size) for size in sizes]
+
+
+def _compute_warp_grid(source_ds, side_length):
+    """Warps the flat pixel indices of source_ds instead of its values.
+
+    The result maps every destination pixel to the index of the source pixel
+    the nearest neighbour warp would take its value from, -1 if none.
+    """
+    width, height = source_ds.RasterXSize, source_ds.RasterYSize
+    index_ds = gdal.GetDriverByName('MEM').Create('', width, height, 1, gdal.GDT_Int32)
+    index_ds.SetGeoTransform(source_ds.GetGeoTransform())
+    index_ds.SetProjection(source_ds.GetProjection())
+    index_ds.GetRasterBand(1).WriteArray(
+        np.arange(width * height, dtype=np.int32).reshape(height, width))
+
+    dims = _warp_size(source_ds, side_length)
+    warped = gdal.Warp(
+        '', index_ds,
+        format='MEM',
+        dstSRS='EPSG:4326',
+        width=dims[0], height=dims[1],
+        dstNodata=-1,
+        warpOptions=['INIT_DEST=NO_DATA']
+    )
+    return {
+        'index': warped.GetRasterBand(1).ReadAsArray(),
+        'geotransform': np.array(warped.GetGeoTransform()),
+        'projection': np.array(warped.GetProjection())
+    }
+
+
+def warp_grid(source_ds, side_length, site, cache_directory):
+    """Returns the warp grid for source_ds, computing and caching it if needed.
+
+    Grids are keyed by the site, the source geotransform, projection and size
+    and side_length and persisted as .npz files in cache_directory.
+    """
+    key_source = json.dumps([
+        site, source_ds.GetGeoTransform(), source_ds.GetProjection(),
+        source_ds.RasterXSize, source_ds.RasterYSize, side_length
+    ])
+    key = f'{site}_{side_length}_{hashlib.sha1(key_source.encode("utf-8")).hexdigest()[:16]}'
+
+    if key in _warp_grids:
+        return _warp_grids[key]
+
+    cache_path = path_join(cache_directory, key + '.npz')
+    if path_exists(cache_path):
+        with np.load(cache_path) as f:
+            grid = {k: f[k] for k in f.files}
+    else:
+        grid = _compute_warp_grid(source_ds, side_length)
+        makedirs(cache_directory, exist_ok=True)
+        # Written under a temporary name as other processes may be computing
+        # the same grid
+        temp_path = path_join(cache_directory, f'{key}.{os.getpid()}.tmp.npz')
+        np.savez(temp_path, **grid)
+        os.replace(temp_path, cache_path)
+        print(f'Cached warp grid {cache_path}', file=sys.stderr)
+
+    _warp_grids[key] = grid
+    return grid
+
+
+def _warp_with_grid(source_ds, reproj_tiff_path, grid):
+    """Reprojects source_ds by gathering source pixels through the grid.
+
+    Produces what the nearest neighbour gdal.Warp in warp_product does:
+    source no data (255) and pixels outside the source are 255.
+    """
+    source = source_ds.GetRasterBand(1).ReadAsArray().ravel()
+    index = grid['index']
+
+    result = np.full(index.shape, 255, dtype=np.uint8)
+    valid = index >= 0
+    result[valid] = source[index[valid]]
+
+    height, width = index.shape
+    result_ds = gdal.GetDriverByName('GTiff').Create(
+        reproj_tiff_path, width, height, 1, gdal.GDT_Byte)
+    result_ds.SetGeoTransform(tuple(grid['geotransform']))
+    result_ds.SetProjection(str(grid['projection']))
+    band = result_ds.GetRasterBand(1)
+    band.SetNoDataValue(0)
+    band.WriteArray(result)
+    result_ds = None
+
+
+def warp_product(source, reproj_tiff_path, side_length, site=None, cache_directory=None,
+                 metrics=None):
+    """Reprojects the product in source (GeoTIFF bytes) into EPSG:4326.
+
+    The shorter side of the result is side_length pixels. Everything up to
+    writing the result into reproj_tiff_path happens in memory.
+
+    With a cache_directory, single band byte products are reprojected with a
+    cached warp grid (see warp_grid), as all products of a site share the
+    same source grid.
+
+    Opening the source and reprojecting it are timed into the 'gdalinfo' and
+    'gdalwarp' stages of metrics, if given, after the GDAL utilities they
+    used to be done with.
+    """
+    source_path = f'/vsimem/{uuid.uuid4().hex}.tiff'
+    gdal.FileFromMemBuffer(source_path, source)
+    try:
+        started = time.monotonic()
+        source_ds = gdal.Open(source_path)
+        if metrics is not None:
+            metrics.add('gdalinfo', time.monotonic() - started, bytes_in=len(source))
+
+        started = time.monotonic()
+        if path_exists(reproj_tiff_path):
+            unlink(reproj_tiff_path)
+
+        if (cache_directory and source_ds.RasterCount == 1 and
+                source_ds.GetRasterBand(1).DataType == gdal.GDT_Byte):
+            grid = warp_grid(source_ds, side_length, site, cache_directory)
+            _warp_with_grid(source_ds, reproj_tiff_path, grid)
+        else:
+            dims = _warp_size(source_ds, side_length)
+            result = gdal.Warp(
+                reproj_tiff_path, source_ds,
+                format='GTiff',
+                dstSRS='EPSG:4326',
+                width=dims[0], height=dims[1],
+                srcNodata=255,
+                dstNodata=0,
+                # https://lists.osgeo.org/pipermail/gdal-dev/2010-May/024553.html
+                warpOptions=['INIT_DEST=255']
+            )
+            # Closes and flushes the result
+            result = None
+        source_ds = None
+        if metrics is not None:
+            metrics.add('gdalwarp', time.monotonic() - started, bytes_in=len(source),
+                        bytes_out=os.path.getsize(reproj_tiff_path))
+    finally:
+        gdal.Unlink(source_path)
+    print(reproj_tiff_path, file=sys.stderr)
+
+
+def compress_file(path):
+    """Gzips path into '<path>.gz' and removes path. Returns the new path."""
+    compressed_path = path + '.gz'
+    temp_path = compressed_path + '.tmp'
+    with open(path, 'rb') as source, gzip.open(temp_path, 'wb') as target:
+        shutil.copyfileobj(source, target)
+    os.replace(temp_path, compressed_path)
+    unlink(path)
+    return compressed_path
+
+
+def warp_and_compress(source, reproj_tiff_path, side_length, site=None, cache_directory=None,
+                      compress=False):
+    """Runs warp_product, gzipping the result if compress is set.
+
+    Returns the path of the result and the Metrics stages of the work for
+    the parent process to merge.
+    """
+    metrics = Metrics(None)
+    warp_product(source, reproj_tiff_path, side_length, site, cache_directory, metrics)
+    if not compress:
+        return reproj_tiff_path, metrics.stages
+    size = os.path.getsize(reproj_tiff_path)
+    started = time.monotonic()
+    path = compress_file(reproj_tiff_path)
+    metrics.add('compress', time.monotonic() - started, bytes_in=size,
+                bytes_out=os.path.getsize(path))
+    return path, metrics.stages
+
+
+class Downloader:
+    """Downloads and reprojects the newest products of the configured sites.
+
+    Downloads run in a pool of 'download-concurrency' threads sharing one S3
+    client. Each finished download is handed to a separate pool of
+    'warp-concurrency' processes so that network transfers and reprojection
+    overlap.
+
+    The client, the pools (and so the warp grids cached in the warp
+    processes) and the listing watermarks are kept from one download round
+    to the next, so that a long-running process sets them up only once. If
+    a warp process dies, e.g. GDAL crashing on a bad product, the warps in
+    flight fail and the warp pool is replaced with a new one.
+    """
+
+    def __init__(self, configuration, compress=False):
+        self.configuration = configuration
+        self.compress = compress
+        self.client = make_client(configuration['download-concurrency'])
+        self.watermarks = load_watermarks(configuration['state-file'])
+        self.download_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=configuration['download-concurrency'])
+        self.warp_pool_lock = threading.Lock()
+        self.warp_pool = self._make_warp_pool()
+
+    def _make_warp_pool(self):
+        # Not forked, as the pool is first used from a download thread while
+        # other threads may be holding locks, e.g. the one of stderr
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.configuration['warp-concurrency'],
+            mp_context=multiprocessing.get_context('forkserver'))
+
+    def submit_warp(self, *args):
+        """Submits warp_and_compress to the warp pool, replacing the pool if it's broken."""
+        with self.warp_pool_lock:
+            pool = self.warp_pool
+        try:
+            return pool.submit(warp_and_compress, *args)
+        except concurrent.futures.process.BrokenProcessPool:
+            with self.warp_pool_lock:
+                if self.warp_pool is pool:
+                    print('A warp process died, starting new ones...', file=sys.stderr)
+                    pool.shutdown(wait=False)
+                    self.warp_pool = self._make_warp_pool()
+                pool = self.warp_pool
+            return pool.submit(warp_and_compress, *args)
+
+    def close(self):
+        self.download_pool.shutdown()
+        self.warp_pool.shutdown()
+
+    def download(self, dry_run=False):
+        """Downloads the products that are newer than what has been seen so far.
+
+        The path of each reprojected product is printed to stdout as soon
+        as it is ready. Returns the paths.
+
+        The listing watermark of a site is only advanced once all of its
+        products have been downloaded or found to exist already, so that
+        products failing to download are listed again in the next round.
+
+        The stages of the round are timed (see Metrics) into the configured
+        'metrics-file' and 'prometheus-file', if any.
+        """
+        configuration = self.configuration
+        metrics = Metrics('downloader')
+        started = time.monotonic()
+        listed_watermarks = {}
+        s3_keys_and_products = fetch_product_list(
+            sites=configuration['sites'],
+            client=self.client,
+            concurrency=configuration['download-concurrency'],
+            watermarks=self.watermarks,
+            listed_watermarks=listed_watermarks
+        )
+        metrics.add('list', time.monotonic() - started, count=len(configuration['sites']))
+
+        newest_products = {}
+        for [s3_key, p] in s3_keys_and_products:
+            key = p.site, p.product_type, p.product_subtype
+            _, newest_currently = newest_products.get(key, [None, None])
+            if newest_currently is None or newest_currently.timestamp < p.timestamp:
+                newest_products[key] = [s3_key, p]
+
+        now = dt.now(datetime.UTC)
+        latest_by_site = {}
+        for _, product in newest_products.values():
+            latest_by_site[product.site] = max(latest_by_site.get(product.site, product.timestamp),
+                                               product.timestamp)
+        for site, latest in sorted(latest_by_site.items()):
+            metrics.gauge('latest_product_age_seconds', round((now - latest).total_seconds(), 3),
+                          site=site)
+
+        def download_and_warp(s3_key, product, paths):
+            started = time.monotonic()
+            source = download_product(self.client, s3_key)
+            metrics.add('download', time.monotonic() - started, bytes_out=len(source))
+            return self.submit_warp(source, paths['reproj_tiff'], configuration['side-length'],
+                                    product.site, configuration['warp-cache-directory'],
+                                    self.compress)
+
+        downloads = {}
+        for s3_key, product in newest_products.values():
+            if dry_run:
+                json.dump(product.as_dict(), sys.stderr, default=default, ensure_ascii=False, indent=4)
+                print(file=sys.stderr)
+                continue
+
+            paths = _product_paths(configuration, product, now)
+            if path_exists(paths['json']):
+                print("%s already exists, not downloading %s" % (paths['json'], s3_key),
                       file=sys.stderr)
-            else:
-                if path_exists(orig_tiff_dest_path):
-                    unlink(orig_tiff_dest_path)
-                with open(orig_tiff_dest_path, 'wb') as f:
-                    client.download_fileobj(_product_bucket, s3_key, f)
-                print(orig_tiff_dest_path, file=sys.stderr)
-
-                info = json.loads(subprocess.check_output([
-                    'gdalinfo', '-json', orig_tiff_dest_path
-                ]))
-                sizes = info['size']
-                min_dimension = min(sizes)
-                desired_side_length = configuration['side-length']
-                coef = desired_side_length / float(min_dimension)
-                dims = [coef * size for size in sizes]
-
-                subprocess.check_call([
-                    'gdalwarp', '-overwrite', orig_tiff_dest_path, reproj_tiff_dest_path,
-                    '-t_srs', 'EPSG:4326',
-                    '-ts', str(int(dims[0])), str(int(dims[1])),
-                    '-srcnodata', '255',
-                    '-dstnodata', '0',
-                    # https://lists.osgeo.org/pipermail/gdal-dev/2010-May/024553.html
-                    '-wo', 'INIT_DEST=255'
-                ], stdout=subprocess.DEVNULL) # gdalwarp produces debug output into stdout...
-                unlink(orig_tiff_dest_path)
-                print(reproj_tiff_dest_path, file=sys.stderr)
-                print(reproj_tiff_dest_path)
-
-                with open(json_dest_path, 'w', encoding='utf-8') as f:
-                    json.dump(product.as_dict(), f, default=default, ensure_ascii=False, indent=4)
-
-        json.dump(product.as_dict(), sys.stderr, default=default, ensure_ascii=False, indent=4)
-        print(file=sys.stderr)
-        print("%i/%i" % (index + 1, len(newest_products)), file=sys.stderr)
+                continue
+
+            future = self.download_pool.submit(download_and_warp, s3_key, product, paths)
+            downloads[future] = (s3_key, product, paths)
+
+        failed_sites = set()
+        warps = {}
+        for future in concurrent.futures.as_completed(downloads):
+            s3_key, product, paths = downloads[future]
+            try:
+                warps[future.result()] = downloads[future]
+            except Exception:
+                traceback.print_exc()
+                print(f'Failed to download {s3_key}, continuing...', file=sys.stderr)
+                failed_sites.add(product.site)
+
+        result = []
+        for index, future in enumerate(concurrent.futures.as_completed(warps)):
+            s3_key, product, paths = warps[future]
+            try:
+                path, stages = future.result()
+                metrics.merge(stages)
+            except concurrent.futures.process.BrokenProcessPool:
+                # The pool gets replaced on the next submit
+                print(f'A warp process died while reprojecting {s3_key}, skipping it...',
+                      file=sys.stderr)
+                failed_sites.add(product.site)
+                continue
+            except Exception:
+                traceback.print_exc()
+                print(f'Failed to reproject {s3_key}, continuing...', file=sys.stderr)
+                failed_sites.add(product.site)
+                continue
+
+            print(path)
+            sys.stdout.flush()
+            with open(paths['json'], 'w', encoding='utf-8') as f:
+                json.dump(product.as_dict(), f, default=default, ensure_ascii=False, indent=4)
+            result.append(path)
+
+            json.dump(product.as_dict(), sys.stderr, default=default, ensure_ascii=False, indent=4)
+            print(file=sys.stderr)
+            print("%i/%i" % (index + 1, len(warps)), file=sys.stderr)
+
+        if not dry_run:
+            for site, watermark in listed_watermarks.items():
+                if site in failed_sites:
+                    print(f'Listing {site} again from where it was, some of its products failed',
+                          file=sys.stderr)
+                else:
+                    self.watermarks[site] = watermark
+        if not dry_run and configuration['state-file']:
+            save_watermarks(configuration['state-file'], self.watermarks)
+        if not dry_run and configuration.get('retention-hours'):
+            for path in remove_old_days(configuration['output-directory'],
+                                        datetime.timedelta(hours=configuration['retention-hours']),
+                                        now):
+                print(f'Removed {path}', file=sys.stderr)
+        if not dry_run and configuration.get('metrics-file'):
+            metrics.write_json_line(configuration['metrics-file'])
+        if not dry_run and configuration.get('prometheus-file'):
+            metrics.write_prometheus(configuration['prometheus-file'])
+        return result
+
+
+def download(dry_run, configuration, compress=False):
+    """Downloads and reprojects the newest products once, see Downloader."""
+    downloader = Downloader(configuration, compress)
+    try:
+        return downloader.download(dry_run)
+    finally:
+        downloader.close()
+
+
+def run_after_round(command, paths):
+    """Runs command through the shell with the new product paths in stdin."""
+    print(f'Running {command} for {len(paths)} new products', file=sys.stderr)
+    try:
+        subprocess.run(command, shell=True, check=True, text=True,
+                       input=''.join(path + '\n' for path in paths))
+    except subprocess.CalledProcessError as e:
+        print(f'{command} failed with status {e.returncode}, continuing...', file=sys.stderr)
+
+
+def run_daemon(configuration, interval=DEFAULT_POLL_INTERVAL, compress=False, after_round=None):
+    """Downloads new products every interval seconds until terminated.
+
+    Unlike running the downloader from cron, the S3 client, GDAL and the
+    worker pools stay warm between rounds, so new products get processed
+    within seconds of being listed. after_round is a shell command run after
+    each round that produced new products, e.g. one building the
+    distribution, see run_after_round.
+
+    SIGTERM stops the daemon once the current round is finished.
+    """
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        print('Stopping after the current round...', file=sys.stderr)
+        stop.set()
+    signal.signal(signal.SIGTERM, request_stop)
+
+    downloader = Downloader(configuration, compress)
+    try:
+        while not stop.is_set():
+            started = time.monotonic()
+            try:
+                paths = downloader.download()
+            except Exception:
+                traceback.print_exc()
+                print('Download round failed, continuing...', file=sys.stderr)
+                paths = []
+            if paths and after_round:
+                run_after_round(after_round, paths)
+            stop.wait(max(0, interval - (time.monotonic() - started)))
+    finally:
+        downloader.close()
 
 
 def main():
@@ -420,7 +961,17 @@ def main():
     parser.add_argument("-d", "--dry-run", dest="dry_run", help="Don't actually download anything",
                         action="store_true", default=False)
     parser.add_argument("-c", "--config", dest="config", help="read configuration from FILE", metavar="FILE")
+    parser.add_argument("--compress", action="store_true", default=False,
+                        help="gzip the reprojected products")
+    parser.add_argument("--daemon", action="store_true", default=False,
+                        help="keep running, downloading new products every --interval seconds")
+    parser.add_argument("--interval", type=float, default=DEFAULT_POLL_INTERVAL,
+                        help="seconds between listings in daemon mode")
+    parser.add_argument("--after-round", metavar="COMMAND", default=None,
+                        help="in daemon mode, shell command to run with the new product paths in stdin after each round producing some")
     args = parser.parse_args()
+    if args.daemon and args.dry_run:
+        parser.error("--dry-run can't be used with --daemon")
 
     try:
         configuration = read_configuration(args.config)
@@ -435,7 +986,10 @@ def main():
         print("Note that the path above may not be correct - should most likely be the dir called data one dir above this script!")
         parser.error("Couldn't read configuration file passed in")
 
-    download(args.dry_run, configuration)
+    if args.daemon:
+        run_daemon(configuration, args.interval, args.compress, args.after_round)
+    else:
+        download(args.dry_run, configuration, args.compress)
 
 if __name__ == '__main__':
     main()
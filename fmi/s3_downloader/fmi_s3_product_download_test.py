@@ -1,6 +1,17 @@
+import concurrent.futures
+import gzip
+import json
+import os
+import tempfile
 import unittest
-from datetime import datetime as dt, timezone
-from fmi_s3_product_download import Product, DataScale, _dbzh_datascale
+import unittest.mock
+from datetime import datetime as dt, timedelta, timezone
+
+import numpy as np
+from osgeo import gdal, osr
+
+from fmi_s3_product_download import (Downloader, Product, _dbzh_datascale, compress_file,
+                                     listing_start_after, remove_old_days, warp_product)
 
 
 class TestRadarPPI(unittest.TestCase):
@@ -205,5 +216,166 @@ class TestCompositeACRR(unittest.TestCase):
         self.assertTrue(result.composite)
 
 
+class TestListingStartAfter(unittest.TestCase):
+    def test_no_watermark(self):
+        self.assertIsNone(listing_start_after(None, "2026/01/24/fikau/"))
+
+    def test_watermark_for_another_day(self):
+        watermark = {
+            "prefix": "2026/01/23/fikau/",
+            "last_key": "2026/01/23/fikau/202601232355_fikau_ppi_0.3_dbzh_qc.tif"
+        }
+        self.assertIsNone(listing_start_after(watermark, "2026/01/24/fikau/"))
+
+    def test_watermark_looks_back(self):
+        watermark = {
+            "prefix": "2026/01/24/fikau/",
+            "last_key": "2026/01/24/fikau/202601241200_fikau_ppi_0.3_dbzh_qc.tif"
+        }
+        self.assertEqual(listing_start_after(watermark, "2026/01/24/fikau/"),
+                         "2026/01/24/fikau/202601241145")
+
+
+class _FakeS3Client(object):
+    """Lists a single product and fails to download it while failing is set."""
+
+    filename = "202601240000_fikau_ppi_0.3_dbzh_qc.tif"
+
+    def __init__(self):
+        self.failing = True
+
+    def list_objects_v2(self, Bucket, Prefix, **kwargs):
+        return {'Contents': [{'Key': Prefix + self.filename}]}
+
+    def download_fileobj(self, bucket, key, buffer):
+        if self.failing:
+            raise IOError("Connection reset")
+        buffer.write(b'TIFF')
+
+
+def _warped(self, source, reproj_tiff_path, *args):
+    future = concurrent.futures.Future()
+    future.set_result((reproj_tiff_path, {}))
+    return future
+
+
+class TestDownloaderWatermarks(unittest.TestCase):
+    def test_watermark_advances_only_after_download(self):
+        with tempfile.TemporaryDirectory() as directory:
+            state_file = os.path.join(directory, 'listing_state.json')
+            configuration = {
+                'sites': ['fikau'],
+                'download-concurrency': 1,
+                'warp-concurrency': 1,
+                'side-length': 100,
+                'output-directory': os.path.join(directory, 'data'),
+                'state-file': state_file,
+                'warp-cache-directory': os.path.join(directory, 'warp_cache'),
+                'retention-hours': None,
+                'metrics-file': None,
+                'prometheus-file': None
+            }
+            client = _FakeS3Client()
+            with unittest.mock.patch('fmi_s3_product_download.make_client', return_value=client), \
+                    unittest.mock.patch.object(Downloader, 'submit_warp', _warped):
+                downloader = Downloader(configuration)
+                try:
+                    self.assertEqual(downloader.download(), [])
+                    with open(state_file) as f:
+                        self.assertEqual(json.load(f), {})
+
+                    client.failing = False
+                    self.assertEqual(len(downloader.download()), 1)
+                    with open(state_file) as f:
+                        self.assertTrue(json.load(f)['fikau']['last_key'].endswith(
+                            _FakeS3Client.filename))
+                finally:
+                    downloader.close()
+
+
+class TestCompressFile(unittest.TestCase):
+    def test_compress_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'product.tiff')
+            with open(path, 'wb') as f:
+                f.write(b'TIFF')
+
+            self.assertEqual(compress_file(path), path + '.gz')
+
+            self.assertEqual(os.listdir(directory), ['product.tiff.gz'])
+            with gzip.open(path + '.gz') as f:
+                self.assertEqual(f.read(), b'TIFF')
+
+
+class TestRemoveOldDays(unittest.TestCase):
+    def test_remove_old_days(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for day in ['2026/1/22', '2026/1/23', '2026/1/24']:
+                os.makedirs(os.path.join(directory, day))
+            os.makedirs(os.path.join(directory, '2025', '12', '31'))
+            os.makedirs(os.path.join(directory, 'other'))
+
+            removed = remove_old_days(directory, timedelta(hours=24),
+                                      dt(2026, 1, 24, 12, 0, tzinfo=timezone.utc))
+
+            self.assertEqual(removed, [os.path.join(directory, '2025', '12', '31'),
+                                       os.path.join(directory, '2026', '1', '22')])
+            self.assertEqual(sorted(os.listdir(directory)), ['2026', 'other'])
+            self.assertEqual(sorted(os.listdir(os.path.join(directory, '2026', '1'))),
+                             ['23', '24'])
+
+
+def _source_tiff(directory):
+    """Returns a small single band product like FMI's as GeoTIFF bytes."""
+    width, height = 60, 40
+    data = (np.arange(width * height) % 250).astype(np.uint8).reshape(height, width)
+    # Not scanned
+    data[:5, :] = 255
+    data[:, 50:] = 255
+
+    path = os.path.join(directory, 'source.tif')
+    source_ds = gdal.GetDriverByName('GTiff').Create(path, width, height, 1, gdal.GDT_Byte)
+    source_ds.SetGeoTransform((300000, 1000, 0, 7000000, 0, -1000))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3067)
+    source_ds.SetProjection(srs.ExportToWkt())
+    band = source_ds.GetRasterBand(1)
+    band.SetNoDataValue(255)
+    band.WriteArray(data)
+    source_ds = None
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class TestWarpProduct(unittest.TestCase):
+    def test_warp_grid_matches_gdal_warp(self):
+        with tempfile.TemporaryDirectory() as directory:
+            source = _source_tiff(directory)
+            warped_path = os.path.join(directory, 'warped.tiff')
+            gridded_path = os.path.join(directory, 'gridded.tiff')
+
+            warp_product(source, warped_path, 30)
+            warp_product(source, gridded_path, 30, site='fitest',
+                         cache_directory=os.path.join(directory, 'cache'))
+            # Once more with the grid from the cache
+            gridded_again_path = os.path.join(directory, 'gridded_again.tiff')
+            warp_product(source, gridded_again_path, 30, site='fitest',
+                         cache_directory=os.path.join(directory, 'cache'))
+
+            warped = gdal.Open(warped_path)
+            expected = warped.GetRasterBand(1).ReadAsArray()
+            self.assertIn(255, expected)
+            for path in [gridded_path, gridded_again_path]:
+                gridded = gdal.Open(path)
+                self.assertEqual((gridded.RasterXSize, gridded.RasterYSize),
+                                 (warped.RasterXSize, warped.RasterYSize))
+                self.assertEqual(gridded.GetGeoTransform(), warped.GetGeoTransform())
+                self.assertEqual(gridded.GetRasterBand(1).GetNoDataValue(),
+                                 warped.GetRasterBand(1).GetNoDataValue())
+                np.testing.assert_array_equal(gridded.GetRasterBand(1).ReadAsArray(), expected)
+                gridded = None
+            warped = None
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,114 @@
+"""
+Timings of the stages of the components of the pipeline, for monitoring.
+
+Shared by collect.py, fmi/dist_builder/collect_radar_products.py and the S3
+downloader, which add the repository root to their module search path for it.
+"""
+import datetime
+import json
+import os
+import threading
+import time
+
+
+class Metrics(object):
+    """Durations, bytes and counts of the stages of a run, for monitoring.
+
+    Each time a stage, e.g. exporting a product, is done, the seconds it
+    took and the bytes it read and wrote are added to the totals of the
+    stage. Gauges are single values like the age of the latest product of a
+    site, optionally labeled.
+    """
+
+    # Stage totals in the Prometheus text format: key, metric name, description
+    PROMETHEUS_STAGE_METRICS = [
+        ('count', 'count', 'Number of times the stage was done in the last run.'),
+        ('seconds', 'seconds', 'Seconds spent in the stage in the last run.'),
+        ('maxSeconds', 'max_seconds', 'Longest time the stage took in the last run.'),
+        ('bytesIn', 'bytes_in', 'Bytes read by the stage in the last run.'),
+        ('bytesOut', 'bytes_out', 'Bytes written by the stage in the last run.')
+    ]
+
+    def __init__(self, component):
+        self.component = component
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.gauges = []
+
+    def _add(self, stage, count, seconds, max_seconds, bytes_in, bytes_out):
+        with self.lock:
+            totals = self.stages.setdefault(stage, {
+                'count': 0, 'seconds': 0.0, 'maxSeconds': 0.0, 'bytesIn': 0, 'bytesOut': 0})
+            totals['count'] += count
+            totals['seconds'] += seconds
+            totals['maxSeconds'] = max(totals['maxSeconds'], max_seconds)
+            totals['bytesIn'] += bytes_in
+            totals['bytesOut'] += bytes_out
+
+    def add(self, stage, seconds, count=1, bytes_in=0, bytes_out=0):
+        self._add(stage, count, seconds, seconds, bytes_in, bytes_out)
+
+    def merge(self, stages):
+        """Adds the stages of another Metrics, e.g. one of a worker process."""
+        for stage, totals in stages.items():
+            self._add(stage, totals['count'], totals['seconds'], totals['maxSeconds'],
+                      totals['bytesIn'], totals['bytesOut'])
+
+    def gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges.append({'name': name, 'labels': labels, 'value': value})
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                'component': self.component,
+                'seconds': round(time.time() - self.started, 3),
+                'stages': json.loads(json.dumps(self.stages)),
+                'gauges': json.loads(json.dumps(self.gauges))
+            }
+
+    def write_json_line(self, path):
+        """Appends the metrics into path as a line of JSON."""
+        with open(path, 'a') as f:
+            f.write(json.dumps(self.as_dict(), sort_keys=True) + '\n')
+
+    def write_prometheus(self, path):
+        """Writes the metrics into path in the Prometheus text format.
+
+        The file is replaced atomically, so it can be picked up by e.g. the
+        textfile collector of the node exporter at any time.
+        """
+        metrics = self.as_dict()
+
+        def labels(**values):
+            return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                            for k, v in sorted(values.items()))
+
+        lines = []
+        for key, name, description in self.PROMETHEUS_STAGE_METRICS:
+            lines.append('# HELP ppi_stage_{} {}'.format(name, description))
+            lines.append('# TYPE ppi_stage_{} gauge'.format(name))
+            for stage, totals in sorted(metrics['stages'].items()):
+                lines.append('ppi_stage_{}{{{}}} {}'.format(
+                    name, labels(component=self.component, stage=stage), totals[key]))
+        typed = set()
+        for gauge in metrics['gauges']:
+            if gauge['name'] not in typed:
+                lines.append('# TYPE ppi_{} gauge'.format(gauge['name']))
+                typed.add(gauge['name'])
+            lines.append('ppi_{}{{{}}} {}'.format(
+                gauge['name'], labels(component=self.component, **gauge['labels']),
+                gauge['value']))
+        lines.append('# TYPE ppi_run_seconds gauge')
+        lines.append('ppi_run_seconds{{{}}} {}'.format(labels(component=self.component),
+                                                       metrics['seconds']))
+        lines.append('# TYPE ppi_last_run_timestamp_seconds gauge')
+        lines.append('ppi_last_run_timestamp_seconds{{{}}} {}'.format(
+            labels(component=self.component), round(time.time(), 3)))
+
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, path)
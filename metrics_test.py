@@ -0,0 +1,82 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from metrics import Metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _metrics(self):
+        worker = Metrics(None)
+        worker.add('gdalwarp', 2.0, bytes_in=100, bytes_out=40)
+        metrics = Metrics('downloader')
+        metrics.add('gdalwarp', 1.0, bytes_in=100, bytes_out=50)
+        metrics.merge(worker.stages)
+        metrics.add('list', 0.5, count=3)
+        metrics.gauge('latest_product_age_seconds', 120, site='fivan')
+        return metrics
+
+    def test_merge(self):
+        metrics = self._metrics()
+
+        self.assertEqual(metrics.stages['gdalwarp'], {
+            'count': 2, 'seconds': 3.0, 'maxSeconds': 2.0, 'bytesIn': 200, 'bytesOut': 90})
+        self.assertEqual(metrics.stages['list'], {
+            'count': 3, 'seconds': 0.5, 'maxSeconds': 0.5, 'bytesIn': 0, 'bytesOut': 0})
+
+    def test_json_lines(self):
+        path = os.path.join(self.directory, 'metrics.jsonl')
+        metrics = self._metrics()
+
+        metrics.write_json_line(path)
+        metrics.add('list', 1.0)
+        metrics.write_json_line(path)
+
+        with open(path) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0]['component'], 'downloader')
+        self.assertEqual(lines[0]['stages']['list']['count'], 3)
+        self.assertEqual(lines[1]['stages']['list']['count'], 4)
+        self.assertEqual(lines[1]['gauges'], [{'name': 'latest_product_age_seconds',
+                                               'labels': {'site': 'fivan'}, 'value': 120}])
+
+    def test_prometheus(self):
+        path = os.path.join(self.directory, 'downloader.prom')
+        metrics = self._metrics()
+        metrics.gauge('products', 2, status='has "quotes"\\')
+
+        metrics.write_prometheus(path)
+
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(os.listdir(self.directory), ['downloader.prom'])
+        self.assertIn('# HELP ppi_stage_max_seconds Longest time the stage took in the last run.',
+                      lines)
+        self.assertIn('# TYPE ppi_stage_max_seconds gauge', lines)
+        self.assertIn('ppi_stage_max_seconds{component="downloader",stage="gdalwarp"} 2.0', lines)
+        self.assertIn('ppi_stage_count{component="downloader",stage="list"} 3', lines)
+        self.assertIn('ppi_latest_product_age_seconds{component="downloader",site="fivan"} 120',
+                      lines)
+        self.assertIn('ppi_products{component="downloader",status="has \\"quotes\\"\\\\"} 2', lines)
+        self.assertTrue(any(line.startswith('ppi_last_run_timestamp_seconds{component="downloader"} ')
+                            for line in lines))
+        # Every sample is of a metric whose type has been declared before it
+        typed = set()
+        for line in lines:
+            if line.startswith('# TYPE '):
+                typed.add(line.split()[2])
+            elif not line.startswith('#'):
+                self.assertIn(line.split('{')[0], typed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+"""
+Publishes a distribution built by collect.py as a snapshot, see
+collect.publish_generation.
+
+Run this only once everything producing the distribution has succeeded.
+"""
+import argparse
+import json
+import os
+
+from collect import (DEFAULT_KEEP_GENERATIONS, GENERATION_FILENAME, GENERATIONS_DIRNAME,
+                     CURRENT_LINK, err, publish_generation)
+
+
+def publish(directory, publish_directory, keep_generations=DEFAULT_KEEP_GENERATIONS):
+    """Publishes the catalog generation in directory, returns the path of the snapshot."""
+    with open(os.path.join(directory, GENERATION_FILENAME)) as f:
+        generation = json.load(f)['generation']
+    return publish_generation(directory, publish_directory, generation, keep_generations)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("directory",
+                        help="distribution produced by collect.py")
+    parser.add_argument("publish_directory",
+                        help="publish the distribution as a snapshot in PUBLISH_DIRECTORY/{}, pointed to by the PUBLISH_DIRECTORY/{} symlink"
+                        .format(GENERATIONS_DIRNAME, CURRENT_LINK))
+    parser.add_argument("--keep-generations", type=int, default=DEFAULT_KEEP_GENERATIONS,
+                        help="number of published snapshots to keep")
+    args = parser.parse_args()
+    if not os.path.exists(os.path.join(args.directory, GENERATION_FILENAME)):
+        parser.error(u"'{}' has no {}, run collect.py first".format(args.directory,
+                                                                    GENERATION_FILENAME))
+    err(u"Published {}".format(publish(args.directory, args.publish_directory,
+                                       args.keep_generations)))
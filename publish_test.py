@@ -0,0 +1,34 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from collect import write_catalog
+from publish import publish
+
+
+class TestPublish(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_publishes_latest_generation(self):
+        dist = os.path.join(self.directory, 'dist')
+        os.makedirs(dist)
+        write_catalog(dist, {})
+        write_catalog(dist, {'fivan': {'products': {'PPI dbZh': {'flavors': {
+            'EL 0.3': {'times': [{'url': 'a.json.gz'}]}}}}}})
+        publish_directory = os.path.join(self.directory, 'www')
+
+        snapshot = publish(dist, publish_directory)
+
+        self.assertEqual(os.path.basename(snapshot).split('-')[0], '2')
+        with open(os.path.join(publish_directory, 'current', 'catalog.json')) as f:
+            self.assertEqual(json.load(f)['generation'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()